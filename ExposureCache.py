@@ -0,0 +1,388 @@
+import os
+import json
+import math
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from array import array
+
+from shapely.geometry import LineString
+from shapely.geometry import box
+
+from RayCasting import unitVector
+from RayCasting import directionTable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def angleKey(angle):
+    """Returns the key of a direction, robust against float noise of the angle"""
+    return round(float(angle), 9)
+
+
+
+class RayCache:
+    """
+    Keeps the rays of previous calculations per (island FID, direction) together with
+    the ray length they were calculated with and the hash of the island geometry.
+
+    Before a calculation update() compares the islands with the ones of the previous
+    run: rays of changed sites are dropped and rays passing an added, removed or
+    changed island are invalidated. A ray which hit an island at distance d stays valid
+    for every ray length, a ray without a hit stays valid for shorter ray lengths.
+
+    The islands are compared by the hash of their stored WKB, so they aren't decoded
+    for it. The bounds are only read for changed islands, the bounds of new islands are
+    read after the calculation (see resolveBounds) when the geometries are decoded.
+    """
+
+    def __init__(self, logger = None):
+        self.logger = logger or logging.getLogger(__name__+'.RayCache')
+        self.clear()
+
+
+    def clear(self):
+        """Removes all cached rays"""
+        #fid -> {angleKey: (length, distance, hitPoint or None)}
+        self.rays = {}
+        #fid -> (geometry hash, (x, y) of the centroid)
+        self.sites = {}
+        #fid -> (geometry hash, bounds or None) of the islands of the last calculation
+        self.obstacles = {}
+        #Layer and fids of the islands whose bounds are read by resolveBounds
+        self.pendingBounds = None
+        self.engine = None
+
+
+    def update(self, visitedIslands, allIslands, engine = None):
+        """Compares the islands with the ones of the previous calculation and removes
+        all rays which might have changed"""
+        if engine != self.engine:
+            if self.engine is not None:
+                self.logger.info('Engine changed from %s to %s, clearing ray cache' % (self.engine, engine))
+            self.clear()
+            self.engine = engine
+
+        #The bounds of the last calculation are read before its layer may change
+        self.resolveBounds()
+
+        geomColumn = allIslands.geomColumn
+        obstacles = {}
+        pending = []
+        for row, fid in enumerate(allIslands.fids):
+            geomHash = geomColumn.getHash(row)
+            old = self.obstacles.get(fid)
+            if old is not None and old[0] == geomHash:
+                obstacles[fid] = old
+            else:
+                obstacles[fid] = (geomHash, None)
+                pending.append(fid)
+
+        changedBounds = []
+        changedIslands = 0
+        if self.obstacles:
+            for fid in pending:
+                obstacles[fid] = (obstacles[fid][0], geomColumn[allIslands.rows[fid]].bounds)
+            pending = []
+
+            for fid in set(self.obstacles) | set(obstacles):
+                old = self.obstacles.get(fid)
+                new = obstacles.get(fid)
+                if old is None or new is None or old[0] != new[0]:
+                    changedIslands += 1
+                    changedBounds.extend(state[1] for state in (old, new) if state is not None)
+        self.obstacles = obstacles
+        self.pendingBounds = (allIslands, pending) if pending else None
+
+        changedSites = 0
+        siteColumn = visitedIslands.geomColumn
+        for row, fid in enumerate(visitedIslands.fids):
+            siteHash = obstacles[fid][0] if fid in obstacles else siteColumn.getHash(row)
+            site = self.sites.get(fid)
+            if site is None or site[0] != siteHash:
+                if site is not None:
+                    changedSites += 1
+                centroid = siteColumn[row].centroid
+                self.sites[fid] = (siteHash, (centroid.x, centroid.y))
+                self.rays.pop(fid, None)
+
+        invalidated = self.invalidate(changedBounds) if changedBounds else 0
+
+        self.logger.info('Ray cache: %i changed islands, %i changed sites, %i invalidated rays'
+                         % (changedIslands, changedSites, invalidated))
+
+
+    def resolveBounds(self):
+        """Reads the bounds of the islands which were new in the last update, at once
+        from the geometries decoded by the calculation"""
+        if self.pendingBounds is None:
+            return
+        allIslands, fids = self.pendingBounds
+        self.pendingBounds = None
+
+        geomColumn = allIslands.geomColumn
+        geomColumn.decodeAll()
+        for fid in fids:
+            row = allIslands.rows.get(fid)
+            if row is not None and fid in self.obstacles:
+                self.obstacles[fid] = (self.obstacles[fid][0], geomColumn[row].bounds)
+
+
+    def invalidate(self, boundsList):
+        """Removes all cached rays which pass one of the given bounding boxes"""
+        boxes = [box(*bounds) for bounds in boundsList]
+        minx = min(bounds[0] for bounds in boundsList)
+        miny = min(bounds[1] for bounds in boundsList)
+        maxx = max(bounds[2] for bounds in boundsList)
+        maxy = max(bounds[3] for bounds in boundsList)
+
+        invalidated = 0
+        for fid, rays in self.rays.items():
+            x, y = self.sites[fid][1]
+            for key in list(rays.keys()):
+                length, distance, hitPoint = rays[key]
+                reach = min(length, distance)
+                ux, uy = unitVector(key)
+                endx = x + ux * reach
+                endy = y + uy * reach
+
+                if max(x, endx) < minx or min(x, endx) > maxx or max(y, endy) < miny or min(y, endy) > maxy:
+                    continue
+
+                ray = LineString([(x, y), (endx, endy)])
+                if any(ray.intersects(changed) for changed in boxes):
+                    del rays[key]
+                    invalidated += 1
+
+        return invalidated
+
+
+    def missingAngles(self, fid, angles, length):
+        """Returns the angles which have to be calculated for the site with the given length"""
+        rays = self.rays.get(fid, {})
+        missing = []
+        for angle in angles:
+            entry = rays.get(angleKey(angle))
+            if entry is None or (entry[2] is None and entry[0] < length):
+                missing.append(angle)
+        return missing
+
+
+    def store(self, fid, angles, rays, length):
+        """Stores the result of castRays for the given angles"""
+        siteRays = self.rays.setdefault(fid, {})
+        for angle, (distance, endPoint) in zip(angles, rays):
+            hitPoint = endPoint if distance < length else None
+            siteRays[angleKey(angle)] = (length, distance, hitPoint)
+
+
+    def getRays(self, fid, centroid, angles, length):
+        """Returns the rays (distance, endPoint) of the site for all angles like castRays.
+        All angles have to be cached (see missingAngles)"""
+        siteRays = self.rays[fid]
+        results = []
+        for angle, (ux, uy) in zip(angles, directionTable(tuple(angles))):
+            cachedLength, distance, hitPoint = siteRays[angleKey(angle)]
+            if hitPoint is not None and distance < length:
+                results.append((distance, hitPoint))
+            else:
+                endPointx = centroid.x + (ux * length)
+                endPointy = centroid.y + (uy * length)
+                results.append((length, (endPointx, endPointy)))
+        return results
+
+
+
+def hashSourceFile(path, blockSize = 1 << 20):
+    """Returns the SHA-256 of the content of a source file and its sidecar files
+    (e.g. .shx, .dbf, .prj and .cpg of a shape file)"""
+    base = os.path.splitext(path)[0]
+    sha = hashlib.sha256()
+    for extension in ('', '.shx', '.dbf', '.prj', '.cpg'):
+        sidecar = path if extension == '' else base + extension
+        if extension and (sidecar == path or not os.path.isfile(sidecar)):
+            continue
+        sha.update(extension.encode('ascii'))
+        with open(sidecar, 'rb') as f:
+            for block in iter(lambda: f.read(blockSize), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+
+class DiskCache:
+    """
+    On-disk cache of parsed layers and cast rays keyed by the content hash of the
+    source file.
+
+    A layer is stored as memory-mappable NumPy arrays: the WKB of all geometries in one
+    buffer with an offset array, the FIDs and one array per numeric attribute column.
+    Other attribute columns and the layer description are stored as JSON. The rays of a
+    RayCache are stored per source hash and engine, the RayCache itself decides which
+    rays are valid for the current ray length, degree and filter.
+    """
+
+    def __init__(self, directory, logger = None):
+        if np is None:
+            raise ImportError('The disk cache requires the package numpy')
+
+        self.logger = logger or logging.getLogger(__name__+'.DiskCache')
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+
+
+    def layerDir(self, key):
+        return os.path.join(self.directory, 'layer-%s' % key)
+
+
+    def raysDir(self, key, engine):
+        return os.path.join(self.directory, 'rays-%s-%s' % (key, engine))
+
+
+    def writeDir(self, target, write):
+        """Writes a cache entry into a temporary directory and moves it to target,
+        so a cache entry is either complete or missing"""
+        temp = tempfile.mkdtemp(dir = self.directory)
+        try:
+            write(temp)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            os.replace(temp, target)
+        except BaseException:
+            shutil.rmtree(temp, ignore_errors = True)
+            raise
+
+
+    def storeLayer(self, key, layer):
+        """Stores a Layer under the given source hash"""
+        from ShpHelper import packWkb
+
+        def write(directory):
+            buffer, offsets = packWkb(layer.geomColumn)
+            np.save(os.path.join(directory, 'wkb.npy'), np.frombuffer(buffer, dtype = np.uint8))
+            np.save(os.path.join(directory, 'offsets.npy'), np.frombuffer(offsets, dtype = np.uint64))
+            np.save(os.path.join(directory, 'fids.npy'), np.asarray(layer.fids, dtype = np.int64))
+
+            numeric = {}
+            other = {}
+            for i, (name, column) in enumerate(layer.columns.items()):
+                if isinstance(column, array):
+                    numeric[name] = ('column-%i.npy' % i, column.typecode)
+                    np.save(os.path.join(directory, numeric[name][0]), np.frombuffer(column, dtype = column.typecode))
+                else:
+                    other[name] = list(column)
+
+            meta = {'geometryType': layer.geometryType,
+                    'srs': layer.srs.ExportToWkt() if layer.srs is not None else None,
+                    'fields': layer.fields,
+                    'columnOrder': list(layer.columns.keys()),
+                    'numericColumns': numeric,
+                    'otherColumns': other}
+            with open(os.path.join(directory, 'layer.json'), 'w') as f:
+                json.dump(meta, f)
+
+        self.writeDir(self.layerDir(key), write)
+        self.logger.info('Stored layer with %i geometries in the cache' % len(layer.fids))
+
+
+    def loadLayer(self, key):
+        """Returns the cached Layer of the given source hash or None"""
+        from ShpHelper import Layer
+        from ShpHelper import unpackWkb
+
+        directory = self.layerDir(key)
+        if not os.path.isfile(os.path.join(directory, 'layer.json')):
+            return None
+
+        with open(os.path.join(directory, 'layer.json')) as f:
+            meta = json.load(f)
+
+        buffer = np.load(os.path.join(directory, 'wkb.npy'), mmap_mode = 'r')
+        offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode = 'r')
+        fids = np.load(os.path.join(directory, 'fids.npy')).tolist()
+
+        columns = {}
+        for name in meta['columnOrder']:
+            if name in meta['numericColumns']:
+                fileName, typecode = meta['numericColumns'][name]
+                values = np.load(os.path.join(directory, fileName), mmap_mode = 'r')
+                columns[name] = array(typecode, values.tobytes())
+            else:
+                columns[name] = meta['otherColumns'][name]
+
+        srs = None
+        if meta['srs'] is not None:
+            import osr
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(meta['srs'])
+
+        layer = Layer()
+        layer.setSRS(srs)
+        layer.setGeometryType(meta['geometryType'])
+        layer.setFields(meta['fields'])
+        #The geometries are decoded when they are needed
+        layer.setRows(fids, unpackWkb(buffer, offsets.tolist(), decode = False), columns)
+
+        self.logger.info('Loaded layer with %i geometries from the cache' % len(fids))
+        return layer
+
+
+    def storeRays(self, key, engine, rayCache):
+        """Stores the rays of a RayCache under the given source hash and engine"""
+
+        rayCache.resolveBounds()
+
+        def write(directory):
+            rays = [(fid, angle) + entry for fid, siteRays in rayCache.rays.items() for angle, entry in siteRays.items()]
+            np.save(os.path.join(directory, 'rayFids.npy'), np.asarray([ray[0] for ray in rays], dtype = np.int64))
+            values = np.full((len(rays), 5), np.nan)
+            for i, (fid, angle, length, distance, hitPoint) in enumerate(rays):
+                values[i, :3] = (angle, length, distance)
+                if hitPoint is not None:
+                    values[i, 3:] = hitPoint
+            np.save(os.path.join(directory, 'rays.npy'), values)
+
+            sites = list(rayCache.sites.items())
+            np.save(os.path.join(directory, 'siteFids.npy'), np.asarray([fid for fid, site in sites], dtype = np.int64))
+            np.save(os.path.join(directory, 'siteHashes.npy'), np.asarray([site[0] for fid, site in sites], dtype = 'S40'))
+            np.save(os.path.join(directory, 'siteCentroids.npy'), np.asarray([site[1] for fid, site in sites], dtype = np.float64).reshape(-1, 2))
+
+            obstacles = list(rayCache.obstacles.items())
+            np.save(os.path.join(directory, 'obstacleFids.npy'), np.asarray([fid for fid, state in obstacles], dtype = np.int64))
+            np.save(os.path.join(directory, 'obstacleHashes.npy'), np.asarray([state[0] for fid, state in obstacles], dtype = 'S40'))
+            np.save(os.path.join(directory, 'obstacleBounds.npy'), np.asarray([state[1] for fid, state in obstacles], dtype = np.float64).reshape(-1, 4))
+
+        self.writeDir(self.raysDir(key, engine), write)
+        self.logger.info('Stored %i rays in the cache' % sum(len(siteRays) for siteRays in rayCache.rays.values()))
+
+
+    def loadRays(self, key, engine, rayCache):
+        """Fills the RayCache with the cached rays of the source hash and engine.
+        Returns False if nothing is cached"""
+        directory = self.raysDir(key, engine)
+        if not os.path.isfile(os.path.join(directory, 'obstacleBounds.npy')):
+            return False
+
+        def load(name):
+            return np.load(os.path.join(directory, name))
+
+        rayCache.clear()
+        rayCache.engine = engine
+
+        for fid, siteHash, centroid in zip(load('siteFids.npy').tolist(), load('siteHashes.npy'), load('siteCentroids.npy').tolist()):
+            rayCache.sites[fid] = (siteHash.decode('ascii'), tuple(centroid))
+
+        for fid, stateHash, bounds in zip(load('obstacleFids.npy').tolist(), load('obstacleHashes.npy'), load('obstacleBounds.npy').tolist()):
+            rayCache.obstacles[fid] = (stateHash.decode('ascii'), tuple(bounds))
+
+        for fid, (angle, length, distance, hitx, hity) in zip(load('rayFids.npy').tolist(), load('rays.npy').tolist()):
+            hitPoint = None if math.isnan(hitx) else (hitx, hity)
+            rayCache.rays.setdefault(fid, {})[angle] = (length, distance, hitPoint)
+
+        self.logger.info('Loaded %i rays from the cache' % sum(len(siteRays) for siteRays in rayCache.rays.values()))
+        return True
@@ -0,0 +1,261 @@
+"""
+Command line interface of the wave exposure calculation for headless batch runs.
+
+Single run:
+
+    python ExposureCli.py gis/Vaestervik.shp --filter "visited = 1" \
+        --points gis/points.shp --lines gis/multi.shp
+
+Many runs in one invocation with a manifest (JSON list of objects or CSV with a
+header). Every job takes the keys source, filter, length, degree, engine, workers,
+simplify, cellsize, points and lines, missing keys default to the command line options:
+
+    python ExposureCli.py --manifest jobs.csv --workers 32 --timing timing.json
+
+The outputs can be shape files, GeoPackages (the same .gpkg for points and lines
+holds both layers, written in one transaction) or tables for analytics (.csv with
+the geometry as hex WKB, .parquet as GeoParquet).
+
+The source can be any vector file OGR reads. The attribute filter and --study-area
+are evaluated by the driver where possible and --fields limits the decoded fields.
+
+With --tile-size the islands are read and calculated tile by tile (buffered by the
+ray length) to bound the memory for very large source files.
+
+Jobs on the same source file reuse the loaded islands and the rays of the previous
+jobs. A JSON timing summary of all jobs is written at the end (stdout by default),
+with --metrics it contains the counters of every job (polygons tested, intersections,
+rays per island).
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import logging.config
+import argparse
+
+from WaveExposure import WaveExposure
+
+
+#Options which can be set per job in a manifest
+jobKeys = ('source', 'filter', 'length', 'degree', 'engine', 'workers', 'simplify', 'cellsize', 'points', 'lines')
+
+
+def createParser():
+    parser = argparse.ArgumentParser(description = 'Calculates the wave exposure of islands (GREMO without bathymetry)')
+    parser.add_argument('source', nargs = '?', help = 'Vector file readable by OGR (shape file, GeoPackage, FlatGeobuf, ...) with the island polygons')
+    parser.add_argument('--layer', default = None, help = 'Name of the layer in the source file (default: the first layer)')
+    parser.add_argument('--fields', default = None,
+                        help = 'Comma separated fields of the islands to read and copy into the output (default: all fields)')
+    parser.add_argument('--study-area', type = float, nargs = 4, default = None, metavar = ('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help = 'Only calculate the sites in this box and read the islands within the ray length of it')
+    parser.add_argument('--filter', default = None, help = 'Attribute filter selecting the sites, e.g. "visited = 1"')
+    parser.add_argument('--length', type = float, default = WaveExposure.length, help = 'Length of the rays in m (default: %(default)s)')
+    parser.add_argument('--degree', type = float, default = WaveExposure.deg, help = 'Degree between the rays (default: %(default)s)')
+    parser.add_argument('--engine', choices = WaveExposure.engines, default = WaveExposure.engine, help = 'Ray casting engine (default: %(default)s)')
+    parser.add_argument('--workers', type = int, default = 1, help = 'Number of worker processes (default: %(default)s)')
+    parser.add_argument('--simplify', type = float, default = None,
+                        help = 'Tolerance in m of the simplified island boundaries (shapely engine, default: full boundaries)')
+    parser.add_argument('--cellsize', type = float, default = WaveExposure.cellSize,
+                        help = 'Cell size in m of the land grid of the raster engine (default: %(default)s)')
+    parser.add_argument('--points', default = None,
+                        help = 'Output file (.shp, .gpkg, .csv or .parquet) for the points with the exposure')
+    parser.add_argument('--lines', default = None,
+                        help = 'Output file (.shp, .gpkg, .csv or .parquet) for the rays as MultiLineStrings, '
+                               'the same GeoPackage as --points holds both layers')
+    parser.add_argument('--stream', action = 'store_true', help = 'Write the results while calculating instead of keeping them in memory')
+    parser.add_argument('--tile-size', type = float, default = None,
+                        help = 'Calculate in tiles of this size in m, loading only the islands of one tile at a time (streams the results)')
+    parser.add_argument('--cache-dir', default = None, help = 'Directory to cache parsed layers and rays between runs')
+    parser.add_argument('--manifest', default = None, help = 'JSON or CSV file with one job per entry/row')
+    parser.add_argument('--timing', default = '-', help = 'File for the JSON timing summary ("-" for stdout, default)')
+    parser.add_argument('--metrics', action = 'store_true', help = 'Add the counters and timers of every job to the timing summary')
+    parser.add_argument('--log-level', default = 'INFO', help = 'Log level (default: %(default)s)')
+    parser.add_argument('--log-config', default = None, help = 'logging.conf style file to configure the logging')
+    return parser
+
+
+def readManifest(path):
+    """Returns the list of job dicts of a JSON or CSV manifest"""
+    with open(path, newline = '') as f:
+        if os.path.splitext(path)[1].lower() == '.json':
+            jobs = json.load(f)
+        else:
+            jobs = [row for row in csv.DictReader(f)]
+
+    for job in jobs:
+        unknown = set(job) - set(jobKeys)
+        if unknown:
+            raise ValueError('Unknown keys in manifest %s: %s' % (path, ', '.join(sorted(unknown))))
+
+    return jobs
+
+
+def createJobs(args):
+    """Returns the jobs of the invocation with all keys set"""
+    defaults = {key: getattr(args, key) for key in jobKeys}
+
+    if args.manifest is None:
+        return [defaults]
+
+    jobs = []
+    for entry in readManifest(args.manifest):
+        job = dict(defaults)
+        job.update({key: value for key, value in entry.items() if value not in (None, '')})
+        job['length'] = float(job['length'])
+        job['degree'] = float(job['degree'])
+        job['workers'] = int(job['workers'])
+        job['cellsize'] = float(job['cellsize'])
+        if job['simplify'] is not None:
+            job['simplify'] = float(job['simplify'])
+        jobs.append(job)
+    return jobs
+
+
+def configureJob(exposure, job):
+    """Sets the parameters of a job on the WaveExposure"""
+    exposure.setSourceFile(job['source'])
+    exposure.setFilter(job['filter'])
+    exposure.setRayLength(job['length'])
+    exposure.setDegree(job['degree'])
+    exposure.setEngine(job['engine'])
+    exposure.setWorkers(job['workers'])
+    exposure.setSimplifyTolerance(job['simplify'])
+    exposure.setCellSize(job['cellsize'])
+
+
+def runJob(exposure, job, stream = False):
+    """Runs a single job and returns its timing dict"""
+    if exposure.getTileSize() is not None:
+        return runTiledJob(exposure, job)
+
+    configureJob(exposure, job)
+
+    timing = dict(job)
+    exposure.resetMetrics()
+
+    start = time.perf_counter()
+    exposure.loadIslandData()
+    timing['load'] = time.perf_counter() - start
+    timing['islands'] = len(exposure.allIslandsLayer.geometries)
+    timing['sites'] = len(exposure.visitedIslands.geometries)
+
+    start = time.perf_counter()
+    if stream:
+        exposure.runExposureCalculation(job['points'], job['lines'])
+        timing['calculate'] = time.perf_counter() - start
+        timing['write'] = 0.0
+    else:
+        exposure.runExposureCalculation()
+        timing['calculate'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exposure.saveLayers(job['points'] or None, job['lines'] or None)
+        timing['write'] = time.perf_counter() - start
+
+    timing['total'] = timing['load'] + timing['calculate'] + timing['write']
+    if exposure.getMetrics().enabled:
+        timing['metrics'] = exposure.getMetrics().asDict()
+    return timing
+
+
+def runTiledJob(exposure, job):
+    """Runs a single job in the tiled mode and returns its timing dict"""
+    configureJob(exposure, job)
+
+    timing = dict(job)
+    exposure.resetMetrics()
+
+    start = time.perf_counter()
+    timing['sites'] = exposure.tiledExposure(job['points'], job['lines'])
+    timing['total'] = time.perf_counter() - start
+
+    if exposure.getMetrics().enabled:
+        timing['metrics'] = exposure.getMetrics().asDict()
+    return timing
+
+
+def main(argv = None):
+    parser = createParser()
+    args = parser.parse_args(argv)
+
+    if args.log_config is not None:
+        logging.config.fileConfig(args.log_config)
+    else:
+        logging.basicConfig(level = args.log_level.upper(), stream = sys.stderr,
+                            format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger('ExposureCli')
+
+    if args.source is None and args.manifest is None:
+        parser.error('Either a source file or a manifest is required')
+
+    try:
+        jobs = createJobs(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    for i, job in enumerate(jobs):
+        if not job['source']:
+            parser.error('Job %i has no source file' % i)
+        if (args.stream or args.tile_size is not None) and not (job['points'] or job['lines']):
+            parser.error('Job %i has no output file to stream into' % i)
+
+    #One WaveExposure per source file keeps the loaded islands and the rays for
+    #later jobs on the same file. It is released after the last job of the file.
+    lastJob = {job['source']: i for i, job in enumerate(jobs)}
+    exposures = {}
+    timings = []
+    failed = 0
+    started = time.perf_counter()
+
+    for i, job in enumerate(jobs):
+        exposure = exposures.get(job['source'])
+        if exposure is None:
+            exposure = WaveExposure()
+            exposure.setIncremental(True)
+            exposure.setMetrics(args.metrics)
+            exposure.setTileSize(args.tile_size)
+            if args.layer is not None:
+                exposure.setSourceLayer(args.layer)
+            if args.fields is not None:
+                exposure.setOutputFields([name.strip() for name in args.fields.split(',') if name.strip()])
+            exposure.setStudyArea(args.study_area)
+            if args.cache_dir is not None:
+                exposure.setCacheDir(args.cache_dir)
+            exposures[job['source']] = exposure
+
+        logger.info('Job %i/%i: %s' % (i + 1, len(jobs), job['source']))
+        try:
+            timing = runJob(exposure, job, args.stream)
+            timing['status'] = 'ok'
+        except Exception as e:
+            logger.exception('Job %i failed' % (i + 1))
+            timing = dict(job)
+            timing['status'] = 'failed'
+            timing['error'] = str(e)
+            failed += 1
+        timings.append(timing)
+
+        if lastJob[job['source']] == i:
+            del exposures[job['source']]
+
+    summary = {'jobs': timings,
+               'failed': failed,
+               'total': time.perf_counter() - started}
+
+    if args.timing == '-':
+        json.dump(summary, sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.timing, 'w') as f:
+            json.dump(summary, f, indent = 2)
+
+    return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
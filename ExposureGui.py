@@ -1,8 +1,11 @@
 import tkinter as tk
 from tkinter.filedialog import FileDialog
+from tkinter import ttk
 
 import os
 import time
+import queue
+import threading
 
 import logging
 import logging.config
@@ -12,9 +15,72 @@ import xml.etree.ElementTree as ET
 
 from WaveExposure import WaveExposure
 
+from Progress import Progress
+from Progress import CancellationToken
+from Progress import CalculationCancelled
+
 logging.config.fileConfig('logging.conf')
 
 
+class CalculationThread(threading.Thread):
+	"""
+	Runs the exposure calculation of a WaveExposure in the background. The progress is
+	reported as (kind, data) messages into a queue which is polled by the GUI:
+
+	('status', text), ('progress', (done, total, raysPerSecond, eta)), ('done', seconds),
+	('cancelled', done) and ('error', message)
+
+	The calculation can be cancelled between two islands with cancel()
+	"""
+
+	def __init__(self, exposure, messages, pointFile = None, lineFile = None):
+		threading.Thread.__init__(self, daemon = True)
+		self.logger = logging.getLogger(__name__+'.CalculationThread')
+		self.exposure = exposure
+		self.messages = messages
+		self.pointFile = pointFile
+		self.lineFile = lineFile
+		self.cancelToken = CancellationToken()
+
+	def cancel(self):
+		self.logger.info('Cancel the calculation')
+		self.cancelToken.cancel()
+
+	def run(self):
+		try:
+			self.calculate()
+		except CalculationCancelled as e:
+			self.messages.put(('cancelled', e.progress.done if e.progress else 0))
+		except Exception as e:
+			self.logger.exception('Calculation failed')
+			self.messages.put(('error', str(e)))
+
+	def reportProgress(self, progress):
+		if progress.done:
+			raysPerSecond = progress.rays / progress.elapsed if progress.elapsed > 0 else 0.0
+			eta = (progress.total - progress.done) * progress.elapsed / progress.done
+		else:
+			raysPerSecond = 0.0
+			eta = None
+		self.messages.put(('progress', (progress.done, progress.total, raysPerSecond, eta)))
+
+	def calculate(self):
+		start = time.time()
+
+		self.messages.put(('status', 'Loading islands...'))
+		self.exposure.loadIslandData()
+		visitedIslands = self.exposure.visitedIslands
+		allIslands = self.exposure.allIslandsLayer
+
+		self.reportProgress(Progress(0, len(visitedIslands.fids), 0, 0.0, None))
+		self.exposure.calcExposure(visitedIslands, allIslands, self.reportProgress, self.cancelToken)
+
+		self.messages.put(('status', 'Saving...'))
+		self.exposure.saveLayers(self.pointFile or None, self.lineFile or None)
+
+		self.messages.put(('done', time.time() - start))
+
+
 class ExposureGui(tk.Frame):
 	headerSetting = {}
 	headerSetting['ipadx'] = 10
@@ -46,6 +112,10 @@ class ExposureGui(tk.Frame):
 
 		"""
 		self.exposure = WaveExposure()
+		#Reruns with changed settings only recalculate the affected rays
+		self.exposure.setIncremental(True)
+		self.calculation = None
+		self.messages = queue.Queue()
 
 		#self.top.geometry('640x480+10+10')
 		self.master.title('Wave Exposure Calculation')
@@ -58,36 +128,103 @@ class ExposureGui(tk.Frame):
 			command=self.startCalculation)
 		self.start.grid(column=0, row=2)
 
+		self.cancel = tk.Button(self,text='Cancel',
+			command=self.cancelCalculation,
+			state=tk.DISABLED)
+		self.cancel.grid(column=1, row=2)
+
 		self.createSettingsFrame()
+		self.createProgressFrame()
 
 		self.QUIT = tk.Button(self, text='QUIT', command=self.quit)
-		self.QUIT.grid(column=1,row=2)
+		self.QUIT.grid(column=2,row=2)
 
 
-	def startCalculation(self):
-		self.logger.debug('Start Wave Exposure Calculation')
-		self.start['state'] = tk.DISABLED
+	def createProgressFrame(self):
+		self.progressVar = tk.DoubleVar()
+		self.progressVar.set(0)
 
-		self.exposure.setDegree(self.degVar.get())
-		self.exposure.setRayLength(self.lengthVar.get())
-		self.exposure.setFilter(self.filterVar.get())
+		self.statusVar = tk.StringVar()
+		self.statusVar.set('')
 
-		self.exposure.setSourceFile(self.sourceFile.get())
+		self.progressFrame = tk.Frame(self)
+		self.progressFrame.grid(column=0,row=3,columnspan=3,sticky=tk.W+tk.E)
 
-		start = time.time()
-		self.exposure.startExposureCalculation()
+		self.progressBar = ttk.Progressbar(self.progressFrame,
+			variable = self.progressVar,
+			maximum = 1,
+			length = 400)
+		self.progressBar.grid(column=0,row=0,sticky=tk.W+tk.E)
 
+		self.statusLabel = tk.Label(self.progressFrame,
+			textvariable = self.statusVar)
+		self.statusLabel.grid(column=0,row=1,**self.labelSettings)
 
-		if self.savingLines.get():
-			self.exposure.saveMultiLineLayer(self.lineFile.get())
 
-		if self.savingPoints.get():
-			self.exposure.savePointLayer(self.pointFile.get())
+	def startCalculation(self):
+		"""Starts the calculation in a CalculationThread, the window stays responsive"""
+		self.logger.debug('Start Wave Exposure Calculation')
 
-		end = time.time()
-		self.start['state'] = tk.NORMAL
+		try:
+			self.exposure.setDegree(self.degVar.get())
+			self.exposure.setRayLength(self.lengthVar.get())
+			self.exposure.setFilter(self.filterVar.get())
+			self.exposure.setSourceFile(self.sourceFile.get())
+		except (ValueError, FileNotFoundError, tk.TclError) as e:
+			self.statusVar.set('Invalid settings: %s' % e)
+			return
 
-		self.logger.debug('It took %s s' % (end-start))
+		self.start['state'] = tk.DISABLED
+		self.cancel['state'] = tk.NORMAL
+		self.progressVar.set(0)
+
+		self.calculation = CalculationThread(self.exposure, self.messages,
+			pointFile = self.pointFile.get() if self.savingPoints.get() else None,
+			lineFile = self.lineFile.get() if self.savingLines.get() else None)
+		self.calculation.start()
+		self.after(100, self.pollCalculation)
+
+
+	def cancelCalculation(self):
+		if self.calculation is not None:
+			self.cancel['state'] = tk.DISABLED
+			self.statusVar.set('Cancelling...')
+			self.calculation.cancel()
+
+
+	def pollCalculation(self):
+		"""Shows the messages of the CalculationThread, polled with after() because Tk
+		must only be used by the main thread"""
+		finished = False
+		try:
+			while True:
+				kind, data = self.messages.get_nowait()
+				if kind == 'status':
+					self.statusVar.set(data)
+				elif kind == 'progress':
+					done, total, raysPerSecond, eta = data
+					self.progressVar.set(done / total if total else 1)
+					self.statusVar.set('%i / %i islands, %.0f rays/s, %s remaining'
+						% (done, total, raysPerSecond, '%.0f s' % eta if eta is not None else '?'))
+				elif kind == 'done':
+					self.statusVar.set('Finished in %.1f s' % data)
+					self.logger.debug('It took %s s' % data)
+					finished = True
+				elif kind == 'cancelled':
+					self.statusVar.set('Cancelled after %i islands' % data)
+					finished = True
+				elif kind == 'error':
+					self.statusVar.set('Error: %s' % data)
+					finished = True
+		except queue.Empty:
+			pass
+
+		if finished or not self.calculation.is_alive() and self.messages.empty():
+			self.calculation = None
+			self.start['state'] = tk.NORMAL
+			self.cancel['state'] = tk.DISABLED
+		else:
+			self.after(100, self.pollCalculation)
 
 
 	def createSettingsFrame(self):
@@ -283,7 +420,7 @@ class ExposureGui(tk.Frame):
 	def saveFileAs(self,variable,fileName='Output.shp',title = 'Save file as...'):
 		options = {}
 		options ['defaultextension'] = '.shp'
-		options	['filetypes'] = [('Shape files', '.shp')]
+		options	['filetypes'] = [('Shape files', '.shp'), ('GeoPackages', '.gpkg'), ('CSV tables', '.csv'), ('Parquet tables', '.parquet')]
 		options	['parent'] = self
 		options	['title'] = title
 
@@ -0,0 +1,282 @@
+"""
+Exposure surfaces: the wave exposure of sample points over the water
+
+Instead of the centroids of the visited islands the exposure is calculated for every
+point of a regular grid (written as GeoTIFF) or of a point layer (written as point
+shape file). The points are cast in batches with one ray caster (and its index of the
+islands) for all points; the numpy and raster engines cast the rays of a whole batch
+at once, the shapely engine casts the points one by one.
+Points on land get no exposure (nodata in the GeoTIFF, left out in the point layer).
+
+    python ExposureSurface.py gis/Vaestervik.shp --cellsize 50 --extent 540000 6400000 560000 6420000 \
+        --tiff gis/exposure.tif --engine raster
+    python ExposureSurface.py gis/Vaestervik.shp --sample-points gis/stations.shp --points gis/stations_exposure.shp
+"""
+
+import sys
+import math
+import logging
+import argparse
+
+from ShpHelper import Layer
+from ShpHelper import Geometry
+
+from WaveExposure import WaveExposure
+
+from shapely.geometry import Point
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from shapely import contains_xy
+except ImportError:
+    try:
+        from shapely.vectorized import contains as contains_xy
+    except ImportError:
+        contains_xy = None
+
+try:
+    import gdal
+except ImportError:
+    try:
+        from osgeo import gdal
+    except ImportError:
+        gdal = None
+
+
+class ExposureSurface:
+    """
+    Calculates the exposure of sample points with the settings (length, degree, engine,
+    workers) of a WaveExposure and the layer of all islands
+    """
+
+    #Number of points cast at once
+    batchSize = 4096
+
+    #Value of the land cells of a GeoTIFF
+    noData = -1.0
+
+    def __init__(self, exposure, allIslands = None, logger = None):
+        if np is None or contains_xy is None:
+            raise ImportError('Exposure surfaces require numpy and shapely with vectorized predicates')
+
+        self.logger = logger or logging.getLogger(__name__+'.ExposureSurface')
+        self.exposure = exposure
+        self.allIslands = allIslands if allIslands is not None else exposure.allIslandsLayer
+
+        if self.allIslands is None:
+            raise TypeError('No islands loaded. Call loadIslandData of the WaveExposure or pass the islands')
+
+
+    def getExtent(self):
+        """Returns the extent (minx, miny, maxx, maxy) of all islands"""
+        bounds = [geom.bounds for geom in self.allIslands.geomColumn]
+        return (min(b[0] for b in bounds), min(b[1] for b in bounds),
+                max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+
+    def gridPoints(self, cellSize, extent = None):
+        """Returns the coordinates (xs, ys) of the cell centres of a grid over the extent
+        (default: extent of all islands) row by row from the top, the shape (rows,
+        columns) and the GDAL geo transform of the grid"""
+        minx, miny, maxx, maxy = extent if extent is not None else self.getExtent()
+        columns = max(1, int(math.ceil((maxx - minx) / cellSize)))
+        rows = max(1, int(math.ceil((maxy - miny) / cellSize)))
+
+        xs = minx + (np.arange(columns) + 0.5) * cellSize
+        ys = maxy - (np.arange(rows) + 0.5) * cellSize
+        x, y = np.meshgrid(xs, ys)
+
+        geoTransform = (minx, cellSize, 0.0, maxy, 0.0, -cellSize)
+        return x.ravel(), y.ravel(), (rows, columns), geoTransform
+
+
+    def landMask(self, xs, ys):
+        """Returns a boolean array which is True for the points inside an island"""
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        mask = np.zeros(len(xs), dtype=bool)
+
+        #Sorting by x limits every island to the points in its x range
+        order = np.argsort(xs, kind = 'stable')
+        sortedXs = xs[order]
+
+        for geom in self.allIslands.geomColumn:
+            minx, miny, maxx, maxy = geom.bounds
+            first = np.searchsorted(sortedXs, minx, side = 'left')
+            last = np.searchsorted(sortedXs, maxx, side = 'right')
+            if first == last:
+                continue
+
+            candidates = order[first:last]
+            candidates = candidates[(ys[candidates] >= miny) & (ys[candidates] <= maxy)]
+            if len(candidates):
+                mask[candidates] |= contains_xy(geom, xs[candidates], ys[candidates])
+
+        return mask
+
+
+    def iterDistances(self, xs, ys):
+        """Yields (indices, distances) of the batches of the points in the water: the
+        positions of the points in xs/ys and the distances (points x directions) of
+        their rays"""
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        land = self.landMask(xs, ys)
+        water = np.flatnonzero(~land)
+
+        self.logger.info('Calculate the exposure of %i points (%i on land)' % (len(xs), len(xs) - len(water)))
+        if self.exposure.getEngine() == 'shapely' and len(water) > self.batchSize:
+            self.logger.warning('The shapely engine casts the %i points one by one, the numpy and raster engines cast them in batches' % len(water))
+        with self.exposure.metrics.timer('calculate'):
+            position = 0
+            for batch in self.exposure.iterPointBatches(xs[water], ys[water], self.allIslands, self.batchSize):
+                yield water[position:position + len(batch)], batch
+                position += len(batch)
+
+        self.exposure.metrics.count('points', len(water))
+
+
+    def calcDistances(self, xs, ys):
+        """Returns the distances (points x directions) of the rays of the points, the
+        rows of points on land are NaN"""
+        distances = np.full((len(xs), len(self.exposure.getAngles())), np.nan)
+        for indices, batch in self.iterDistances(xs, ys):
+            distances[indices] = batch
+        return distances
+
+
+    def calcPoints(self, xs, ys):
+        """Returns the exposure (sum of the ray lengths) of the points, NaN on land.
+        Only the sums are kept, so the memory doesn't grow with the number of rays"""
+        exposures = np.full(len(xs), np.nan)
+        for indices, batch in self.iterDistances(xs, ys):
+            exposures[indices] = batch.sum(axis = 1)
+        return exposures
+
+
+    def calcGrid(self, cellSize, extent = None):
+        """Returns the exposure of the cells of a grid (rows x columns, NaN on land) and
+        the GDAL geo transform of the grid"""
+        xs, ys, shape, geoTransform = self.gridPoints(cellSize, extent)
+        self.logger.info('Exposure grid of %i x %i cells of %s m' % (shape[1], shape[0], cellSize))
+        return self.calcPoints(xs, ys).reshape(shape), geoTransform
+
+
+    def writeGeoTiff(self, filePath, grid, geoTransform):
+        """Writes an exposure grid (see calcGrid) as Float32 GeoTIFF with the srs of
+        the islands"""
+        if gdal is None:
+            raise ImportError('Writing GeoTIFFs requires GDAL')
+
+        rows, columns = grid.shape
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(filePath, columns, rows, 1, gdal.GDT_Float32, ['COMPRESS=DEFLATE', 'TILED=YES'])
+        dataset.SetGeoTransform(geoTransform)
+        srs = self.allIslands.getSRS()
+        if srs is not None:
+            dataset.SetProjection(srs.ExportToWkt())
+
+        band = dataset.GetRasterBand(1)
+        band.SetNoDataValue(self.noData)
+        band.WriteArray(np.where(np.isnan(grid), self.noData, grid).astype(np.float32))
+        band.FlushCache()
+        del dataset
+
+
+    def writePointLayer(self, filePath, points):
+        """Calculates the exposure of the points of a Layer and streams them with their
+        attributes and the field Exposure into a point shape file. Points on land are
+        left out. Returns the number of written points"""
+        fids = list(points.fids)
+        centroids = [geom.centroid if geom.geom_type != 'Point' else geom for geom in points.geomColumn]
+        xs = np.array([point.x for point in centroids], dtype=np.float64)
+        ys = np.array([point.y for point in centroids], dtype=np.float64)
+        exposures = self.calcPoints(xs, ys)
+
+        output = Layer()
+        output.setGeometryType('Point')
+        output.setSRS(points.getSRS() if points.getSRS() is not None else self.allIslands.getSRS())
+        output.setFields(dict(points.getFields()))
+        output.addField('Exposure', 'Float')
+
+        written = 0
+        with self.exposure.metrics.timer('write'), output.openWriter(filePath) as writer:
+            for row, fid in enumerate(fids):
+                if np.isnan(exposures[row]):
+                    continue
+                attributes = points.getRowAttributes(row)
+                attributes['Exposure'] = float(exposures[row])
+                writer.write(Geometry(Point(xs[row], ys[row]), fid, attributes))
+                written += 1
+
+        return written
+
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Calculates the wave exposure of a grid or a layer of points over the water')
+    parser.add_argument('source', help = 'Shape file with the island polygons')
+    parser.add_argument('--cellsize', type = float, default = 100.0, help = 'Cell size of the exposure grid in m (default: %(default)s)')
+    parser.add_argument('--extent', type = float, nargs = 4, default = None, metavar = ('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help = 'Extent of the grid (default: extent of the islands)')
+    parser.add_argument('--sample-points', default = None, help = 'Shape file with sample points instead of a grid')
+    parser.add_argument('--tiff', default = None, help = 'Output GeoTIFF of the grid')
+    parser.add_argument('--points', default = None, help = 'Output point shape file')
+    parser.add_argument('--length', type = float, default = WaveExposure.length)
+    parser.add_argument('--degree', type = float, default = WaveExposure.deg)
+    parser.add_argument('--engine', choices = WaveExposure.engines, default = WaveExposure.engine)
+    parser.add_argument('--raster-cellsize', type = float, default = WaveExposure.cellSize, help = 'Cell size of the raster engine')
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--log-level', default = 'INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = args.log_level.upper(), stream = sys.stderr,
+                        format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.tiff is None and args.points is None:
+        parser.error('An output (--tiff or --points) is required')
+    if args.sample_points is not None and args.tiff is not None:
+        parser.error('Sample points can only be written as point layer (--points)')
+
+    exposure = WaveExposure()
+    exposure.setSourceFile(args.source)
+    exposure.setRayLength(args.length)
+    exposure.setDegree(args.degree)
+    exposure.setEngine(args.engine)
+    exposure.setCellSize(args.raster_cellsize)
+    exposure.setWorkers(args.workers)
+    exposure.loadAllIslands()
+
+    surface = ExposureSurface(exposure)
+
+    if args.sample_points is not None:
+        points = Layer()
+        points.loadShp(args.sample_points)
+        surface.writePointLayer(args.points, points)
+        return 0
+
+    grid, geoTransform = surface.calcGrid(args.cellsize, args.extent)
+    if args.tiff is not None:
+        surface.writeGeoTiff(args.tiff, grid, geoTransform)
+
+    if args.points is not None:
+        xs, ys, shape, geoTransform = surface.gridPoints(args.cellsize, args.extent)
+        points = Layer()
+        points.setSRS(exposure.allIslandsLayer.getSRS())
+        points.setGeometryType('Point')
+        points.addField('Exposure', 'Float')
+        values = grid.ravel()
+        with points.openWriter(args.points) as writer:
+            for i in np.flatnonzero(~np.isnan(values)):
+                writer.write(Geometry(Point(xs[i], ys[i]), int(i), {'Exposure': float(values[i])}))
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Instrumentation of the exposure calculation
+
+Metrics collects counters (e.g. polygons tested, intersections computed, rays per
+island) and timers (load, calculate and write stage durations). NullMetrics offers the
+same interface without doing anything and is used when the instrumentation is disabled.
+The hot loops only count in local variables and report them once per site, so the
+overhead is negligible in both cases.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Counters and timers of a calculation"""
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+
+
+    def count(self, name, value = 1):
+        """Adds value to the counter name"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def addCounts(self, counts):
+        """Adds all values of a dict of counters"""
+        for name, value in counts.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def addTime(self, name, seconds):
+        """Adds seconds to the timer name"""
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+
+    @contextmanager
+    def timer(self, name):
+        """Context manager adding the wall time of the block to the timer name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start)
+
+
+    def asDict(self):
+        """Returns the counters, timers and derived rates as dict"""
+        derived = {}
+        islands = self.counters.get('islands', 0)
+        if islands:
+            derived['raysPerIsland'] = self.counters.get('rays', 0) / islands
+        if self.timers.get('calculate'):
+            derived['raysPerSecond'] = self.counters.get('rays', 0) / self.timers['calculate']
+        return {'counters': dict(self.counters), 'timers': dict(self.timers), 'derived': derived}
+
+
+    def dumpJson(self, filePath):
+        """Writes the metrics as JSON file"""
+        with open(filePath, 'w') as f:
+            json.dump(self.asDict(), f, indent = 2)
+
+
+    def __repr__(self):
+        return '<Metrics counters: %s, timers: %s>' % (self.counters, self.timers)
+
+
+
+class NullMetrics(Metrics):
+    """Metrics which ignore everything (instrumentation disabled)"""
+
+    enabled = False
+
+    def count(self, name, value = 1):
+        pass
+
+    def addCounts(self, counts):
+        pass
+
+    def addTime(self, name, seconds):
+        pass
+
+    @contextmanager
+    def timer(self, name):
+        yield
@@ -0,0 +1,128 @@
+"""
+Progress reporting and cooperative cancellation of the exposure calculation
+
+An observer passed to WaveExposure.calcExposure (or streamExposure/startExposureCalculation)
+is called after every island with a Progress tuple and, every batchSize islands, with
+batchDone. A CancellationToken is checked between two islands; once cancelled the
+calculation stops with a CalculationCancelled exception and the results of the finished
+islands are kept. Observers run in the thread of the calculation, so they can checkpoint
+or throttle it, and the token can be cancelled from any thread.
+"""
+
+import time
+import threading
+from collections import namedtuple
+
+
+#done/total islands (total None if unknown, e.g. in the tiled mode), rays of the finished islands, seconds since the start and the fid of the last island
+Progress = namedtuple('Progress', ('done', 'total', 'rays', 'elapsed', 'fid'))
+
+
+class CalculationCancelled(Exception):
+    """Raised by a calculation which was cancelled with its CancellationToken"""
+
+    def __init__(self, progress = None):
+        Exception.__init__(self, 'Calculation cancelled after %i islands' % progress.done if progress else 'Calculation cancelled')
+        self.progress = progress
+
+
+
+class CancellationToken:
+    """Thread-safe flag to cancel a running calculation"""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def isCancelled(self):
+        return self.event.is_set()
+
+    def raiseIfCancelled(self, progress = None):
+        if self.event.is_set():
+            raise CalculationCancelled(progress)
+
+
+
+class ProgressObserver:
+    """Base class of the observers of a calculation. Subclasses override the methods
+    they are interested in"""
+
+    #Number of islands between two calls of batchDone (None = never)
+    batchSize = None
+
+    def islandDone(self, progress):
+        """Called after every island"""
+        pass
+
+    def batchDone(self, progress):
+        """Called every batchSize islands and after the last island"""
+        pass
+
+
+
+class CallbackObserver(ProgressObserver):
+    """Observer calling a function with the Progress of every island"""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def islandDone(self, progress):
+        self.callback(progress)
+
+
+
+def asObserver(observer):
+    """Returns a ProgressObserver for an observer, a plain callable or None"""
+    if observer is None or isinstance(observer, ProgressObserver):
+        return observer
+    if callable(observer):
+        return CallbackObserver(observer)
+    raise TypeError('%s is neither a ProgressObserver nor callable' % type(observer))
+
+
+
+class ProgressTracker:
+    """Counts the finished islands of a calculation, reports them to the observer and
+    checks the cancellation token"""
+
+    def __init__(self, observer = None, cancelToken = None, total = None):
+        self.observer = asObserver(observer)
+        self.cancelToken = cancelToken
+        self.total = total
+        self.done = 0
+        self.rays = 0
+        self.fid = None
+        self.reported = 0
+        self.start = time.perf_counter()
+
+    def progress(self):
+        return Progress(self.done, self.total, self.rays, time.perf_counter() - self.start, self.fid)
+
+    def check(self):
+        """Raises CalculationCancelled if the calculation was cancelled"""
+        if self.cancelToken is not None:
+            self.cancelToken.raiseIfCancelled(self.progress())
+
+    def islandDone(self, fid, rays):
+        self.done += 1
+        self.rays += rays
+        self.fid = fid
+
+        observer = self.observer
+        if observer is not None:
+            progress = self.progress()
+            observer.islandDone(progress)
+            if observer.batchSize and self.done % observer.batchSize == 0:
+                observer.batchDone(progress)
+                self.reported = self.done
+
+        self.check()
+
+    def finish(self):
+        """Reports the last (incomplete) batch"""
+        observer = self.observer
+        if observer is not None and observer.batchSize and self.reported != self.done:
+            observer.batchDone(self.progress())
+            self.reported = self.done
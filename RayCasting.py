@@ -0,0 +1,606 @@
+"""
+Ray casting engines used by WaveExposure.calcExposure
+
+Every engine is created for one layer of obstacles (all islands) and a ray length
+and offers castRays(fid, centroid, angles). It returns for every angle (in degree)
+a tuple (distance, (x, y)) with the length of the unobstructed ray and its end point,
+which is either the closest intersection with another island or the end of the ray.
+"""
+
+import math
+import bisect
+import logging
+import functools
+
+from shapely.geometry import Point
+from shapely.geometry import LineString
+from shapely.geometry import box
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def unitVector(deg):
+    """Returns the unit vector (cos, sin) of a direction in degree. The angle is reduced
+    to a quadrant first, so the axis directions are exact (e.g. (0.0, 1.0) for 90°)
+    and directions differing by 90° are exact rotations of each other"""
+    quadrant, rest = divmod(deg, 90.0)
+    c = math.cos(math.radians(rest))
+    s = math.sin(math.radians(rest))
+    quadrant = int(quadrant) % 4
+    if quadrant == 0:
+        return c, s
+    elif quadrant == 1:
+        return -s, c
+    elif quadrant == 2:
+        return -c, -s
+    else:
+        return s, -c
+
+
+@functools.lru_cache(maxsize = 64)
+def directionTable(angles):
+    """Returns the unit vectors of a tuple of angles (in degree). The table is computed
+    once and shared by all sites and ray casters using the same angles"""
+    return tuple(unitVector(angle) for angle in angles)
+
+
+def directionAngles(deg):
+    """Returns the directions (in degree) from 0 up to 360 (exclusive) with the spacing deg.
+    The angles are computed as multiples of deg instead of accumulating deg, so they
+    don't depend on the rounding of repeated additions"""
+    if deg <= 0:
+        raise ValueError('The degree between the rays has to be positive')
+    angles = []
+    i = 0
+    while i * deg < 360:
+        angles.append(i * deg)
+        i += 1
+    return tuple(angles)
+
+
+
+class RayCaster:
+    """Base class of the ray casters which counts the work done in stats"""
+
+    def __init__(self, length):
+        self.length = length
+        self.stats = {}
+        self.offsets = {}
+
+
+    def getOffsets(self, angles):
+        """Returns the ray template of the angles: the vectors (dx, dy) from a site to the
+        end points of its rays. It is computed once per set of angles and translated
+        to the centroid of every site"""
+        angles = tuple(angles)
+        offsets = self.offsets.get(angles)
+        if offsets is None:
+            if len(self.offsets) >= 64:
+                self.offsets.clear()
+            length = self.length
+            offsets = self.offsets[angles] = tuple((ux * length, uy * length) for ux, uy in directionTable(angles))
+        return offsets
+
+
+    def addStats(self, **counts):
+        for name, value in counts.items():
+            self.stats[name] = self.stats.get(name, 0) + value
+
+
+    def castPoints(self, xs, ys, angles):
+        """Returns the distances (points x angles) of the rays of sample points which
+        don't belong to an island (e.g. a grid over the water). Engines which can cast
+        many points at once override it"""
+        distances = [[distance for distance, endPoint in self.castRays(None, Point(x, y), angles)]
+                     for x, y in zip(xs, ys)]
+        return np.array(distances, dtype=np.float64).reshape(len(distances), len(angles)) if np is not None else distances
+
+
+    def popStats(self):
+        """Returns the counters since the last call and resets them"""
+        stats = self.stats
+        self.stats = {}
+        return stats
+
+
+
+def boxDistance(x, y, bounds):
+    """Returns the distance of the point (x, y) to the box (minx, miny, maxx, maxy)"""
+    dx = max(bounds[0] - x, 0.0, x - bounds[2])
+    dy = max(bounds[1] - y, 0.0, y - bounds[3])
+    return math.hypot(dx, dy)
+
+
+def boxSector(x, y, bounds):
+    """Returns the sector (start, width) in radians (start in [0, 2pi)) of the directions
+    from the point (x, y) to the box (minx, miny, maxx, maxy), None if the point is inside"""
+    minx, miny, maxx, maxy = bounds
+    if minx <= x <= maxx and miny <= y <= maxy:
+        return None
+
+    centre = math.atan2((miny + maxy) / 2 - y, (minx + maxx) / 2 - x)
+    low = high = 0.0
+    for cornerx, cornery in ((minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy)):
+        delta = math.atan2(cornery - y, cornerx - x) - centre
+        delta = (delta + math.pi) % (2 * math.pi) - math.pi
+        low = min(low, delta)
+        high = max(high, delta)
+
+    return (centre + low) % (2 * math.pi), high - low
+
+
+def rayBoxEntry(x, y, dx, dy, bounds):
+    """Returns the parameter t (0 = start, 1 = end) at which the segment from (x, y)
+    to (x + dx, y + dy) enters the box (minx, miny, maxx, maxy) or None if it misses it"""
+    tmin = 0.0
+    tmax = 1.0
+    for origin, delta, low, high in ((x, dx, bounds[0], bounds[2]), (y, dy, bounds[1], bounds[3])):
+        if delta == 0:
+            if origin < low or origin > high:
+                return None
+        else:
+            t0 = (low - origin) / delta
+            t1 = (high - origin) / delta
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > tmin:
+                tmin = t0
+            if t1 < tmax:
+                tmax = t1
+            if tmin > tmax:
+                return None
+    return tmin
+
+
+
+class ShapelyRayCaster(RayCaster):
+    """Casts every ray as shapely LineString and intersects it with the
+    boundaries of the candidate islands of the spatial index.
+
+    The candidates of a ray are tested nearest first, ordered by the distance along
+    the ray at which it enters their bounding box. No island can be hit before that
+    distance, so the search stops as soon as the closest hit found is closer than
+    the bounding box of the next candidate.
+
+    The candidates are selected once per site: only islands whose bounding box
+    intersects the circle with the ray length around the centroid can block a ray,
+    all others are culled before the rays are cast. The remaining candidates are
+    assigned to the rays within the sector of directions their bounding box covers.
+
+    If the layer has simplified boundaries (Layer.simplifyBoundaries) the rays are
+    intersected with them instead. The original boundary lies within the band of the
+    tolerance around the simplified one, so the true hit is in the first section of
+    the ray inside the band. The simplified hit is used if it lies in this section
+    and the section is shorter than maxErrorFactor * tolerance, which bounds the error
+    of the distance. Otherwise (near misses, grazing rays, hits near the end of the
+    ray) the hit is refined with the full boundary. Rays starting inside the band
+    (a site within the tolerance of another coast) are always refined: the section
+    begins at the site, so the original boundary needn't cross the ray in it at all."""
+
+    #Maximum error of a ray as multiple of the simplification tolerance
+    maxErrorFactor = 4.0
+
+    def __init__(self, allIslands, length, logger = None):
+        RayCaster.__init__(self, length)
+        self.logger = logger or logging.getLogger(__name__+'.ShapelyRayCaster')
+        self.allIslands = allIslands
+        #Bounding boxes of the islands by fid, filled on first use
+        self.bounds = {}
+
+
+    def getBounds(self, fid, geom):
+        bounds = self.bounds.get(fid)
+        if bounds is None:
+            bounds = self.bounds[fid] = geom.bounds
+        return bounds
+
+
+    def siteCandidates(self, fid, centroid):
+        """Returns the (fid, geometry, bounds) of all islands (except the site) whose
+        bounding box is within the ray length of the centroid"""
+        x = centroid.x
+        y = centroid.y
+        length = self.length
+        geomColumn = self.allIslands.geomColumn
+        rows = self.allIslands.rows
+
+        candidates = []
+        for ifid in self.allIslands.queryFids(box(x - length, y - length, x + length, y + length)):
+            if ifid != fid:
+                ipoly = geomColumn[rows[ifid]]
+                bounds = self.getBounds(ifid, ipoly)
+                if boxDistance(x, y, bounds) <= length:
+                    candidates.append((ifid, ipoly, bounds))
+        return candidates
+
+
+    def assignCandidates(self, centroid, offsets, candidates):
+        """Returns for every ray (dx, dy) the list of candidates whose bounding box lies
+        in the direction of the ray"""
+        fullCircle = 2 * math.pi
+        #Small margin, the exact test is rayBoxEntry
+        margin = 1e-9
+
+        rayAngles = [math.atan2(dy, dx) % fullCircle for dx, dy in offsets]
+        order = sorted(range(len(offsets)), key = rayAngles.__getitem__)
+        sortedAngles = [rayAngles[i] for i in order]
+
+        assigned = [[] for offset in offsets]
+        for candidate in candidates:
+            sector = boxSector(centroid.x, centroid.y, candidate[2])
+            if sector is None:
+                for rays in assigned:
+                    rays.append(candidate)
+                continue
+
+            start, width = sector
+            start -= margin
+            end = start + width + 2 * margin
+            ranges = [(start, end)]
+            if start < 0:
+                ranges = [(0.0, end), (start + fullCircle, fullCircle)]
+            elif end >= fullCircle:
+                ranges = [(start, fullCircle), (0.0, end - fullCircle)]
+
+            for low, high in ranges:
+                for i in range(bisect.bisect_left(sortedAngles, low), bisect.bisect_right(sortedAngles, high)):
+                    assigned[order[i]].append(candidate)
+
+        return assigned
+
+
+    def nearestHit(self, centroid, ray, boundary):
+        """Returns (distance, point) of the intersection of the ray and the boundary
+        closest to the centroid or None"""
+        intersections = ray.intersection(boundary)
+        closest = None
+
+        if intersections.geom_type == 'MultiPoint':
+            for poi in intersections.geoms:
+                tempDistance = centroid.distance(poi)
+                if closest is None or tempDistance < closest[0]:
+                    closest = (tempDistance, poi)
+        elif intersections.geom_type == 'Point':
+            closest = (centroid.distance(intersections), intersections)
+
+        return closest
+
+
+    def firstBandSection(self, centroid, ray, band):
+        """Returns the distances (start, end) of the first section of the ray inside
+        the band or None"""
+        inside = ray.intersection(band)
+        if inside.is_empty:
+            return None
+
+        parts = inside.geoms if hasattr(inside, 'geoms') else [inside]
+        sections = []
+        for part in parts:
+            distances = [math.hypot(x - centroid.x, y - centroid.y) for x, y in part.coords]
+            if distances:
+                sections.append((min(distances), max(distances)))
+        return min(sections) if sections else None
+
+
+    def castRays(self, fid, centroid, angles):
+        results = []
+        tolerance = self.allIslands.simplifyTolerance
+        maxError = self.maxErrorFactor * tolerance if tolerance is not None else None
+        #Counted locally and added to the stats once per site
+        candidates = 0
+        tested = 0
+        intersected = 0
+        refined = 0
+
+        offsets = self.getOffsets(angles)
+        siteCandidates = self.siteCandidates(fid, centroid)
+        culled = len(self.allIslands.fids) - len(siteCandidates) - (1 if fid in self.allIslands.rows else 0)
+
+        for (offsetx, offsety), rayCandidates in zip(offsets, self.assignCandidates(centroid, offsets, siteCandidates)):
+            #Translating the ray template to the centroid
+            endPointx=centroid.x+offsetx
+            endPointy=centroid.y+offsety
+
+            rayLong = LineString([(centroid.x,centroid.y),(endPointx,endPointy)])
+
+            distance = self.length
+
+            closestIntersectingPoint = None
+
+            #Only islands whose bounding box intersects the ray are candidates, ordered
+            #by the distance at which the ray enters their bounding box
+            ordered = []
+            for ifid, ipoly, bounds in rayCandidates:
+                entry = rayBoxEntry(centroid.x, centroid.y, offsetx, offsety, bounds)
+                if entry is not None:
+                    ordered.append((entry * self.length, ifid, ipoly))
+            ordered.sort(key = lambda candidate: candidate[0])
+            candidates += len(ordered)
+
+            for lowerBound, ifid, ipoly in ordered:
+                #All remaining islands are farther away than the closest hit
+                if lowerBound >= distance:
+                    break
+
+                tested += 1
+                if tolerance is None:
+                    #checks if the previous created ray intersects with the boundary of an island
+                    if not rayLong.intersects(ipoly):
+                        continue
+                    hit = self.nearestHit(centroid, rayLong, ipoly.boundary)
+                else:
+                    boundary, band = self.allIslands.getSimplifiedBoundary(ifid)
+                    section = self.firstBandSection(centroid, rayLong, band)
+                    if section is None:
+                        #The ray doesn't come close to the original boundary
+                        continue
+
+                    hit = self.nearestHit(centroid, rayLong, boundary)
+                    if hit is None or section[0] <= 0 or not section[0] <= hit[0] <= section[1] \
+                            or section[1] - section[0] > maxError or section[1] >= self.length:
+                        refined += 1
+                        hit = self.nearestHit(centroid, rayLong, ipoly.boundary)
+
+                if hit is not None:
+                    intersected += 1
+                    if hit[0] < distance:
+                        distance, closestIntersectingPoint = hit
+
+            if distance != self.length:
+                results.append((distance, (closestIntersectingPoint.x, closestIntersectingPoint.y)))
+            else:
+                results.append((distance, (endPointx, endPointy)))
+
+        self.addStats(raysCast = len(results), siteCandidates = len(siteCandidates), culled = culled,
+                      candidates = candidates, polygonsTested = tested, intersections = intersected, refined = refined)
+        return results
+
+
+
+def iterBoundaryRings(geom):
+    """Yields the coordinate sequences of all rings/lines forming the boundary
+    of a shapely geometry (also for Multi-Geometries)"""
+    if hasattr(geom, 'geoms'):
+        for part in geom.geoms:
+            yield from iterBoundaryRings(part)
+    elif geom.geom_type == 'Polygon':
+        yield geom.exterior.coords
+        for interior in geom.interiors:
+            yield interior.coords
+    elif geom.geom_type in ('LineString', 'LinearRing'):
+        yield geom.coords
+
+
+
+class EdgeArrays:
+    """
+    All boundary segments of the geometries of a layer flattened into contiguous
+    NumPy arrays (start and end coordinates and the position of the owning geometry)
+    """
+
+    def __init__(self, layer, logger = None):
+        if np is None:
+            raise ImportError('The numpy engine requires the package numpy')
+
+        self.logger = logger or logging.getLogger(__name__+'.EdgeArrays')
+        self.fids = list(layer.geometries.keys())
+        self.positions = {fid: i for i, fid in enumerate(self.fids)}
+
+        starts = []
+        ends = []
+        owners = []
+        for i, fid in enumerate(self.fids):
+            for ring in iterBoundaryRings(layer.geometries[fid].getGeometry()):
+                coords = np.asarray(ring, dtype=np.float64)[:, :2]
+                if len(coords) < 2:
+                    continue
+                starts.append(coords[:-1])
+                ends.append(coords[1:])
+                owners.append(np.full(len(coords) - 1, i, dtype=np.int64))
+
+        if starts:
+            starts = np.concatenate(starts)
+            ends = np.concatenate(ends)
+            self.owner = np.concatenate(owners)
+        else:
+            starts = ends = np.empty((0, 2), dtype=np.float64)
+            self.owner = np.empty(0, dtype=np.int64)
+
+        self.x0 = np.ascontiguousarray(starts[:, 0])
+        self.y0 = np.ascontiguousarray(starts[:, 1])
+        self.x1 = np.ascontiguousarray(ends[:, 0])
+        self.y1 = np.ascontiguousarray(ends[:, 1])
+
+        self.minx = np.minimum(self.x0, self.x1)
+        self.maxx = np.maximum(self.x0, self.x1)
+        self.miny = np.minimum(self.y0, self.y1)
+        self.maxy = np.maximum(self.y0, self.y1)
+
+        self.logger.debug('Flattened %i geometries into %i segments' % (len(self.fids), len(self.owner)))
+
+
+    def __len__(self):
+        return len(self.owner)
+
+
+    def selectSegments(self, x, y, radius, excludeFid = None):
+        """Returns the indices of all segments whose bounding box intersects the circle
+        around (x, y) with the given radius, optionally without the segments of one fid"""
+        mask = (self.maxx >= x - radius) & (self.minx <= x + radius) \
+            & (self.maxy >= y - radius) & (self.miny <= y + radius)
+
+        #Segments in the corners of the square are culled by the distance of their box
+        dx = np.maximum(np.maximum(self.minx - x, x - self.maxx), 0.0)
+        dy = np.maximum(np.maximum(self.miny - y, y - self.maxy), 0.0)
+        mask &= dx * dx + dy * dy <= radius * radius
+
+        if excludeFid in self.positions:
+            mask &= self.owner != self.positions[excludeFid]
+
+        return np.flatnonzero(mask)
+
+
+    def selectSegmentsBox(self, minx, miny, maxx, maxy, radius):
+        """Returns the indices of all segments whose bounding box is within the radius of
+        the box (minx, miny, maxx, maxy)"""
+        dx = np.maximum(np.maximum(self.minx - maxx, minx - self.maxx), 0.0)
+        dy = np.maximum(np.maximum(self.miny - maxy, miny - self.maxy), 0.0)
+        return np.flatnonzero(dx * dx + dy * dy <= radius * radius)
+
+
+
+class NumpyRayCaster(RayCaster):
+    """
+    Computes the nearest ray-segment intersection for all directions of a site
+    in one vectorized pass over the boundary segments of the EdgeArrays
+    """
+
+    #Maximum number of ray-segment pairs evaluated at once
+    chunkSize = 1 << 20
+
+    #Size of the cells grouping sample points in castPoints as fraction of the ray length
+    pointCellFactor = 0.25
+
+    def __init__(self, allIslands, length, edges = None, logger = None):
+        RayCaster.__init__(self, length)
+        self.logger = logger or logging.getLogger(__name__+'.NumpyRayCaster')
+        self.edges = edges if edges is not None else EdgeArrays(allIslands)
+
+
+    def castRays(self, fid, centroid, angles):
+        cx = centroid.x
+        cy = centroid.y
+        angles = tuple(angles)
+
+        #Ray vectors (rays x 1) to broadcast against the segments. The shared ray
+        #template gives exactly the same end points as the shapely engine
+        offsets = np.array(self.getOffsets(angles), dtype=np.float64).reshape(-1, 2)
+        dx = offsets[:, 0:1]
+        dy = offsets[:, 1:2]
+
+        #Parameter of the closest hit along each ray (0 = centroid, 1 = end of the ray)
+        best = np.full(len(angles), np.inf)
+
+        segments = self.edges.selectSegments(cx, cy, self.length, fid)
+        step = max(1, self.chunkSize // max(1, len(angles)))
+
+        for start in range(0, len(segments), step):
+            idx = segments[start:start + step]
+            ex = self.edges.x1[idx] - self.edges.x0[idx]
+            ey = self.edges.y1[idx] - self.edges.y0[idx]
+            wx = self.edges.x0[idx] - cx
+            wy = self.edges.y0[idx] - cy
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                denom = dx * ey - dy * ex
+                t = (wx * ey - wy * ex) / denom
+                u = (wx * dy - wy * dx) / denom
+
+            valid = (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+            t = np.where(valid, t, np.inf)
+            best = np.minimum(best, t.min(axis = 1))
+
+        with np.errstate(invalid='ignore'):
+            hitx = cx + best * dx[:, 0]
+            hity = cy + best * dy[:, 0]
+
+        results = []
+        for i in range(len(angles)):
+            if np.isfinite(best[i]):
+                distance = math.hypot(hitx[i] - cx, hity[i] - cy)
+                if distance < self.length:
+                    results.append((distance, (float(hitx[i]), float(hity[i]))))
+                    continue
+
+            results.append((self.length, (cx + float(dx[i, 0]), cy + float(dy[i, 0]))))
+
+        self.addStats(raysCast = len(angles), culledSegments = len(self.edges) - len(segments),
+                      segmentsTested = len(segments) * len(angles))
+        return results
+
+
+    def castPoints(self, xs, ys, angles):
+        """Returns the distances (points x angles) of the rays of sample points. The
+        points are grouped into cells of the ray length and the rays of a group
+        (points x directions) are broadcast against the segments within the ray length
+        of the group at once. The distances are the same as with castRays up to the
+        rounding"""
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        angles = tuple(angles)
+        length = self.length
+        distances = np.full((len(xs), len(angles)), float(length))
+        if not len(xs):
+            return distances
+
+        offsets = np.array(self.getOffsets(angles), dtype=np.float64).reshape(-1, 2)
+        cellSize = length * self.pointCellFactor
+        cells = np.stack([np.floor(xs / cellSize), np.floor(ys / cellSize)], axis = 1)
+        cellIds = np.unique(cells, axis = 0, return_inverse = True)[1].ravel()
+        order = np.argsort(cellIds, kind = 'stable')
+        groups = np.split(order, np.flatnonzero(np.diff(cellIds[order])) + 1)
+
+        #At least a few segments per chunk of rays x segments
+        pointStep = max(1, self.chunkSize // (16 * len(angles)))
+        culled = 0
+        tested = 0
+
+        for group in groups:
+            segments = self.edges.selectSegmentsBox(xs[group].min(), ys[group].min(), xs[group].max(), ys[group].max(), length)
+            culled += (len(self.edges) - len(segments)) * len(group)
+            tested += len(segments) * len(group) * len(angles)
+            for start in range(0, len(group), pointStep):
+                points = group[start:start + pointStep]
+                distances[points] = self.castPointGroup(xs[points], ys[points], offsets, segments)
+
+        self.addStats(raysCast = len(xs) * len(angles), culledSegments = culled, segmentsTested = tested)
+        return distances
+
+
+    def castPointGroup(self, xs, ys, offsets, segments):
+        """Returns the distances (points x directions) of the rays of the points against
+        the given segments. The terms depending only on the direction and the segment
+        (or only on the point and the segment) are computed once for the group, the
+        coordinates are relative to the first point to keep the precision"""
+        ox = xs[0]
+        oy = ys[0]
+        px = (xs - ox)[:, None]
+        py = (ys - oy)[:, None]
+        #Directions as row vectors (1 x directions) and column vectors (directions x 1)
+        dx = offsets[:, 0]
+        dy = offsets[:, 1]
+        dxc = dx[:, None]
+        dyc = dy[:, None]
+        #Part of the segment parameter depending only on the point and the direction (points x directions)
+        n = px * dy - py * dx
+
+        best = np.full((len(xs), len(offsets)), np.inf)
+        step = max(1, self.chunkSize // (len(xs) * len(offsets)))
+
+        for start in range(0, len(segments), step):
+            idx = segments[start:start + step]
+            x0 = self.edges.x0[idx] - ox
+            y0 = self.edges.y0[idx] - oy
+            ex = self.edges.x1[idx] - self.edges.x0[idx]
+            ey = self.edges.y1[idx] - self.edges.y0[idx]
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                #(directions x segments)
+                denom = dxc * ey - dyc * ex
+                m = x0 * dyc - y0 * dxc
+                #(points x 1 x segments)
+                tNum = ((x0 * ey - y0 * ex) - (px * ey - py * ex))[:, None, :]
+                t = tNum / denom
+                u = (m - n[:, :, None]) / denom
+
+            valid = (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+            t = np.where(valid, t, np.inf)
+            best = np.minimum(best, t.min(axis = 2))
+
+        #The length of the ray to the hit like castRays
+        with np.errstate(invalid='ignore'):
+            lengths = np.hypot(best * dx, best * dy)
+        return np.where(np.isfinite(best) & (lengths < self.length), lengths, float(self.length))
@@ -1,13 +1,35 @@
+from array import array
+from collections.abc import Mapping
+from collections.abc import MutableSequence
 from enum import Enum
+import hashlib
 import logging
+import math
 import os
+import re
 
 import ogr
 import osr
 
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
 from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
 from shapely import wkb
 
+try:
+    from shapely import from_wkb
+    from shapely import to_wkb
+except ImportError:
+    from_wkb = None
+    to_wkb = None
+
+from TableWriter import TableWriters
+from TableWriter import openTableWriter
+
 def frange(start, stop, step):
     i = start
     while i < stop:
@@ -23,6 +45,74 @@ def checkProjUnit(srs):
 
 
 
+def geometriesFromWkb(parts):
+    """Returns the shapely geometries of a list of WKB, decoded at once with shapely 2"""
+    if from_wkb is not None:
+        return list(from_wkb(parts))
+    return [wkb.loads(part) for part in parts]
+
+
+
+def geometriesToWkb(geoms):
+    """Returns the WKB of a list of shapely geometries or WKB. WKB is kept as is, the
+    geometries are encoded at once with shapely 2"""
+    parts = list(geoms)
+    positions = [i for i, geom in enumerate(parts) if not isinstance(geom, bytes)]
+    if positions:
+        encode = [parts[i] for i in positions]
+        encoded = to_wkb(encode) if to_wkb is not None else [wkb.dumps(geom) for geom in encode]
+        for i, part in zip(positions, encoded):
+            parts[i] = part
+    return parts
+
+
+
+def packWkb(geoms):
+    """Packs the WKB of a list of shapely geometries (or a GeometryColumn, whose
+    undecoded rows are copied as they are) into one bytes buffer. Returns the buffer
+    and an array with the offsets of the geometries in it (one entry more than
+    geometries)"""
+    parts = geoms.wkbList() if isinstance(geoms, GeometryColumn) else geometriesToWkb(geoms)
+    offsets = array('Q', [0])
+    for part in parts:
+        offsets.append(offsets[-1] + len(part))
+
+    return b''.join(parts), offsets
+
+
+
+def unpackWkb(buffer, offsets, decode = True):
+    """Returns the list of shapely geometries of a buffer created by packWkb (decoded at
+    once) or with decode False the list of their WKB for a GeometryColumn"""
+    view = memoryview(buffer)
+    parts = [bytes(view[offsets[i]:offsets[i+1]]) for i in range(len(offsets) - 1)]
+    return geometriesFromWkb(parts) if decode else parts
+
+
+
+def openSource(path):
+    """Opens any vector data source readable by OGR (shape file, GeoPackage,
+    FlatGeobuf, ...) read only. Raises a ValueError if OGR can't open it"""
+    source = ogr.Open(path, 0)
+    if source is None:
+        raise ValueError('%s is no vector data source readable by OGR' % path)
+    return source
+
+
+
+def getSourceLayer(source, layerID = 0):
+    """Returns the layer of a data source by index or name"""
+    if isinstance(layerID, str):
+        layer = source.GetLayerByName(layerID)
+    else:
+        layer = source.GetLayer(layerID)
+
+    if layer is None:
+        raise ValueError('The data source has no layer %s' % layerID)
+    return layer
+
+
+
 def getEPSG(srs):
     """Returns the EPSG-Code of the given srs from an OGR Spatial Reference"""
     return srs.GetAttrValue("AUTHORITY", 1)
@@ -78,7 +168,15 @@ def getShpGeomType(shp,layerID):
 
 
 def getLayerGeomType(layer):
-    return GeomTypesOgr(layer.GetGeomType())
+    """Returns the GeomTypesOgr of an ogr layer. Z and M coordinates are dropped and
+    curve types are mapped to their linear types (e.g. MultiSurface to MultiPolygon),
+    the features are converted on reading (see Layer.iterShp). Raises a ValueError for
+    other types (e.g. TIN)"""
+    geomType = ogr.GT_GetLinear(ogr.GT_Flatten(layer.GetGeomType()))
+    try:
+        return GeomTypesOgr(geomType)
+    except ValueError:
+        raise ValueError('Geometry type %s of layer %s is not supported' % (ogr.GeometryTypeToName(layer.GetGeomType()), layer.GetName()))
 
 
 def getFieldValueById(feature,id):
@@ -105,6 +203,296 @@ def getFieldValueById(feature,id):
         raise TypeError('Type %s not supported. Field name: %s. Type: %s' %(ftype,name,ogr.GetFieldTypeName(ftype)))
 
 
+class FieldDecoder:
+    """
+    Reads the attributes of the features of an ogr layer. The field indices and typed
+    getters are resolved once from the layer definition instead of looking up the
+    field definition per feature and field like getFieldValueById. Values are the
+    same as with getFieldValueById (a field named FID holds the FID of the feature),
+    except for NULL fields which are None instead of 0 or '' like in OGR's filters
+    """
+
+    #Names of the typed getters of ogr.Feature
+    getterNames = {ogr.OFTInteger: 'GetFieldAsInteger', ogr.OFTInteger64: 'GetFieldAsInteger64',
+                   ogr.OFTReal: 'GetFieldAsDouble', ogr.OFTString: 'GetFieldAsString',
+                   ogr.OFTDateTime: 'GetFieldAsDateTime'}
+
+    def __init__(self, layerDefn, fields):
+        self.names = list(fields.keys())
+        self.getters = []
+        self.isSet = getattr(ogr.Feature, 'IsFieldSetAndNotNull', None) or ogr.Feature.IsFieldSet
+        for name, fieldType in fields.items():
+            if name == 'FID':
+                self.getters.append((name, None, None, False))
+                continue
+            try:
+                getter = getattr(ogr.Feature, self.getterNames[fieldType])
+            except KeyError:
+                raise TypeError('Type %s not supported. Field name: %s. Type: %s' % (fieldType, name, ogr.GetFieldTypeName(fieldType)))
+            #The getters return 0 or '' for NULL, a NULL date is a list of zeros
+            self.getters.append((name, layerDefn.GetFieldIndex(name), getter, fieldType == ogr.OFTDateTime))
+
+
+    def decode(self, feature):
+        """Returns the attribute dict of a feature"""
+        attributes = {}
+        isSet = self.isSet
+        for name, index, getter, checkAll in self.getters:
+            if getter is None:
+                attributes[name] = feature.GetFID()
+                continue
+            value = getter(feature, index)
+            #Only empty values are checked for NULL
+            if (checkAll or not value) and not isSet(feature, index):
+                value = None
+            attributes[name] = value
+        return attributes
+
+
+
+class _FilterParser:
+    """
+    Recursive descent parser for the subset of the OGR SQL WHERE syntax used as
+    attribute filter: comparisons (=, !=, <>, <, <=, >, >=), IN (...), IS [NOT] NULL,
+    AND, OR, NOT and parentheses. Field names are case insensitive like in shape files.
+    If the fields of the layer are given, other names (e.g. misspelled fields or the
+    FID of OGR) raise a ValueError. The predicates return True, False or None (unknown)
+    like SQL: a comparison with a NULL field is unknown and NOT keeps it unknown.
+    """
+
+    tokenPattern = re.compile(r"""\s*(?:(?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)|'(?P<string>(?:[^']|'')*)'|"(?P<quoted>[^"]+)"|(?P<op><>|!=|<=|>=|=|<|>|\(|\)|,)|(?P<name>[A-Za-z_][A-Za-z0-9_]*))""")
+
+    def __init__(self,expression,fields = None):
+        self.expression = expression
+        self.fieldNames = {name.lower() for name in fields} if fields is not None else None
+        self.tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = self.tokenPattern.match(expression, position)
+            if match is None:
+                raise ValueError('Unsupported filter expression: %s' % self.expression)
+            position = match.end()
+            if match.group('number') is not None:
+                number = match.group('number')
+                value = float(number) if any(c in number for c in '.eE') else int(number)
+                self.tokens.append(('value', value))
+            elif match.group('string') is not None:
+                self.tokens.append(('value', match.group('string').replace("''", "'")))
+            elif match.group('quoted') is not None:
+                self.tokens.append(('name', match.group('quoted')))
+            elif match.group('op') is not None:
+                self.tokens.append(('op', match.group('op')))
+            else:
+                name = match.group('name')
+                if name.upper() in ('AND', 'OR', 'NOT', 'IN', 'IS', 'NULL'):
+                    self.tokens.append(('keyword', name.upper()))
+                else:
+                    self.tokens.append(('name', name))
+        self.position = 0
+
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+
+    def accept(self,kind,value = None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.position += 1
+            return token
+        return None
+
+
+    def expect(self,kind,value = None):
+        token = self.accept(kind, value)
+        if token is None:
+            raise ValueError('Unsupported filter expression: %s' % self.expression)
+        return token
+
+
+    def parse(self):
+        predicate = self.parseOr()
+        if self.position != len(self.tokens):
+            raise ValueError('Unsupported filter expression: %s' % self.expression)
+        return predicate
+
+
+    def parseOr(self):
+        predicates = [self.parseAnd()]
+        while self.accept('keyword', 'OR'):
+            predicates.append(self.parseAnd())
+        if len(predicates) == 1:
+            return predicates[0]
+
+        def predicate(attributes):
+            result = False
+            for p in predicates:
+                value = p(attributes)
+                if value:
+                    return True
+                if value is None:
+                    result = None
+            return result
+
+        return predicate
+
+
+    def parseAnd(self):
+        predicates = [self.parseNot()]
+        while self.accept('keyword', 'AND'):
+            predicates.append(self.parseNot())
+        if len(predicates) == 1:
+            return predicates[0]
+
+        def predicate(attributes):
+            result = True
+            for p in predicates:
+                value = p(attributes)
+                if value is None:
+                    result = None
+                elif not value:
+                    return False
+            return result
+
+        return predicate
+
+
+    def parseNot(self):
+        if self.accept('keyword', 'NOT'):
+            predicate = self.parseNot()
+
+            def negation(attributes):
+                value = predicate(attributes)
+                return None if value is None else not value
+
+            return negation
+        if self.accept('op', '('):
+            predicate = self.parseOr()
+            self.expect('op', ')')
+            return predicate
+        return self.parseComparison()
+
+
+    def parseComparison(self):
+        name = self.expect('name')[1]
+        if self.fieldNames is not None and name.lower() not in self.fieldNames:
+            raise ValueError('Unknown field %s in the filter expression: %s' % (name, self.expression))
+        getValue = _fieldGetter(name)
+
+        if self.accept('keyword', 'IS'):
+            negate = self.accept('keyword', 'NOT') is not None
+            self.expect('keyword', 'NULL')
+            return lambda attributes: (getValue(attributes) is None) != negate
+
+        negate = self.accept('keyword', 'NOT') is not None
+        if negate or self.peek() == ('keyword', 'IN'):
+            self.expect('keyword', 'IN')
+            self.expect('op', '(')
+            values = [self.expect('value')[1]]
+            while self.accept('op', ','):
+                values.append(self.expect('value')[1])
+            self.expect('op', ')')
+
+            def contains(attributes):
+                fieldValue = getValue(attributes)
+                if fieldValue is None:
+                    return None
+                return any(_compare(fieldValue, '=', v) for v in values) != negate
+
+            return contains
+
+        op = self.expect('op')[1]
+        if op not in ('=', '!=', '<>', '<', '<=', '>', '>='):
+            raise ValueError('Unsupported filter expression: %s' % self.expression)
+        value = self.expect('value')[1]
+        return lambda attributes: _compare(getValue(attributes), op, value)
+
+
+
+def _fieldGetter(name):
+    """Returns a function reading a field from an attribute dict (case insensitive)"""
+    lowerName = name.lower()
+
+    def getValue(attributes):
+        if name in attributes:
+            return attributes[name]
+        for key, value in attributes.items():
+            if key.lower() == lowerName:
+                return value
+        return None
+
+    return getValue
+
+
+
+def _compare(fieldValue, op, value):
+    """Compares an attribute value with a literal of the filter, the comparison with
+    NULL is unknown (None). Like OGR the literal is converted to the type of the
+    field: a number compared with a string field is compared as string, a string
+    compared with a numeric field as number (0 if it isn't a number)"""
+    if fieldValue is None:
+        return None
+
+    if isinstance(fieldValue, str):
+        if isinstance(value, (int, float)):
+            value = str(value) if isinstance(value, int) else '%.15g' % value
+    elif isinstance(value, str):
+        match = re.match(r'\s*[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?', value)
+        value = float(match.group(0)) if match else 0.0
+
+    if op == '=':
+        return fieldValue == value
+    elif op in ('!=', '<>'):
+        return fieldValue != value
+    elif op == '<':
+        return fieldValue < value
+    elif op == '<=':
+        return fieldValue <= value
+    elif op == '>':
+        return fieldValue > value
+    else:
+        return fieldValue >= value
+
+
+
+def getFilterFieldNames(expression):
+    """Returns the lower case names of the fields used in an attribute filter. For
+    expressions the in-process filter doesn't support all identifiers are returned"""
+    if expression is None or not expression.strip():
+        return set()
+
+    try:
+        tokens = _FilterParser(expression).tokens
+    except ValueError:
+        return {name.lower() for name in re.findall(r'[A-Za-z_][A-Za-z0-9_]*', expression)}
+
+    return {value.lower() for kind, value in tokens if kind == 'name'}
+
+
+
+def compileAttributeFilter(expression, fields = None):
+    """Compiles an OGR attribute filter (e.g. 'visited = 1') into a function which
+    takes the attribute dict of a geometry and returns if it matches the filter.
+    None or an empty filter matches everything. Raises a ValueError if the
+    expression is not supported or uses a name which isn't in fields (the field
+    names of the layer, default: any name)"""
+    if expression is None or not expression.strip():
+        return lambda attributes: True
+
+    predicate = _FilterParser(expression, fields).parse()
+    #Unknown (a comparison with NULL) doesn't match
+    return lambda attributes: predicate(attributes) is True
+
+
+
+#Types of the fields read with the Arrow stream
+ArrowFieldTypes = (ogr.OFTInteger, ogr.OFTInteger64, ogr.OFTReal, ogr.OFTString)
+
+
+
 class GeomTypesOgr(Enum):
     Unknown = 0
     Point = 1
@@ -130,47 +518,91 @@ class GeomTypesShapely(Enum):
     LinearRing = 101
 
 
-"""
-Represents
-
-"""
 class Geometry:
-    
-    def __init__(self,geom,fid = None,attributes = {},logger = None):
-        self.logger = logger or logging.getLogger(__name__+'.Geometry')
+    """
+    Represents a single feature: a shapely geometry, its FID and its attributes.
+
+    A Geometry is either standalone (holding the geometry and the attribute dict itself)
+    or a lightweight view on a row of a Layer, which stores all geometries and attributes
+    in columns. Layer.geometries returns such views. getAttributes() of a view returns
+    a new dict, use updateAttribute to change the value in the layer.
+    """
+
+    __slots__ = ('fid', '_geom', '_attributes', '_layer', '_row')
+
+    logger = logging.getLogger(__name__+'.Geometry')
 
-        self.logger.debug('Create new Geometry')
+    def __init__(self,geom,fid = None,attributes = None,logger = None):
+        self._layer = None
+        self._row = None
 
         if isinstance(geom, ogr.Geometry):
             #For OGR Geometries which need to be changed to shapely
-            self.logger.debug('Add ogr.Geometry with FID %s' % fid)
             self.parseOGRGeometry(geom)
         elif isinstance(geom, BaseGeometry):
-            self.geom = geom
+            self._geom = geom
+        elif isinstance(geom, (bytes, bytearray)):
+            #WKB is only decoded when the geometry is needed
+            self._geom = bytes(geom)
         else:
-            self.geomLogger.error('Object %s is not of type ogr.Geometry or shapely.BaseGeometry' % type(geom))
-            raise TypeError('Object must be of type ogr.Geometry or shapely.BaseGeometry')
+            self.logger.error('Object %s is not of type ogr.Geometry, shapely.BaseGeometry or WKB' % type(geom))
+            raise TypeError('Object must be of type ogr.Geometry, shapely.BaseGeometry or WKB')
         self.fid = fid
-        self.attributes = attributes
+        self._attributes = attributes if attributes is not None else {}
 
 
+    @classmethod
+    def view(cls,layer,row):
+        """Returns a Geometry which reads its data from the given row of the layer"""
+        geometry = cls.__new__(cls)
+        geometry._layer = layer
+        geometry._row = row
+        geometry.fid = layer.fids[row]
+        geometry._geom = None
+        geometry._attributes = None
+        return geometry
+
 
     def parseOGRGeometry(self,geom):
-        """Loads a OGR Geometry and stores it as Shapely Geometry."""
-        self.logger.debug('Convert ogr.Geometry to Shapely Geometry')
-        wkbGeom = geom.ExportToWkb()
-        self.geom = wkb.loads(wkbGeom)
+        """Stores the WKB of an OGR Geometry, it is decoded into a Shapely Geometry when
+        it is needed"""
+        self.setGeometry(bytes(geom.ExportToWkb()))
 
 
     def setGeometry(self,geom):
-        self.geom = geom
+        if self._layer is not None:
+            self._layer.geomColumn[self._row] = geom
+            self._layer.spatialIndex = None
+            self._layer.simplifiedColumn = None
+        else:
+            self._geom = geom
 
 
     def getGeometry(self):
-        return self.geom
+        if self._layer is not None:
+            return self._layer.geomColumn[self._row]
+        if isinstance(self._geom, bytes):
+            self._geom = wkb.loads(self._geom)
+        return self._geom
+
+
+    def getStored(self):
+        """Returns the shapely geometry or, if it wasn't decoded yet, its WKB"""
+        if self._layer is not None:
+            return self._layer.geomColumn.getStored(self._row)
+        return self._geom
+
+
+    def getWkb(self):
+        """Returns the WKB of the geometry, without decoding and encoding an undecoded
+        geometry"""
+        stored = self.getStored()
+        return stored if isinstance(stored, bytes) else wkb.dumps(stored)
+
+    geom = property(getGeometry, setGeometry)
 
     def getCentroid(self):
-        return self.geom.centroid
+        return self.getGeometry().centroid
 
     """
     Adds an Attribute
@@ -180,15 +612,25 @@ class Geometry:
     def addAttribute(self,name,value):
         if not isinstance(name, str):
             raise TypeError('Attribute name has to be of the type String and not %s' % type(name))
-        elif name in attributes:
-            self.geomLogger.error('Attribute %s of the geometry with fid %s exists already' %(name,fid))
+        elif self.getAttributes().get(name) is not None:
+            self.logger.error('Attribute %s of the geometry with fid %s exists already' %(name,self.fid))
             raise ValueError('Key %s already exist in dict attributes use update' % name)
         
-        self.attributes[name] = value
+        self.setAttribute(name, value)
 
 
     def getAttributes(self):
-        return self.attributes
+        if self._layer is not None:
+            return self._layer.getRowAttributes(self._row)
+        return self._attributes
+
+    attributes = property(getAttributes)
+
+    def setAttribute(self,name,value):
+        if self._layer is not None:
+            self._layer.setCell(name, self._row, value)
+        else:
+            self._attributes[name] = value
 
     """
     Updates an existing attribute
@@ -196,11 +638,11 @@ class Geometry:
     def updateAttribute(self,name,value):
         if not isinstance(name, str):
             raise TypeError('Attribute name has to be of the type String and not %s' % type(name))
-        elif name not in attributes:
-            self.geomLogger.error('Overwriting attribute %s of the geometry with fid %s' %(name,fid))
+        elif name not in self.getAttributes():
+            self.logger.error('Overwriting attribute %s of the geometry with fid %s' %(name,self.fid))
             raise ValueError('Can\'t find key %s in Dictionary attributes' % name)
 
-        self.attributes[name] = value
+        self.setAttribute(name, value)
 
 
     """
@@ -209,13 +651,132 @@ class Geometry:
     def delAttribute(self,name):
         if not isinstance(name, str):
             raise TypeError('Attribute name has to be of the type String and not %s' % type(name))
-        elif name in attributes:
-            self.geomLogger.warning('Overwriting attribute %s of the geometry with fid %s' %(name,fid))
 
-        del self.attributes[name]
+        if self._layer is not None:
+            self._layer.setCell(name, self._row, None)
+        else:
+            del self._attributes[name]
     
     def __repr__(self):
-        return "<WaveExposure.Geometry fid: %s, geom: %s, attributes: %s>" % (fid,geom,attributes)
+        return "<WaveExposure.Geometry fid: %s, geom: %s, attributes: %s>" % (self.fid,self.getGeometry(),self.getAttributes())
+
+
+
+class GeometryMap(Mapping):
+    """
+    Read-only dict-like access (fid -> Geometry view) on the rows of a Layer.
+    Assigning a Geometry to a fid adds it to the layer like Layer.addGeometry
+    """
+
+    __slots__ = ('layer',)
+
+    def __init__(self,layer):
+        self.layer = layer
+
+    def __getitem__(self,fid):
+        return Geometry.view(self.layer, self.layer.rows[fid])
+
+    def __setitem__(self,fid,geometry):
+        self.layer.addGeometry(fid, geometry)
+
+    def __contains__(self,fid):
+        return fid in self.layer.rows
+
+    def __iter__(self):
+        return iter(self.layer.fids)
+
+    def __len__(self):
+        return len(self.layer.fids)
+
+    def keys(self):
+        return list(self.layer.fids)
+
+    def values(self):
+        return [Geometry.view(self.layer, row) for row in range(len(self.layer.fids))]
+
+    def items(self):
+        return [(fid, Geometry.view(self.layer, row)) for row, fid in enumerate(self.layer.fids)]
+
+
+
+class GeometryColumn(MutableSequence):
+    """
+    The geometry column of a Layer. Rows hold shapely geometries or WKB (bytes) which
+    is only decoded when the geometry is needed: one row on access, all rows at once
+    (vectorized with shapely 2) on iteration. getStored, getWkb and wkbList return
+    undecoded rows without decoding and encoding them again, getHash hashes the WKB
+    of a row once
+    """
+
+    def __init__(self, geoms = ()):
+        self.items = [bytes(geom) if isinstance(geom, bytearray) else geom for geom in geoms]
+        self.pending = sum(isinstance(geom, bytes) for geom in self.items)
+        self.hashes = [None] * len(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self.items)))]
+        geom = self.items[row]
+        if isinstance(geom, bytes):
+            geom = wkb.loads(geom)
+            self.items[row] = geom
+            self.pending -= 1
+        return geom
+
+    def __setitem__(self, row, geom):
+        if isinstance(geom, bytearray):
+            geom = bytes(geom)
+        self.pending += isinstance(geom, bytes) - isinstance(self.items[row], bytes)
+        self.items[row] = geom
+        self.hashes[row] = None
+
+    def __delitem__(self, row):
+        self.pending -= isinstance(self.items[row], bytes)
+        del self.items[row]
+        del self.hashes[row]
+
+    def insert(self, row, geom):
+        if isinstance(geom, bytearray):
+            geom = bytes(geom)
+        self.pending += isinstance(geom, bytes)
+        self.items.insert(row, geom)
+        self.hashes.insert(row, None)
+
+    def __iter__(self):
+        self.decodeAll()
+        return iter(self.items)
+
+    def decodeAll(self):
+        """Decodes all undecoded rows at once"""
+        if self.pending:
+            rows = [row for row, geom in enumerate(self.items) if isinstance(geom, bytes)]
+            for row, geom in zip(rows, geometriesFromWkb([self.items[row] for row in rows])):
+                self.items[row] = geom
+            self.pending = 0
+
+    def getStored(self, row):
+        """Returns the shapely geometry or the WKB of a row without decoding it"""
+        return self.items[row]
+
+    def getWkb(self, row):
+        geom = self.items[row]
+        return geom if isinstance(geom, bytes) else wkb.dumps(geom)
+
+    def getHash(self, row):
+        """Returns the SHA-1 of the WKB of a row. It is computed from the stored WKB
+        before the row is decoded and kept, so decoded rows aren't encoded again"""
+        digest = self.hashes[row]
+        if digest is None:
+            digest = self.hashes[row] = hashlib.sha1(self.getWkb(row)).hexdigest()
+        return digest
+
+    def wkbList(self):
+        """Returns the WKB of all rows, the decoded rows are encoded at once"""
+        return geometriesToWkb(self.items)
+
 
 
 class Layer:
@@ -225,15 +786,32 @@ class Layer:
     Includes methods to easily read/store GDAL-Layers
     """
 
+    #Read the attributes in column batches with OGR's Arrow stream where possible
+    bulkRead = True
+
+    #Number of features per batch of the Arrow stream
+    arrowBatchSize = 65536
+
 
     
     def __init__(self,logger = None):
         self.logger = logger or logging.getLogger(__name__+'.Layer')
         self.logger.debug('New Layer is created')
-        self.geometries = {}
+        #Columnar storage: one entry per row in fids and geomColumn, the attributes
+        #are stored in one column per field (array for numeric fields)
+        self.fids = []
+        self.rows = {}
+        self.geomColumn = GeometryColumn()
+        self.columns = {}
         self.fields = {}
         self.srs = None
         self.geometryType = None
+        self.spatialIndex = None
+        self.spatialIndexFids = []
+        self.spatialIndexPositions = {}
+        #Simplified boundaries (level of detail) of the geometries, see simplifyBoundaries
+        self.simplifyTolerance = None
+        self.simplifiedColumn = None
 
     def setGeometryType(self,geometryType):
         """Sets the type of the Geometry"""
@@ -289,29 +867,193 @@ class Layer:
             self.logger.error("Field %s doesn't exist in this Layer and can't be deleted" % name)
 
 
+    @property
+    def geometries(self):
+        """Dict-like access (fid -> Geometry) on all rows of the layer"""
+        return GeometryMap(self)
+
+
     def addGeometry(self,fid,geom):
         if isinstance(geom,Geometry):
-            self.geometries[fid] = geom
+            self.addRow(fid, geom.getStored(), geom.getAttributes())
         else:
             self.logger.error('%s is not of type ShpHelper.Geometry' % type(geom))
             raise TypeError('Given Geometry of type %s is not of type ShpHelper.Geometry' % type(geom))
-    
+
+
+    def addRow(self,fid,geom,attributes):
+        """Adds (or replaces) the row of a fid with a shapely geometry (or its WKB,
+        decoded when it is needed) and an attribute dict"""
+        row = self.rows.get(fid)
+        if row is None:
+            row = len(self.fids)
+            self.rows[fid] = row
+            self.fids.append(fid)
+            self.geomColumn.append(geom)
+        else:
+            self.geomColumn[row] = geom
+
+        for name in list(self.columns.keys()):
+            if name not in attributes:
+                self.setCell(name, row, None)
+
+        for name, value in attributes.items():
+            self.setCell(name, row, value)
+
+        #The spatial index and the simplified boundaries are rebuilt on the next query
+        self.spatialIndex = None
+        self.simplifiedColumn = None
+
+
+    def setRows(self,fids,geoms,columns):
+        """Replaces all rows of the layer by the given list of FIDs, list of shapely
+        geometries (or WKB) and dict of attribute columns (each with one value per row)"""
+        self.fids = list(fids)
+        self.rows = {fid: row for row, fid in enumerate(self.fids)}
+        self.geomColumn = GeometryColumn(geoms)
+        self.columns = dict(columns)
+        self.spatialIndex = None
+        self.simplifiedColumn = None
+
+
+    def setCell(self,name,row,value):
+        """Sets the value of the attribute column name in the given row"""
+        column = self.columns.get(name)
+        if column is None:
+            column = self.createColumn(name)
+
+        try:
+            if row == len(column):
+                column.append(value)
+            else:
+                column[row] = value
+        except (TypeError, OverflowError):
+            #The value doesn't fit into the typed array (e.g. None), fall back to a list
+            column = list(column)
+            self.columns[name] = column
+            if row == len(column):
+                column.append(value)
+            else:
+                column[row] = value
+
+
+    def createColumn(self,name):
+        """Creates the column of a field. Numeric fields of the layer are stored in
+        typed arrays if the column is created with the first row, otherwise all
+        rows are filled with None"""
+        fieldType = self.fields.get(name)
+
+        if len(self.fids) == 1 and fieldType in (ogr.OFTInteger, ogr.OFTInteger64):
+            column = array('q')
+        elif len(self.fids) == 1 and fieldType == ogr.OFTReal:
+            column = array('d')
+        else:
+            column = [None] * len(self.fids)
+
+        self.columns[name] = column
+        return column
+
+
+    def getRowAttributes(self,row):
+        """Returns a new attribute dict of the given row"""
+        return {name: column[row] for name, column in self.columns.items()}
+
 
     def getGeometryByFID(self,fid):
         try:
-            return self.geometries[fid]
+            return Geometry.view(self, self.rows[fid])
         except KeyError:
             self.logger.error('FID %s not in Layer' % fid)
-            self.logger.debug(self.geometries.keys())
             raise KeyError('FID %s not in Layer' % fid)
 
 
-
-    def loadShp(self,path, layerID = 0, filter = None):
-        driver = ogr.GetDriverByName("ESRI Shapefile")
+    def buildSpatialIndex(self):
+        """Builds a STRtree over the bounding boxes of all geometries of the layer.
+        The index is rebuilt automatically if geometries are added afterwards"""
+        self.logger.debug('Build spatial index over %i geometries' % len(self.fids))
+        self.spatialIndexFids = list(self.fids)
+        geoms = list(self.geomColumn)
+
+        #Shapely < 2.0 returns the geometries instead of their positions on a query
+        self.spatialIndexPositions = {id(geom): i for i, geom in enumerate(geoms)}
+        self.spatialIndex = STRtree(geoms)
+
+
+    def queryFids(self, geom):
+        """Returns the FIDs of all geometries whose bounding box intersects the
+        bounding box of the given shapely geometry (in the order of the layer)"""
+        if self.spatialIndex is None:
+            self.buildSpatialIndex()
+
+        if not self.spatialIndexFids:
+            return []
+
+        positions = []
+        for hit in self.spatialIndex.query(geom):
+            if isinstance(hit, BaseGeometry):
+                positions.append(self.spatialIndexPositions[id(hit)])
+            else:
+                positions.append(int(hit))
+
+        return [self.spatialIndexFids[i] for i in sorted(positions)]
+
+
+    def queryGeometries(self, geom):
+        """Returns a list of (fid, Geometry) tuples of all candidate geometries
+        whose bounding box intersects the bounding box of the given geometry"""
+        return [(fid, self.geometries[fid]) for fid in self.queryFids(geom)]
+
+
+    def simplifyBoundaries(self, tolerance):
+        """Builds simplified boundaries of all geometries (Douglas-Peucker with the
+        tolerance in the units of the layer) and the band around them which contains
+        the original boundary. None or 0 removes them"""
+        if not tolerance:
+            self.simplifyTolerance = None
+            self.simplifiedColumn = None
+            return
+
+        if tolerance < 0:
+            raise ValueError('The simplification tolerance has to be positive')
+
+        self.simplifyTolerance = float(tolerance)
+        #Every point of the original boundary is within the tolerance of the simplified
+        #one. The polygon of the buffer is inscribed in the circle, so the buffer distance
+        #is enlarged to contain the full tolerance
+        bandDistance = self.simplifyTolerance / math.cos(math.pi / 8)
+        self.simplifiedColumn = []
+        for geom in self.geomColumn:
+            boundary = geom.simplify(self.simplifyTolerance, preserve_topology = True).boundary
+            self.simplifiedColumn.append((boundary, boundary.buffer(bandDistance, 2)))
+        self.logger.debug('Simplified %i boundaries with a tolerance of %s' % (len(self.fids), tolerance))
+
+
+    def getSimplifiedBoundary(self, fid):
+        """Returns the simplified boundary of a fid and the band containing its original
+        boundary (see simplifyBoundaries)"""
+        if self.simplifyTolerance is None:
+            raise ValueError('The boundaries of the layer are not simplified')
+
+        if self.simplifiedColumn is None:
+            self.simplifyBoundaries(self.simplifyTolerance)
+        return self.simplifiedColumn[self.rows[fid]]
+
+
+
+    def iterShp(self,path, layerID = 0, filter = None, spatialFilter = None, fields = None):
+        """Generator reading the features of any OGR vector source (shape file,
+        GeoPackage, FlatGeobuf, ...) lazily. layerID is the index or name of the layer.
+        The srs, geometry type and fields of the layer are set before the first feature
+        is yielded. Yields a ShpHelper.Geometry per feature without adding it to the layer.
+        The attribute filter and spatialFilter (minx, miny, maxx, maxy: the features
+        whose geometry intersects the rectangle, some drivers only test the envelope)
+        are evaluated by the driver. fields (list of names, default all) selects the fields
+        to read, OGR doesn't decode the others. Features without geometry are skipped
+        with a warning. Geometries with Z/M coordinates or curves are converted to 2D
+        linear geometries, other types (e.g. TIN) raise a ValueError"""
         self.logger.debug('Trying to open %s with OGR' % path)
-        source = driver.Open(path,0)
-        layer = source.GetLayer(layerID)
+        source = openSource(path)
+        layer = getSourceLayer(source, layerID)
         
         self.logger.debug('Layer - Name: %s' % (layer.GetName()))
         
@@ -322,96 +1064,450 @@ class Layer:
         #self.epsg = getEPSG(srs)
         #logging.debug('Layer - EPSG: %s' % self.epsg)
 
-        #Gets the geometry type of the layer
-        self.geometryType = GeomTypesOgr(layer.GetGeomType()).name
-        self.logger.debug('OGC Thing: %s' % GeomTypesOgr(layer.GetGeomType()).name)
+        #Gets the geometry type of the layer, 2D and linear
+        geomType = getLayerGeomType(layer)
+        self.geometryType = geomType.name
+        self.logger.debug('OGC Thing: %s' % ogr.GeometryTypeToName(layer.GetGeomType()))
         self.logger.debug('Layer - Geometry Type: %s' % self.geometryType)
+        #Z/M coordinates and curves are converted per feature, also in layers of mixed types
+        convert = layer.GetGeomType() != geomType.value or geomType == GeomTypesOgr.Unknown
         
 
         #Get the names and types of all fields
         self.fields = getLayerFieldNamesAndType(layer)
 
+        if fields is not None:
+            self.fields = self.selectFields(layer, fields, filter)
+
         if filter is not None:
             self.logger.debug('Set attribute filter: %s' % filter)
             layer.SetAttributeFilter(filter)
 
+        if spatialFilter is not None:
+            self.logger.debug('Set spatial filter: %s' % (spatialFilter,))
+            layer.SetSpatialFilterRect(*spatialFilter)
 
-        #Loads all features of the layer and adds them to the feature list
-        for feature in layer:
-            #Get Geometry
-            geom = feature.GetGeometryRef()
-            #Get FID
-            fid = feature.GetFID()
-
-            attributes = {}
-            self.logger.debug(self.fields)
+        #Reads the features one after another (or in batches), the source stays open until the generator is exhausted
+        if not convert and self.canReadArrow(layer):
+            yield from self.iterArrowBatches(layer)
+        else:
+            decoder = FieldDecoder(layer.GetLayerDefn(), self.fields)
+            skipped = 0
+            for feature in layer:
+                geom = feature.GetGeometryRef()
+                if geom is None:
+                    skipped += 1
+                    continue
+                if convert:
+                    geom = geom.GetLinearGeometry()
+                    geom.FlattenTo2D()
+                yield Geometry(geom, feature.GetFID(), decoder.decode(feature))
+            self.warnSkipped(skipped)
 
-            #Get all attributes of the Geometry
-            for fieldName in self.fields.keys():
-                #if fieldName != 'FID':
-                fieldId = feature.GetFieldIndex(fieldName)
-                    
-                attributes[fieldName] = getFieldValueById(feature,fieldName)
-                print(attributes)
+        del source
 
-            self.logger.debug('Create ShpHelper.Geometry with FID %s' % fid)
-            self.geometries[fid] = Geometry(geom,fid,attributes)
 
+    def warnSkipped(self, skipped):
+        """Logs the number of features skipped for their missing geometry"""
+        if skipped:
+            self.logger.warning('Skipped %i features without geometry' % skipped)
+
+
+    def canReadArrow(self, layer):
+        """Returns if the features of an ogr layer can be read in column batches with
+        OGR's Arrow stream interface (GDAL >= 3.6 and pyarrow, numeric and string
+        fields only)"""
+        if not self.bulkRead or pa is None or not hasattr(layer, 'GetArrowStreamAsPyArrow'):
+            return False
+        return all(fieldType in ArrowFieldTypes for fieldType in self.fields.values())
+
+
+    def iterArrowBatches(self, layer):
+        """Reads the features of an ogr layer in batches of arrowBatchSize features with
+        OGR's Arrow stream and yields a ShpHelper.Geometry per feature. A column is
+        converted at once per batch, the values are the same as with the FieldDecoder
+        (NULL fields are None, a field named FID holds the FID). Features without geometry are skipped with a warning"""
+        fidColumn = layer.GetFIDColumn() or 'OGC_FID'
+        geometryColumn = layer.GetGeometryColumn() or 'wkb_geometry'
+        options = ['MAX_FEATURES_IN_BATCH=%i' % self.arrowBatchSize, 'INCLUDE_FID=YES']
+        skipped = 0
+
+        for batch in layer.GetArrowStreamAsPyArrow(options):
+            fids = batch.column(fidColumn).to_pylist()
+            geoms = batch.column(geometryColumn).to_pylist()
+
+            columns = []
+            for name in self.fields.keys():
+                if name == 'FID':
+                    columns.append(fids)
+                    continue
+                column = batch.column(name)
+                #Boolean (Integer subtype) fields are ints like GetFieldAsInteger
+                if pa.types.is_boolean(column.type):
+                    column = column.cast(pa.int32())
+                columns.append(column.to_pylist())
+
+            names = list(self.fields.keys())
+            for fid, geom, values in zip(fids, geoms, zip(*columns) if columns else ((),) * len(fids)):
+                if geom is None:
+                    skipped += 1
+                    continue
+                yield Geometry(geom, fid, dict(zip(names, values)))
+
+        self.warnSkipped(skipped)
+
+
+    def selectFields(self, layer, fieldNames, filter = None):
+        """Tells OGR to skip the fields of an ogr layer which are neither in fieldNames
+        nor used by the attribute filter and returns the dict of the selected fields.
+        Raises a ValueError for unknown field names"""
+        allFields = getLayerFieldNamesAndType(layer)
+        lowerNames = {name.lower(): name for name in allFields}
+
+        unknown = [name for name in fieldNames if name.lower() not in lowerNames]
+        if unknown:
+            raise ValueError('Unknown fields: %s' % ', '.join(unknown))
+
+        selected = {name.lower() for name in fieldNames} | getFilterFieldNames(filter)
+        fields = {name: fieldType for name, fieldType in allFields.items() if name.lower() in selected}
+        layer.SetIgnoredFields([name for name in allFields if name not in fields])
+        self.logger.debug('Reading %i of %i fields' % (len(fields), len(allFields)))
+
+        return fields
+
+
+    def loadShp(self,path, layerID = 0, filter = None, spatialFilter = None, fields = None):
+        """Loads all features (matching the attribute and spatial filter, see iterShp)
+        of an OGR vector source into the layer. The geometries are kept as WKB until
+        they are needed (see GeometryColumn), the spatial index is built on the first
+        query"""
+        for geometry in self.iterShp(path, layerID, filter, spatialFilter, fields):
+            self.addRow(geometry.fid, geometry.getStored(), geometry.getAttributes())
+
+
+    @staticmethod
+    def readFields(path, layerID = 0):
+        """Returns the field dict (name: OGR type) of an OGR vector source without
+        loading it"""
+        source = openSource(path)
+        fields = getLayerFieldNamesAndType(getSourceLayer(source, layerID))
+        del source
+        return fields
 
-            #print('Length allISlandDict' % allIslandsGeomDict.length())
 
+    @staticmethod
+    def readExtent(path, layerID = 0):
+        """Returns the extent (minx, miny, maxx, maxy) of an OGR vector source without
+        loading it"""
+        source = openSource(path)
+        minx, maxx, miny, maxy = getSourceLayer(source, layerID).GetExtent()
         del source
+        return minx, miny, maxx, maxy
+
+
+    def selectByCentroid(self, bounds):
+        """Returns a new Layer with the geometries of this layer whose centroid lies in
+        the bounds (minx, miny, maxx, maxy), including the lower and excluding the
+        upper bounds so every centroid belongs to one of adjacent bounds"""
+        minx, miny, maxx, maxy = bounds
+        layer = Layer()
+        layer.setSRS(self.srs)
+        layer.setGeometryType(self.geometryType)
+        layer.setFields(dict(self.fields))
+
+        for row, fid in enumerate(self.fids):
+            centroid = self.geomColumn[row].centroid
+            if minx <= centroid.x < maxx and miny <= centroid.y < maxy:
+                layer.addRow(fid, self.geomColumn[row], self.getRowAttributes(row))
+
+        return layer
+
+
+    def filterLayer(self,filter):
+        """Returns a new Layer with the geometries of this layer matching the attribute
+        filter (e.g. 'visited = 1'). The filter is evaluated in-process and the geometries
+        are shared with this layer instead of reloading them from disk.
+        Raises a ValueError if the filter expression is not supported or uses a name
+        which isn't a field of the layer (let OGR evaluate it then)"""
+        layer = Layer()
+        layer.setSRS(self.srs)
+        layer.setGeometryType(self.geometryType)
+        layer.setFields(dict(self.fields))
+
+        matches = compileAttributeFilter(filter, self.fields)
+        for row, fid in enumerate(self.fids):
+            attributes = self.getRowAttributes(row)
+            if matches(attributes):
+                layer.addRow(fid, self.geomColumn.getStored(row), attributes)
+
+        self.logger.debug('Filter %s matches %i of %i geometries' % (filter, len(layer.geometries), len(self.geometries)))
+        return layer
+
+    def openWriter(self, filePath, batchSize = None, layerName = None):
+        """Returns a writer for a new file with the srs, geometry type and fields of
+        this layer. The format depends on the extension: a LayerWriter for shape files
+        and GeoPackages (where layerName, default the file name, replaces a layer of
+        that name and keeps the other layers) or a TableWriter for .csv and .parquet"""
+        extension = os.path.splitext(filePath)[1].lower()
+        if extension == '.gpkg':
+            writer = GeoPackage(filePath, overwrite = False).openWriter(self, layerName)
+        elif extension in TableWriters:
+            writer = openTableWriter(filePath, self.srs, self.geometryType, self.fields)
+        else:
+            writer = LayerWriter(filePath, self.srs, self.geometryType, self.fields)
 
-        #self.logger.debug(self.geometries['177'].geom)
+        if batchSize is not None:
+            writer.batchSize = batchSize
+        return writer
 
-    def writeShp(self, filePath):
-        driver = ogr.GetDriverByName("ESRI Shapefile")
 
-        self.logger.debug('File %s exitst? %s' % (filePath,os.path.exists(filePath)))
-        if os.path.exists(filePath):
+    def writeShp(self, filePath, geometries = None, layerName = None):
+        """Writes the geometries of the layer (or any iterable of ShpHelper.Geometry
+        with the fields of this layer) into a file, see openWriter for the formats"""
+        if geometries is None:
+            geometries = self.geometries.values()
+
+        with self.openWriter(filePath, layerName = layerName) as writer:
+            writer.writeAll(geometries)
+
+
+
+class GeoPackage:
+    """
+    A GeoPackage file holding several layers (e.g. the rays and the points of the
+    exposure) written in one transaction. A GeoPackage has no 10 character limit of
+    the field names, no width of the strings and no 2 GB limit of a shape file.
+    Open a LayerWriter per layer with openWriter, all layers are committed when the
+    GeoPackage or its last open writer is closed.
+    """
+
+    def __init__(self, filePath, overwrite = True, logger = None):
+        self.logger = logger or logging.getLogger(__name__+'.GeoPackage')
+        self.filePath = filePath
+
+        driver = ogr.GetDriverByName('GPKG')
+        if overwrite and os.path.exists(filePath):
+            self.logger.info('Deleting %s... ' % filePath)
             driver.DeleteDataSource(filePath)
-            self.logger.info('Deleting %s... ' % (filePath))
 
-        source = driver.CreateDataSource(filePath)
+        if os.path.exists(filePath):
+            self.source = ogr.Open(filePath, 1)
+        else:
+            self.source = driver.CreateDataSource(filePath)
+
+        if self.source is None:
+            raise ValueError('GeoPackage %s can\'t be opened for writing' % filePath)
 
-        layerName = os.path.splitext(os.path.basename(filePath))[0]
+        self.writers = []
+        self.source.StartTransaction()
+
+
+    def openWriter(self, layer, layerName = None):
+        """Returns a LayerWriter for a new layer (default name: the file name) with the
+        srs, geometry type and fields of a ShpHelper.Layer. An existing layer of the
+        same name is replaced"""
+        if layerName is None:
+            layerName = os.path.splitext(os.path.basename(self.filePath))[0]
+
+        for index in range(self.source.GetLayerCount()):
+            if self.source.GetLayerByIndex(index).GetName() == layerName:
+                self.logger.info('Replacing layer %s of %s' % (layerName, self.filePath))
+                self.source.DeleteLayer(index)
+                break
+
+        fields = layer.getFields()
+        writer = LayerWriter(self.filePath, layer.getSRS(), layer.getGeomType(), fields,
+                             source = self.source, layerName = layerName,
+                             options = ['FID=%s' % self.fidColumnName(fields)])
+        writer.package = self
+        self.writers.append(writer)
+        return writer
+
+
+    @staticmethod
+    def fidColumnName(fields):
+        """Returns a name of the primary key column of a layer which doesn't collide
+        with its fields. GDAL refuses fields named like the primary key (ignoring the
+        case) unless they are integers, e.g. the String field FID of the exposure"""
+        names = set(name.lower() for name in fields.keys())
+        for name in ('fid', 'ogc_fid'):
+            if name not in names:
+                return name
+        index = 1
+        while 'fid_%i' % index in names:
+            index += 1
+        return 'fid_%i' % index
+
+
+    def writerClosed(self, writer):
+        """Closes the GeoPackage with its last open writer"""
+        if writer in self.writers:
+            self.writers.remove(writer)
+            if not self.writers:
+                self.close()
+
+
+    def close(self):
+        """Closes the writers and commits all layers"""
+        if self.source is not None:
+            source = self.source
+            self.source = None
+            for writer in list(self.writers):
+                writer.close()
+            source.CommitTransaction()
+            self.logger.debug('Committed %s' % self.filePath)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+
+
+class LayerWriter:
+    """
+    Writes ShpHelper.Geometry objects into a new shape file (or a layer of a
+    GeoPackage, see GeoPackage.openWriter). The features of a shape file are inserted
+    in transactions of batchSize features, a GeoPackage holds one transaction for all
+    its layers. One ogr.Feature is reused for all rows.
+    Use it as context manager or call close() to commit the last batch.
+    """
+
+    #Number of features inserted per transaction
+    batchSize = 10000
+
+    def __init__(self, filePath, srs, geometryType, fields, logger = None, source = None, layerName = None, options = None):
+        self.logger = logger or logging.getLogger(__name__+'.LayerWriter')
+        self.package = None
+        self.transactions = source is None
+
+        if source is None:
+            driver = ogr.GetDriverByName("ESRI Shapefile")
+
+            self.logger.debug('File %s exitst? %s' % (filePath,os.path.exists(filePath)))
+            if os.path.exists(filePath):
+                driver.DeleteDataSource(filePath)
+                self.logger.info('Deleting %s... ' % (filePath))
+
+            source = driver.CreateDataSource(filePath)
+
+        self.source = source
+
+        if layerName is None:
+            layerName = os.path.splitext(os.path.basename(filePath))[0]
         
         self.logger.debug('Layername: %s' % layerName)
-        self.logger.debug('SRS: %s' % self.srs)
-        self.logger.debug('GeomType: %s' % GeomTypesOgr[self.geometryType].value)
-        layer = source.CreateLayer(layerName,self.srs,GeomTypesOgr[self.geometryType].value)
+        self.logger.debug('SRS: %s' % srs)
+        self.logger.debug('GeomType: %s' % GeomTypesOgr[geometryType].value)
+        self.layer = self.source.CreateLayer(layerName,srs,GeomTypesOgr[geometryType].value,options or [])
+        if self.layer is None:
+            raise ValueError('Layer %s can\'t be created in %s' % (layerName, filePath))
 
-        for fieldName, fieldType in self.fields.items():
+        #Field indices are resolved once for all features. The index of a created field
+        #is the last one, the driver may have shortened its name (10 characters in a DBF)
+        self.fieldIndices = []
+        for fieldName, fieldType in fields.items():
 
             field = ogr.FieldDefn(fieldName, fieldType)
 
-            if fieldType == ogr.OFTString:
+            #Only the DBF of a shape file needs a width of the strings
+            if fieldType == ogr.OFTString and self.transactions:
                 field.SetWidth(80)
 
-            layer.CreateField(field)
+            if self.layer.CreateField(field) != ogr.OGRERR_NONE:
+                raise ValueError('Field %s (%s) can\'t be created in %s' % (fieldName, ogr.GetFieldTypeName(fieldType), filePath))
+            self.fieldIndices.append((fieldName, self.layer.GetLayerDefn().GetFieldCount() - 1))
 
-        for fid, geometry in self.geometries.items():
-            feature =  ogr.Feature(layer.GetLayerDefn())
-            
-            geom = ogr.CreateGeometryFromWkb(wkb.dumps(geometry.geom))
-            feature.SetGeometry(geom)
+        layerDefn = self.layer.GetLayerDefn()
+        self.feature = ogr.Feature(layerDefn)
 
-            self.logger.debug('Feature ID (Geometry): %s' % type(fid))
-            feature.SetFID(int(fid))
-            #feature.SetField('FID',ogr.OFTInteger)
-            self.logger.debug('Feature ID (OGR): %i' % feature.GetFID())
+        self.count = 0
+        self.pending = 0
 
-            for attributeName, attributeValue in geometry.attributes.items():
-                self.logger.debug('Attribute: %s Value:%s' % (attributeName, attributeValue))
-                feature.SetField(attributeName,attributeValue)
 
+    def write(self, geometry):
+        """Writes a ShpHelper.Geometry as feature. Attributes which are not fields of
+        the layer are ignored"""
+        self.writeFeature(geometry, geometry.getWkb())
 
 
-            layer.CreateFeature(feature)
+    def writeFeature(self, geometry, data):
+        """Writes a ShpHelper.Geometry with the WKB of its geometry as feature"""
+        if self.pending == 0 and self.transactions:
+            self.layer.StartTransaction()
 
-            feature.Destroy()
+        feature = self.feature
+        feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(data))
+        feature.SetFID(int(geometry.fid))
 
-        del source
+        attributes = geometry.attributes
+        for name, index in self.fieldIndices:
+            value = attributes.get(name)
+            if value is None:
+                feature.UnsetField(index)
+            else:
+                feature.SetField(index, value)
+
+        self.layer.CreateFeature(feature)
+
+        self.count += 1
+        self.pending += 1
+        if self.pending >= self.batchSize:
+            self.commit()
+
+
+    def writeAll(self, geometries):
+        """Writes all ShpHelper.Geometry objects of an iterable (e.g. a generator
+        producing the results one by one). The geometries of a batch are encoded
+        as WKB at once"""
+        batch = []
+        for geometry in geometries:
+            batch.append(geometry)
+            if len(batch) >= self.batchSize:
+                self.writeBatch(batch)
+                batch = []
+        self.writeBatch(batch)
+
+
+    def writeBatch(self, geometries):
+        for geometry, data in zip(geometries, geometriesToWkb([geometry.getStored() for geometry in geometries])):
+            self.writeFeature(geometry, data)
+
+
+    def commit(self):
+        """Commits the features written since the last commit"""
+        if self.pending > 0:
+            if self.transactions:
+                self.layer.CommitTransaction()
+                self.logger.debug('Committed %i features' % self.pending)
+            self.pending = 0
+
+
+    def close(self):
+        """Commits the last batch and closes the file (the GeoPackage is committed
+        with its last writer)"""
+        if self.source is not None:
+            self.commit()
+            self.logger.debug('Wrote %i features' % self.count)
+            self.feature = None
+            self.layer = None
+            self.source = None
+
+            if self.package is not None:
+                self.package.writerClosed(self)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
 
 
 if __name__ == '__main__':
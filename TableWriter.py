@@ -0,0 +1,190 @@
+"""
+Columnar exports of layers for analytics (see ShpHelper.Layer.openWriter)
+
+The rows are written as a table with the fid, the attributes and the geometry as WKB,
+so the results (e.g. the exposure of every island) can be read without parsing shape
+files: CSV with the WKB as hex string (readable by pandas, DuckDB, GDAL, ...) or
+GeoParquet with the WKB as binary column (requires pyarrow). Both writers take
+ShpHelper.Geometry objects like a LayerWriter and write them in batches of batchSize
+rows (one row group per batch in Parquet).
+"""
+
+import os
+import csv
+import json
+import logging
+
+import ogr
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class TableWriter:
+    """
+    Base class of the table writers. The columns are the fid (unless the layer has a
+    field named fid), the fields of the layer and the geometry. Subclasses write the
+    rows of a batch in writeRows and close the file in closeFile
+    """
+
+    #Number of rows written at once
+    batchSize = 10000
+
+    def __init__(self, filePath, srs, geometryType, fields, logger = None):
+        self.logger = logger or logging.getLogger(__name__+'.'+type(self).__name__)
+        self.filePath = filePath
+        self.srs = srs
+        self.geometryType = geometryType
+        self.fields = dict(fields)
+        self.fieldNames = list(self.fields.keys())
+        self.fidColumn = 'fid' not in (name.lower() for name in self.fieldNames)
+        self.columnNames = (['fid'] if self.fidColumn else []) + self.fieldNames + ['geometry']
+
+        if os.path.exists(filePath):
+            self.logger.info('Deleting %s... ' % filePath)
+            os.remove(filePath)
+
+        self.rows = []
+        self.count = 0
+        self.closed = False
+
+
+    def write(self, geometry):
+        """Writes a ShpHelper.Geometry as row. Attributes which are not fields of the
+        layer are ignored"""
+        attributes = geometry.attributes
+        row = [int(geometry.fid)] if self.fidColumn else []
+        row.extend(attributes.get(name) for name in self.fieldNames)
+        row.append(geometry.getWkb())
+        self.rows.append(row)
+
+        self.count += 1
+        if len(self.rows) >= self.batchSize:
+            self.commit()
+
+
+    def writeAll(self, geometries):
+        """Writes all ShpHelper.Geometry objects of an iterable"""
+        for geometry in geometries:
+            self.write(geometry)
+
+
+    def commit(self):
+        """Writes the rows of the current batch"""
+        if self.rows:
+            self.writeRows(self.rows)
+            self.rows = []
+
+
+    def writeRows(self, rows):
+        raise NotImplementedError
+
+
+    def closeFile(self):
+        pass
+
+
+    def close(self):
+        """Writes the last batch and closes the file"""
+        if not self.closed:
+            self.commit()
+            self.closeFile()
+            self.logger.debug('Wrote %i rows' % self.count)
+            self.closed = True
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+
+
+class CsvWriter(TableWriter):
+    """Writes a CSV file with a header, the geometry is the WKB as hex string"""
+
+    def __init__(self, filePath, srs, geometryType, fields, logger = None):
+        TableWriter.__init__(self, filePath, srs, geometryType, fields, logger)
+        self.file = open(filePath, 'w', newline = '')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columnNames)
+
+
+    def writeRows(self, rows):
+        for row in rows:
+            row[-1] = row[-1].hex()
+        self.writer.writerows(rows)
+
+
+    def closeFile(self):
+        self.file.close()
+
+
+
+class ParquetWriter(TableWriter):
+    """Writes a GeoParquet file, the geometry is a binary WKB column"""
+
+    #Arrow types of the OGR field types, other fields are written as strings
+    arrowTypes = {ogr.OFTInteger: 'int64', ogr.OFTInteger64: 'int64', ogr.OFTReal: 'float64'}
+
+    def __init__(self, filePath, srs, geometryType, fields, logger = None):
+        if pa is None:
+            raise ImportError('Writing Parquet files requires pyarrow')
+
+        TableWriter.__init__(self, filePath, srs, geometryType, fields, logger)
+
+        types = [pa.int64()] if self.fidColumn else []
+        types.extend(getattr(pa, self.arrowTypes.get(fieldType, 'string'))() for fieldType in self.fields.values())
+        types.append(pa.binary())
+        self.types = types
+
+        schema = pa.schema(list(zip(self.columnNames, types)), metadata = {'geo': json.dumps(self.geoMetadata())})
+        self.writer = pq.ParquetWriter(filePath, schema)
+
+
+    def geoMetadata(self):
+        """Returns the GeoParquet metadata of the geometry column"""
+        crs = None
+        if self.srs is not None and hasattr(self.srs, 'ExportToPROJJSON'):
+            crs = json.loads(self.srs.ExportToPROJJSON())
+
+        column = {'encoding': 'WKB',
+                  'geometry_types': [self.geometryType] if self.geometryType else [],
+                  'crs': crs}
+        return {'version': '1.0.0', 'primary_column': 'geometry', 'columns': {'geometry': column}}
+
+
+    def writeRows(self, rows):
+        arrays = []
+        for values, arrowType in zip(zip(*rows), self.types):
+            if arrowType == pa.string():
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(pa.array(values, type = arrowType))
+
+        self.writer.write_table(pa.Table.from_arrays(arrays, names = self.columnNames))
+
+
+    def closeFile(self):
+        self.writer.close()
+
+
+
+#Table writers by file extension
+TableWriters = {'.csv': CsvWriter, '.parquet': ParquetWriter}
+
+
+def openTableWriter(filePath, srs, geometryType, fields):
+    """Returns the table writer for the extension of the file"""
+    extension = os.path.splitext(filePath)[1].lower()
+    try:
+        writerClass = TableWriters[extension]
+    except KeyError:
+        raise ValueError('No table format for %s (%s)' % (filePath, ', '.join(sorted(TableWriters))))
+    return writerClass(filePath, srs, geometryType, fields)
@@ -1,21 +1,75 @@
 import os
+import sys
 import math
+import hashlib
 import logging
 import logging.config
 
+from contextlib import closing
+
+from concurrent.futures import ProcessPoolExecutor
+
 from ShpHelper import Layer
 from ShpHelper import Geometry
 from ShpHelper import GeomTypesShapely
+from ShpHelper import GeoPackage
+from ShpHelper import packWkb
+from ShpHelper import unpackWkb
+from ShpHelper import getFilterFieldNames
+
+from RayCasting import ShapelyRayCaster
+from RayCasting import NumpyRayCaster
+from RayCasting import directionAngles
+
+from RasterEngine import RasterRayCaster
+
+from ExposureCache import RayCache
+from ExposureCache import DiskCache
+from ExposureCache import hashSourceFile
+
+from Instrumentation import Metrics
+from Instrumentation import NullMetrics
+
+from Progress import ProgressTracker
 
 from shapely.geometry import Point
 from shapely.geometry import LineString
 from shapely.geometry import MultiLineString
 
-def frange(start, stop, step):
-    i = start
-    while i < stop:
-        yield i
-        i += step
+#Ray caster of a worker process of the parallel mode (see WaveExposure.setWorkers)
+_workerRayCaster = None
+
+
+def _initWorker(fids, buffer, offsets, length, engine, simplifyTolerance = None, cellSize = None):
+    """Initializes a worker process with the layer of all islands. The islands are
+    transferred once per worker as packed WKB instead of once per task"""
+    global _workerRayCaster
+
+    allIslands = Layer()
+    allIslands.setRows(fids, unpackWkb(buffer, offsets, decode = False), {})
+
+    exposure = WaveExposure()
+    exposure.setRayLength(length)
+    exposure.setEngine(engine)
+    exposure.setSimplifyTolerance(simplifyTolerance)
+    if cellSize is not None:
+        exposure.setCellSize(cellSize)
+    _workerRayCaster = exposure.createRayCaster(allIslands)
+
+
+def _castChunk(chunk):
+    """Casts the rays of a chunk of (fid, x, y, angles) sites in a worker process and
+    returns the rays of the sites and the counters of the ray caster"""
+    results = [_workerRayCaster.castRays(fid, Point(x, y), angles) for fid, x, y, angles in chunk]
+    return results, _workerRayCaster.popStats()
+
+
+def _castPointBatch(batch):
+    """Casts the rays of a batch (xs, ys, angles) of sample points in a worker process
+    and returns their distances and the counters of the ray caster"""
+    xs, ys, angles = batch
+    return _workerRayCaster.castPoints(xs, ys, angles), _workerRayCaster.popStats()
+
 
 
 class WaveExposure:
@@ -31,6 +85,24 @@ class WaveExposure:
     length = 2000 #Length of the  in m
     deg = 15
     sourceFile = None
+    engine = 'shapely'
+    simplifyTolerance = None
+    cellSize = 10.0
+    tileSize = None
+    sourceLayer = 0
+    outputFields = None
+    studyArea = None
+    workers = 1
+    rayCache = None
+    diskCache = None
+    attributeFilter = None
+    allIslandsLayer = None
+    loadedSource = None
+    sourceHash = None
+    metrics = NullMetrics()
+
+    #Available ray casting engines
+    engines = ('shapely', 'numpy', 'raster')
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
@@ -68,6 +140,228 @@ class WaveExposure:
         """Returns the currently set degree"""
         return self.deg
 
+
+    def getAngles(self):
+        """Returns the list of directions (in degree) of the rays of a site"""
+        return list(directionAngles(self.deg))
+
+    def setEngine(self,engine):
+        """Sets the engine used for ray casting ('shapely', 'numpy' or 'raster')"""
+        self.logger.info('Set engine to %s' % engine)
+        if engine not in self.engines:
+            raise ValueError('Engine %s unknown. Use one of %s' % (engine, ', '.join(self.engines)))
+        self.engine = engine
+
+
+    def getEngine(self):
+        """Returns the currently set ray casting engine"""
+        return self.engine
+
+
+    def createRayCaster(self,allIslands):
+        """Creates the ray caster of the selected engine for the given layer of islands"""
+        self.logger.debug('Create %s ray caster' % self.engine)
+        if self.engine in ('numpy', 'raster') and self.simplifyTolerance is not None:
+            self.logger.warning('The %s engine uses the full boundaries, the simplification is ignored' % self.engine)
+
+        if self.engine == 'numpy':
+            return NumpyRayCaster(allIslands, self.length)
+        elif self.engine == 'raster':
+            return RasterRayCaster(allIslands, self.length, self.cellSize)
+        else:
+            if allIslands.simplifyTolerance != self.simplifyTolerance:
+                allIslands.simplifyBoundaries(self.simplifyTolerance)
+            return ShapelyRayCaster(allIslands, self.length)
+
+
+    def setCellSize(self,cellSize):
+        """Sets the cell size in m of the land grid of the raster engine. The distances
+        of the raster engine are accurate to about one cell (see RasterEngine)"""
+        self.logger.info('Set cell size to %s m' % cellSize)
+        if cellSize <= 0:
+            raise ValueError('The cell size has to be positive')
+        self.cellSize = float(cellSize)
+
+
+    def getCellSize(self):
+        """Returns the cell size of the raster engine"""
+        return self.cellSize
+
+
+    def setSimplifyTolerance(self,tolerance):
+        """Sets the tolerance in m of the simplified island boundaries used by the shapely
+        engine (None = full boundaries). Hits which could change within the tolerance are
+        refined with the full boundaries (see RayCasting.ShapelyRayCaster)"""
+        self.logger.info('Set simplification tolerance to %s' % tolerance)
+        if tolerance is not None and tolerance < 0:
+            raise ValueError('The simplification tolerance has to be positive')
+        self.simplifyTolerance = float(tolerance) if tolerance else None
+
+
+    def getSimplifyTolerance(self):
+        """Returns the tolerance of the simplified island boundaries or None"""
+        return self.simplifyTolerance
+
+
+    def getRayCacheKey(self):
+        """Returns the key of the cached rays: rays of different engines or simplification
+        tolerances are not mixed"""
+        if self.engine == 'shapely' and self.simplifyTolerance is not None:
+            return '%s-simplified-%s' % (self.engine, self.simplifyTolerance)
+        if self.engine == 'raster':
+            return '%s-%s' % (self.engine, self.cellSize)
+        return self.engine
+
+    def setWorkers(self,workers):
+        """Sets the number of processes used for the calculation (1 = no parallelisation)"""
+        self.logger.info('Set workers to %i' % workers)
+        if workers < 1:
+            raise ValueError('The number of workers has to be at least 1')
+        self.workers = int(workers)
+
+
+    def getWorkers(self):
+        """Returns the number of processes used for the calculation"""
+        return self.workers
+
+    def setIncremental(self,incremental):
+        """Enables/disables the incremental mode. The rays of every calculation are kept
+        and the next calculation only casts the rays affected by changed parameters
+        (filter, degree, longer rays) or changed islands"""
+        self.logger.info('Set incremental mode to %s' % incremental)
+        if incremental:
+            if self.rayCache is None:
+                self.rayCache = RayCache()
+        else:
+            self.rayCache = None
+
+
+    def isIncremental(self):
+        """Returns if the incremental mode is enabled"""
+        return self.rayCache is not None
+
+    def setCacheDir(self,directory):
+        """Sets a directory to cache the parsed islands and the cast rays between runs
+        (None disables it). The cache is keyed by the content hash of the source file,
+        so a changed file is loaded and calculated again. Enables the incremental mode"""
+        self.logger.info('Set cache directory to %s' % directory)
+        if directory is None:
+            self.diskCache = None
+        else:
+            self.diskCache = DiskCache(directory)
+            self.setIncremental(True)
+
+
+    def getCacheDir(self):
+        """Returns the cache directory or None"""
+        return self.diskCache.directory if self.diskCache is not None else None
+
+    def setMetrics(self,enabled):
+        """Enables/disables the collection of counters and timers of the calculation
+        (see Instrumentation.Metrics). Disabled metrics cost nearly nothing"""
+        self.logger.info('Set metrics to %s' % enabled)
+        self.metrics = Metrics() if enabled else NullMetrics()
+
+
+    def getMetrics(self):
+        """Returns the metrics of the calculations since the last reset"""
+        return self.metrics
+
+
+    def resetMetrics(self):
+        """Clears the counters and timers"""
+        self.metrics = Metrics() if self.metrics.enabled else NullMetrics()
+
+
+    def dumpMetrics(self,filePath):
+        """Writes the metrics as JSON file"""
+        self.metrics.dumpJson(filePath)
+
+    def setTileSize(self,tileSize):
+        """Sets the size in m of the tiles of the tiled mode (None disables it). In the
+        tiled mode only the islands of one tile (buffered by the ray length) are loaded
+        at a time and the results are streamed into the output files"""
+        self.logger.info('Set tile size to %s' % tileSize)
+        if tileSize is not None and tileSize <= 0:
+            raise ValueError('The tile size has to be positive')
+        self.tileSize = float(tileSize) if tileSize is not None else None
+
+
+    def getTileSize(self):
+        """Returns the tile size of the tiled mode or None"""
+        return self.tileSize
+
+    def setSourceLayer(self,sourceLayer):
+        """Sets the index or name of the layer of the source file (e.g. of a GeoPackage)"""
+        self.logger.info('Set source layer to %s' % sourceLayer)
+        self.sourceLayer = sourceLayer
+
+
+    def getSourceLayer(self):
+        return self.sourceLayer
+
+
+    def setOutputFields(self,fields):
+        """Sets the fields of the islands which are read and copied into the output
+        (list of names, None for all fields). Fields used by the filter are read too"""
+        self.logger.info('Set output fields to %s' % fields)
+        self.outputFields = list(fields) if fields is not None else None
+
+
+    def getOutputFields(self):
+        return self.outputFields
+
+
+    def setStudyArea(self,bounds):
+        """Restricts the calculation to the sites whose centroid lies in the bounds
+        (minx, miny, maxx, maxy, None for all sites). Only the islands within the ray
+        length of the study area are read from the source file"""
+        self.logger.info('Set study area to %s' % (bounds,))
+        if bounds is not None:
+            minx, miny, maxx, maxy = bounds
+            if minx >= maxx or miny >= maxy:
+                raise ValueError('The study area %s is empty' % (bounds,))
+            bounds = (float(minx), float(miny), float(maxx), float(maxy))
+        self.studyArea = bounds
+
+
+    def getStudyArea(self):
+        return self.studyArea
+
+
+    def getLoadFields(self):
+        """Returns the names of the fields to read from the source file: the output
+        fields and the fields used by the filter (None for all fields)"""
+        if self.outputFields is None:
+            return None
+
+        filterFields = getFilterFieldNames(self.attributeFilter)
+        fields = list(self.outputFields)
+        for name in Layer.readFields(self.sourceFile, self.sourceLayer):
+            if name.lower() in filterFields and name not in fields:
+                fields.append(name)
+        return fields
+
+
+    def getLoadSpatialFilter(self):
+        """Returns the bounds of the islands to read: the study area buffered by the ray
+        length (None for all islands)"""
+        if self.studyArea is None:
+            return None
+        minx, miny, maxx, maxy = self.studyArea
+        return (minx - self.length, miny - self.length, maxx + self.length, maxy + self.length)
+
+
+    def hashSource(self):
+        """Returns the key of the loaded islands in the disk cache: the content hash of
+        the source file and the options selecting the loaded islands and fields"""
+        key = hashSourceFile(self.sourceFile)
+        options = (self.sourceLayer, self.outputFields, self.getLoadSpatialFilter())
+        if options != (0, None, None):
+            key += '-' + hashlib.sha1(repr(options).encode('utf-8')).hexdigest()[:12]
+        return key
+
+
     def setFilter(self,attributeFilter):
         self.logger.info('Set the filter to %s' % attributeFilter)
         self.attributeFilter = attributeFilter
@@ -90,35 +384,197 @@ class WaveExposure:
             raise Exception('Source file is not selected')
 
 
-    def startExposureCalculation(self):
+    def startExposureCalculation(self, pointFile = None, lineFile = None, observer = None, cancelToken = None):
+        """Loads the islands and calculates the exposure. If output files are given the
+        results are streamed into them while the calculation runs instead of being
+        collected in the point and ray layer. The observer and cancelToken report the
+        progress and cancel the calculation (see calcExposure). Returns the metrics of
+        the calculation (see setMetrics)"""
+        if self.tileSize is not None:
+            self.tiledExposure(pointFile, lineFile, observer, cancelToken)
+            return self.metrics
+
         self.loadIslandData()
+        self.runExposureCalculation(pointFile, lineFile, observer, cancelToken)
 
         #self.visitedIslands.writeShp('/home/kleinermann/workspace/dirk/gis/islands_visited.shp')
+        return self.metrics
 
 
-    def loadIslandData(self):
-        self.logger.info('Start Exposure calculation')
-        
-        self.logger.info('Loading all Islands into Memory')
-        self.logger.debug('Trying to load layer from file %s' % self.sourceFile)
-        self.allIslandsLayer = Layer()
-        self.allIslandsLayer.loadShp(self.sourceFile)
+    def runExposureCalculation(self, pointFile = None, lineFile = None, observer = None, cancelToken = None):
+        """Calculates the exposure of the loaded islands (see loadIslandData). The rays
+        of a cancelled calculation are stored in the disk cache as well"""
+        if self.diskCache is not None and (self.rayCache.engine != self.getRayCacheKey() or not self.rayCache.rays):
+            self.diskCache.loadRays(self.sourceHash, self.getRayCacheKey(), self.rayCache)
 
-        self.logger.info('Loading all visisted Islands into Memory')
-        self.visitedIslands = Layer()
-        self.visitedIslands.loadShp(path = self.sourceFile, filter = self.attributeFilter)
+        try:
+            if pointFile is None and lineFile is None:
+                self.calcExposure(self.visitedIslands, self.allIslandsLayer, observer, cancelToken)
+            else:
+                self.streamExposure(self.visitedIslands, self.allIslandsLayer, pointFile, lineFile, observer, cancelToken)
+        finally:
+            if self.diskCache is not None:
+                self.diskCache.storeRays(self.sourceHash, self.getRayCacheKey(), self.rayCache)
 
-        self.calcExposure(self.visitedIslands, self.allIslandsLayer)
 
+    def loadIslandData(self):
+        """Loads the islands of the source file and selects the visited islands with
+        the filter. The islands are only loaded again if the source file changed"""
+        self.logger.info('Start Exposure calculation')
 
-    def calcExposure(self,visitedIslands,allIslands):
-        self.logger.info('Start calculation of the wave exposure')
-        
+        with self.metrics.timer('load'):
+            loadedSource = (self.sourceFile, os.path.getmtime(self.sourceFile), os.path.getsize(self.sourceFile),
+                            self.sourceLayer, self.outputFields, self.getLoadSpatialFilter())
+            if self.allIslandsLayer is not None and loadedSource == self.loadedSource:
+                self.logger.info('Islands of %s are already loaded' % self.sourceFile)
+            else:
+                self.loadAllIslands()
+                self.loadedSource = loadedSource
+
+            if self.diskCache is not None and self.sourceHash is None:
+                self.sourceHash = self.hashSource()
+
+            self.logger.info('Selecting all visisted Islands')
+            try:
+                self.visitedIslands = self.allIslandsLayer.filterLayer(self.attributeFilter)
+            except ValueError:
+                #Let OGR evaluate filters which can't be evaluated in-process
+                self.logger.info('Loading all visisted Islands into Memory')
+                self.visitedIslands = Layer()
+                self.visitedIslands.loadShp(path = self.sourceFile, layerID = self.sourceLayer, filter = self.attributeFilter,
+                                            spatialFilter = self.getLoadSpatialFilter(), fields = self.getLoadFields())
+
+            if self.studyArea is not None:
+                self.visitedIslands = self.visitedIslands.selectByCentroid(self.studyArea)
+                self.logger.info('%i visited islands in the study area' % len(self.visitedIslands.fids))
+
+
+    def loadAllIslands(self):
+        """Loads all islands of the source file (from the disk cache if possible)"""
+        self.logger.info('Loading all Islands into Memory')
+        self.logger.debug('Trying to load layer from file %s' % self.sourceFile)
+        self.allIslandsLayer = None
+        self.sourceHash = None
+
+        if self.diskCache is not None:
+            self.sourceHash = self.hashSource()
+            self.allIslandsLayer = self.diskCache.loadLayer(self.sourceHash)
+
+        if self.allIslandsLayer is None:
+            self.allIslandsLayer = Layer()
+            self.allIslandsLayer.loadShp(self.sourceFile, layerID = self.sourceLayer, spatialFilter = self.getLoadSpatialFilter(),
+                                         fields = self.getLoadFields())
+
+            if self.diskCache is not None:
+                self.diskCache.storeLayer(self.sourceHash, self.allIslandsLayer)
+
+
+    def iterTiles(self,extent):
+        """Yields the bounds (minx, miny, maxx, maxy) of the tiles covering the extent"""
+        minx, miny, maxx, maxy = extent
+        columns = int(math.floor((maxx - minx) / self.tileSize)) + 1
+        rows = int(math.floor((maxy - miny) / self.tileSize)) + 1
+        for row in range(rows):
+            for column in range(columns):
+                tileMinx = minx + column * self.tileSize
+                tileMiny = miny + row * self.tileSize
+                yield tileMinx, tileMiny, tileMinx + self.tileSize, tileMiny + self.tileSize
+
+
+    def loadTile(self,tile):
+        """Loads all islands within the ray length of the tile and selects the visited
+        islands whose centroid lies in the tile. Returns both layers. The sites are
+        taken from the buffered islands: OGR's spatial filter tests the geometries, so
+        an island whose centroid lies in the tile but whose shape doesn't touch it
+        (e.g. a concave island or a MultiPolygon) is only found with the buffer. Parts
+        of a MultiPolygon all farther than the ray length from the tile of its centroid
+        aren't found"""
+        minx, miny, maxx, maxy = tile
+        buffered = (minx - self.length, miny - self.length, maxx + self.length, maxy + self.length)
+        fields = self.getLoadFields()
+        allIslands = Layer()
+        allIslands.loadShp(self.sourceFile, layerID = self.sourceLayer, spatialFilter = buffered, fields = fields)
+
+        #Every site belongs to the tile of its centroid
+        try:
+            candidates = allIslands.filterLayer(self.attributeFilter)
+        except ValueError:
+            #Let OGR evaluate filters which can't be evaluated in-process
+            candidates = Layer()
+            candidates.loadShp(self.sourceFile, layerID = self.sourceLayer, filter = self.attributeFilter,
+                               spatialFilter = buffered, fields = fields)
+        visitedIslands = candidates.selectByCentroid(tile)
+
+        return visitedIslands, allIslands
+
+
+    def tiledExposure(self,pointFile = None,lineFile = None,observer = None,cancelToken = None):
+        """Calculates the exposure tile by tile (see setTileSize) and streams the results
+        into the point and/or MultiLine shape file. The islands are read per tile with
+        spatial filters on the source file, so the memory is bounded by the tile size
+        instead of the size of the source file. Returns the number of calculated sites.
+        observer and cancelToken as in calcExposure, the total of the Progress is None
+        as the number of sites is only known at the end"""
+        if pointFile is None and lineFile is None:
+            raise ValueError('The tiled mode requires a point or MultiLine output file')
+
+        #The tiles of a study area only cover the study area
+        extent = self.studyArea if self.studyArea is not None else Layer.readExtent(self.sourceFile, self.sourceLayer)
+        self.logger.info('Start calculation of the wave exposure in tiles of %s m over %s' % (self.tileSize, extent))
+
+        pointWriter = None
+        lineWriter = None
+        sites = 0
+        tracker = ProgressTracker(observer, cancelToken)
+        raysPerIsland = len(self.getAngles())
+
+        try:
+            for tile in self.iterTiles(extent):
+                tracker.check()
+                if self.studyArea is not None:
+                    #The sites right of or above the study area belong to no tile
+                    tile = (tile[0], tile[1], min(tile[2], self.studyArea[2]), min(tile[3], self.studyArea[3]))
+                    if tile[0] >= tile[2] or tile[1] >= tile[3]:
+                        continue
+
+                with self.metrics.timer('load'):
+                    visitedIslands, allIslands = self.loadTile(tile)
+
+                if pointWriter is None and lineWriter is None:
+                    self.createOutputLayers(allIslands)
+                    pointWriter, lineWriter = self.openOutputWriters(pointFile, lineFile)
+
+                if not visitedIslands.fids:
+                    continue
+
+                self.logger.info('Tile %s: %i sites, %i islands' % (tile, len(visitedIslands.fids), len(allIslands.fids)))
+                self.metrics.count('tiles')
+                sites += len(visitedIslands.fids)
+
+                #The ray cache holds the rays of one layer of islands, it isn't used for tiles
+                with self.metrics.timer('calculate'), closing(self.iterExposure(visitedIslands, allIslands, useCache = False)) as results:
+                    for fid, rayGeometry, pointGeometry in results:
+                        if lineWriter is not None:
+                            lineWriter.write(rayGeometry)
+                        if pointWriter is not None:
+                            pointWriter.write(pointGeometry)
+                        tracker.islandDone(fid, raysPerIsland)
+            tracker.finish()
+        finally:
+            for writer in (pointWriter, lineWriter):
+                if writer is not None:
+                    writer.close()
+
+        return sites
+
+
+    def createOutputLayers(self,allIslands):
+        """Creates the empty ray and point layer with the fields of the islands"""
         self.logger.debug('Create a layer for the rays of the exposure')
         self.rayLayer = Layer()
         self.rayLayer.setGeometryType('MultiLineString')
         self.rayLayer.setSRS(allIslands.getSRS())
-        self.rayLayer.setFields(allIslands.getFields())
+        self.rayLayer.setFields(dict(allIslands.getFields()))
         self.rayLayer.addField('FID', 'String')
         self.rayLayer.addField('Exposure', 'Float')
 
@@ -128,101 +584,244 @@ class WaveExposure:
         self.pointLayer = Layer()
         self.pointLayer.setGeometryType('Point')
         self.pointLayer.setSRS(allIslands.getSRS())
-        self.pointLayer.setFields(allIslands.getFields())
+        self.pointLayer.setFields(dict(allIslands.getFields()))
         self.pointLayer.addField('FID', 'String')
         self.pointLayer.addField('Exposure', 'Float')
 
-        for fid, geom in visitedIslands.geometries.items():
-            self.logger.debug(type(geom))
-            centroid = geom.getCentroid()
+
+    def calcExposure(self,visitedIslands,allIslands,observer = None,cancelToken = None):
+        """Calculates the exposure of the visited islands into the ray and point layer.
+        The observer (a Progress.ProgressObserver or a function) is called after every
+        island, the cancelToken (Progress.CancellationToken) is checked between two
+        islands. A cancelled calculation raises Progress.CalculationCancelled and the
+        layers keep the finished islands"""
+        self.logger.info('Start calculation of the wave exposure')
+        
+        self.createOutputLayers(allIslands)
+        tracker = ProgressTracker(observer, cancelToken, len(visitedIslands.fids))
+        raysPerIsland = len(self.getAngles())
+
+        tracker.check()
+        with self.metrics.timer('calculate'), closing(self.iterExposure(visitedIslands, allIslands)) as results:
+            for fid, rayGeometry, pointGeometry in results:
+                self.rayLayer.addGeometry(fid,rayGeometry)
+                self.pointLayer.addGeometry(fid,pointGeometry)
+                tracker.islandDone(fid, raysPerIsland)
+        tracker.finish()
+
+
+    def streamExposure(self,visitedIslands,allIslands,pointFile = None,lineFile = None,observer = None,cancelToken = None):
+        """Calculates the exposure and writes the result of every island into the
+        point and/or MultiLine shape file as soon as it is finished. The ray and
+        point layer only describe the output and stay empty. observer and cancelToken
+        as in calcExposure, a cancelled calculation leaves the files with the finished
+        islands"""
+        self.logger.info('Start calculation of the wave exposure (streaming)')
+
+        self.createOutputLayers(allIslands)
+        tracker = ProgressTracker(observer, cancelToken, len(visitedIslands.fids))
+        raysPerIsland = len(self.getAngles())
+        tracker.check()
+
+        pointWriter, lineWriter = self.openOutputWriters(pointFile, lineFile)
+
+        try:
+            #The writing is part of the calculate timer in this mode
+            with self.metrics.timer('calculate'), closing(self.iterExposure(visitedIslands, allIslands)) as results:
+                for fid, rayGeometry, pointGeometry in results:
+                    if lineWriter is not None:
+                        lineWriter.write(rayGeometry)
+                    if pointWriter is not None:
+                        pointWriter.write(pointGeometry)
+                    tracker.islandDone(fid, raysPerIsland)
+            tracker.finish()
+        finally:
+            for writer in (pointWriter, lineWriter):
+                if writer is not None:
+                    writer.close()
+
+
+    def iterExposure(self,visitedIslands,allIslands,useCache = True):
+        """Yields (fid, rayGeometry, pointGeometry) for every visited island as soon as
+        its rays are calculated. The geometries are ShpHelper.Geometry objects with the
+        attributes of the island and the fields FID and Exposure"""
+        metrics = self.metrics
+
+        for fid, centroid, rays in self.iterRays(visitedIslands, allIslands, useCache):
             exposureIsland = 0.0
             rayGeomList = []
 
-            for curDeg in frange(0,360,self.deg):
-                print('Current degree: %d' % curDeg)
-
-                #Calculating the coordinate of the end point (depending on length)
-                endPointx=centroid.x+(math.cos(math.radians(curDeg))*self.length)
-                endPointy=centroid.y+(math.sin(math.radians(curDeg))*self.length)
-
-
-                rayLong = LineString([(centroid.x,centroid.y),(endPointx,endPointy)])
-
-                distance = self.length
-
-                closestIntersectingPoint = None
-                
-
-                for ifid, igeom in allIslands.geometries.items():
-                    if fid != ifid:
-                        ipoly = igeom.getGeometry()
-                        #checks if the previous created ray intersects with the boundary of an island
-                        if rayLong.intersects(ipoly):
-                            self.logger.debug("Line (%s) intersects with polygon (%s)" %(fid, ifid))
-                            intersections = (rayLong.intersection(ipoly.boundary))
-
-                            if intersections.geom_type == 'MultiPoint':
-                                for poi in intersections:
-                                    tempDistance = centroid.distance(poi)
-                                    self.logger.debug("Intersection is a MultiPoint")
-
-                                    if tempDistance < distance:
-                                        distance = tempDistance
-                                        closestIntersectingPoint = poi
-                            elif intersections.geom_type == 'Point':
-                                tempDistance = centroid.distance(intersections)
-                                self.logger.debug("Intersection is onnly a point")
-
-                                if tempDistance < distance:
-                                    distance = tempDistance
-                                    closestIntersectingPoint = intersections
-                            else:
-                                self.logger.debug("No intersections")
-                    else:
-                        pass
-
-                self.logger.debug("Length of the ray: %f" % distance)
-                
+            for distance, endPoint in rays:
                 exposureIsland += distance
-
-                if distance != self.length:
-                    self.logger.debug('Create LineString: %s,%s' % ((centroid.x,closestIntersectingPoint.x),(centroid.y,closestIntersectingPoint.y)))
-                    rayGeomList.append(LineString([(centroid.x,centroid.y),(closestIntersectingPoint.x,closestIntersectingPoint.y)]))
-                else:
-                    self.logger.debug('Create LineString: %s,%s' % ((centroid.x,endPointx),(centroid.y,endPointy)))
-                    rayGeomList.append(LineString([(centroid.x,centroid.y),(endPointx,endPointy)]))
-            
+                rayGeomList.append(LineString([(centroid.x,centroid.y),endPoint]))
 
             #Create MultiLine geometry
-            self.logger.debug('Create the MultiLine geometry')
-            self.logger.debug('List: %s' % rayGeomList)
             rayMultiLine = MultiLineString(rayGeomList)
 
-            self.logger.debug('MultiLineString: %s' % rayMultiLine.length)
-            
-            rayAttributes = allIslands.getGeometryByFID(fid).getAttributes()
+            metrics.count('islands')
+            metrics.count('rays', len(rayGeomList))
+
+            rayAttributes = dict(allIslands.getGeometryByFID(fid).getAttributes())
             rayAttributes['FID'] = fid
             rayAttributes['Exposure'] = exposureIsland
 
-            
-            
-
-            self.rayLayer.addGeometry(fid,Geometry(rayMultiLine,fid,rayAttributes))
-
-
             #Create Point geometry
-            self.logger.debug('Create Point geometry')
-
-            centroidAttributes = allIslands.getGeometryByFID(fid).getAttributes()
+            centroidAttributes = dict(allIslands.getGeometryByFID(fid).getAttributes())
             centroidAttributes['FID'] = fid
             centroidAttributes['Exposure'] = exposureIsland
 
-            self.pointLayer.addGeometry(fid,Geometry(centroid,fid,centroidAttributes))
+            yield fid, Geometry(rayMultiLine,fid,rayAttributes), Geometry(centroid,fid,centroidAttributes)
+
+
+    def iterRays(self,visitedIslands,allIslands,useCache = True):
+        """Yields (fid, centroid, rays) for all visited islands in the order of the layer.
+        rays is the result of castRays of the ray caster for all directions. With the
+        incremental mode (and useCache) only the rays missing in the ray cache are cast"""
+        angles = self.getAngles()
+        sites = [(fid, geom.getCentroid()) for fid, geom in visitedIslands.geometries.items()]
+
+        if self.rayCache is None or not useCache:
+            yield from self.castSites([(fid, centroid, angles) for fid, centroid in sites], allIslands)
+            return
+
+        self.rayCache.update(visitedIslands, allIslands, self.getRayCacheKey())
+        work = []
+        for fid, centroid in sites:
+            missing = self.rayCache.missingAngles(fid, angles, self.length)
+            if missing:
+                work.append((fid, centroid, missing))
+
+        self.logger.info('Ray cache: casting %i of %i rays' % (sum(len(site[2]) for site in work), len(sites) * len(angles)))
+
+        results = self.castSites(work, allIslands)
+        pending = iter(work)
+        nextWork = next(pending, None)
+
+        for fid, centroid in sites:
+            if nextWork is not None and nextWork[0] == fid:
+                castFid, castCentroid, rays = next(results)
+                self.rayCache.store(fid, nextWork[2], rays, self.length)
+                nextWork = next(pending, None)
+
+            yield fid, centroid, self.rayCache.getRays(fid, centroid, angles, self.length)
+
+        #The islands are decoded by now, read the bounds of the new islands
+        self.rayCache.resolveBounds()
+
+
+    def castSites(self,sites,allIslands):
+        """Casts the rays of a list of (fid, centroid, angles) and yields (fid, centroid, rays)
+        in the order of the list"""
+        if self.workers > 1 and len(sites) > 1:
+            yield from self.castSitesParallel(sites, allIslands)
+        elif sites:
+            rayCaster = self.createRayCaster(allIslands)
+            try:
+                for fid, centroid, angles in sites:
+                    yield fid, centroid, rayCaster.castRays(fid, centroid, angles)
+            finally:
+                self.metrics.addCounts(rayCaster.popStats())
+
+
+    def castSitesParallel(self,sites,allIslands):
+        """Distributes the sites in chunks over a pool of worker processes. The results
+        are yielded in the order of the sites independent of the order of completion"""
+        fids = list(allIslands.fids)
+        buffer, offsets = packWkb(allIslands.geomColumn)
+
+        #Several chunks per worker to balance islands with a different number of neighbours
+        chunkSize = max(1, math.ceil(len(sites) / (self.workers * 4)))
+        chunks = [sites[i:i+chunkSize] for i in range(0, len(sites), chunkSize)]
+        self.logger.info('Calculate %i islands in %i chunks with %i workers' % (len(sites), len(chunks), self.workers))
+
+        tasks = [[(fid, centroid.x, centroid.y, angles) for fid, centroid, angles in chunk] for chunk in chunks]
+
+        executor = ProcessPoolExecutor(max_workers = self.workers,
+                                       initializer = _initWorker,
+                                       initargs = (fids, buffer, offsets, self.length, self.engine,
+                                                   self.simplifyTolerance, self.cellSize))
+        try:
+            for chunk, (results, stats) in zip(chunks, executor.map(_castChunk, tasks)):
+                self.metrics.addCounts(stats)
+                for (fid, centroid, angles), rays in zip(chunk, results):
+                    yield fid, centroid, rays
+        finally:
+            #Chunks which haven't started yet are dropped if the generator is closed early
+            executor.shutdown(cancel_futures = True)
+
+
+    def iterPointBatches(self,xs,ys,allIslands,batchSize):
+        """Casts the rays of sample points (coordinate sequences) in batches and yields the
+        distances (batch x directions) of every batch in order. The ray caster (with its
+        index of the islands) is created once and reused for all batches, with several
+        workers once per worker process"""
+        angles = self.getAngles()
+        batches = [(xs[i:i+batchSize], ys[i:i+batchSize], angles) for i in range(0, len(xs), batchSize)]
+
+        if self.workers > 1 and len(batches) > 1:
+            fids = list(allIslands.fids)
+            buffer, offsets = packWkb(allIslands.geomColumn)
+            self.logger.info('Calculate %i points in %i batches with %i workers' % (len(xs), len(batches), self.workers))
+
+            executor = ProcessPoolExecutor(max_workers = self.workers,
+                                           initializer = _initWorker,
+                                           initargs = (fids, buffer, offsets, self.length, self.engine,
+                                                       self.simplifyTolerance, self.cellSize))
+            try:
+                for distances, stats in executor.map(_castPointBatch, batches):
+                    self.metrics.addCounts(stats)
+                    yield distances
+            finally:
+                executor.shutdown(cancel_futures = True)
+        elif batches:
+            rayCaster = self.createRayCaster(allIslands)
+            try:
+                for batch in batches:
+                    yield rayCaster.castPoints(*batch)
+            finally:
+                self.metrics.addCounts(rayCaster.popStats())
+
+
+    def openOutputWriters(self, pointFile = None, lineFile = None):
+        """Returns the writers (pointWriter, lineWriter) of the output files (None for
+        a missing file), see ShpHelper.Layer.openWriter for the formats. If both are
+        the same GeoPackage it gets the layers points and rays in one transaction,
+        which is committed when both writers are closed"""
+        if pointFile is not None and pointFile == lineFile:
+            if os.path.splitext(pointFile)[1].lower() != '.gpkg':
+                raise ValueError('Only a GeoPackage can hold the points and the rays in one file: %s' % pointFile)
+            package = GeoPackage(pointFile)
+            return package.openWriter(self.pointLayer, 'points'), package.openWriter(self.rayLayer, 'rays')
+
+        pointWriter = self.pointLayer.openWriter(pointFile, layerName = 'points') if pointFile is not None else None
+        lineWriter = self.rayLayer.openWriter(lineFile, layerName = 'rays') if lineFile is not None else None
+        return pointWriter, lineWriter
+
+
+    def saveLayers(self, pointFile = None, lineFile = None):
+        """Saves the point and/or the ray layer, in one transaction if both files are
+        the same GeoPackage (see openOutputWriters)"""
+        if self.pointLayer is None or self.rayLayer is None:
+            self.logger.error('The layers can\'t be saved because they are None. Start the exposure calculation to create the Layers first')
+            raise TypeError('The layers can\'t be saved because they are None. Start the exposure calculation to create the Layers first')
+
+        with self.metrics.timer('write'):
+            pointWriter, lineWriter = self.openOutputWriters(pointFile, lineFile)
+            try:
+                if pointWriter is not None:
+                    pointWriter.writeAll(self.pointLayer.geometries.values())
+                if lineWriter is not None:
+                    lineWriter.writeAll(self.rayLayer.geometries.values())
+            finally:
+                for writer in (pointWriter, lineWriter):
+                    if writer is not None:
+                        writer.close()
 
 
     def saveMultiLineLayer(self, filePath):
         if self.rayLayer is not None:
-            self.rayLayer.writeShp(filePath)
+            with self.metrics.timer('write'):
+                self.rayLayer.writeShp(filePath, layerName = 'rays')
         else:
             self.logger.error('MultiLine layer can\'t be saved because it is None. Start the exposure calculation to create the Layer first')
             raise TypeError('MultiLine layer can\'t be saved because it is None. Start the exposure calculation to create the Layer first')
@@ -230,7 +829,8 @@ class WaveExposure:
 
     def savePointLayer(self, filePath):
         if self.pointLayer is not None:
-            self.pointLayer.writeShp(filePath)
+            with self.metrics.timer('write'):
+                self.pointLayer.writeShp(filePath, layerName = 'points')
         else:
             self.logger.error('Point layer can\'t be saved because it is None. Start the exposure calculation to create the Layer first')
             raise TypeError('Point layer can\'t be saved because it is None. Start the exposure calculation to create the Layer first')
@@ -238,28 +838,14 @@ class WaveExposure:
 
 
 def main():
-    logging.config.fileConfig('logging.conf')
-
-    exposure = WaveExposure()
-
-    exposure.setSourceFile('gis/Vaestervik.shp')#dirk/gis/islands.shp')
-
-    exposure.setFilter('visited = 1')
-
-    exposure.startExposureCalculation()
-
-    exposure.savePointLayer('gis/points.shp')
-
-    exposure.saveMultiLineLayer('gis/multi.shp')
-    
-    #for key, point in visitedGeomDict.items():
-    #   print('x: %f   y: %f' % (point.x,point.y))
-    #geomtools.calcExposure(visitedIslands,allIslands,LENGTH,DEG)
+    #The command line interface (ExposureCli) replaces the former hardcoded run
+    import ExposureCli
+    return ExposureCli.main()
 
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
     #print ('Start calculation')
 
     #logging.basicConfig(level=logging.DEBUG)
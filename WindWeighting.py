@@ -0,0 +1,283 @@
+"""
+Exposure weighted by the wind per direction (GREMO)
+
+GREMO weights the fetch of every direction by the frequency and the speed of the
+wind from that direction. The fetches (ray distances) of the sites are calculated
+once and stored per direction in a FetchTable; any number of weighting scenarios
+(seasons, years, ...) is then evaluated with one matrix product
+
+    weighted exposure (sites x scenarios) = fetches (sites x directions) . weights (directions x scenarios)
+
+without casting rays again. The stored fetches keep the settings they were calculated
+with (source, filter, ray length, degree and engine) and are only reused with the same
+settings. A scenario is a table of sectors with the direction the
+wind comes from (compass bearing in degree, 0 = north, clockwise), its frequency and
+its mean speed. Every ray belongs to the sector with the nearest direction and gets
+frequency * speed / (rays of the sector), so the weighted exposure of a site is the
+sum of frequency * speed * mean fetch over the sectors. The CSV has the columns
+scenario (optional), direction, frequency and speed:
+
+    scenario,direction,frequency,speed
+    winter,0,12.5,8.1
+    winter,45,9.0,7.4
+    ...
+
+    python WindWeighting.py gis/Vaestervik.shp --filter "visited = 1" --wind wind.csv \
+        --fetches gis/fetches.npz --output gis/weighted.csv
+"""
+
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+
+from WaveExposure import WaveExposure
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def compassBearing(angle):
+    """Returns the compass bearing (0 = north, clockwise) of a ray direction in degree
+    (0 = east, counterclockwise, see RayCasting.directionAngles)"""
+    return (90.0 - angle) % 360.0
+
+
+
+def angularDistance(a, b):
+    """Returns the distance of two directions in degree (0 to 180)"""
+    distance = abs(a - b) % 360.0
+    return min(distance, 360.0 - distance)
+
+
+
+class WindWeighting:
+    """
+    Weighting scenarios of the exposure: per scenario the sectors with the direction
+    (compass bearing the wind comes from), frequency and speed of the wind
+    """
+
+    #Name of the scenario of a CSV without scenario column
+    defaultScenario = 'weighted'
+
+    def __init__(self, logger = None):
+        self.logger = logger or logging.getLogger(__name__+'.WindWeighting')
+        self.scenarios = {}
+
+
+    def addSector(self, scenario, direction, frequency, speed):
+        """Adds a sector to a scenario (created with its first sector)"""
+        if frequency < 0 or speed < 0:
+            raise ValueError('Frequency and speed of the sector %s of %s have to be positive' % (direction, scenario))
+        self.scenarios.setdefault(scenario, []).append((float(direction) % 360.0, float(frequency), float(speed)))
+
+
+    def loadCsv(self, filePath):
+        """Adds the sectors of a CSV file with the columns scenario (optional),
+        direction, frequency and speed"""
+        with open(filePath, newline = '') as f:
+            reader = csv.DictReader(f)
+            columns = {name.strip().lower(): name for name in reader.fieldnames or []}
+            missing = [name for name in ('direction', 'frequency', 'speed') if name not in columns]
+            if missing:
+                raise ValueError('%s has no column %s' % (filePath, ', '.join(missing)))
+
+            for row in reader:
+                scenario = row[columns['scenario']].strip() if 'scenario' in columns else self.defaultScenario
+                self.addSector(scenario, float(row[columns['direction']]), float(row[columns['frequency']]),
+                               float(row[columns['speed']]))
+
+        self.logger.info('Loaded %i weighting scenarios from %s' % (len(self.scenarios), filePath))
+
+
+    def getScenarios(self):
+        """Returns the names of the scenarios in the order they were added"""
+        return list(self.scenarios.keys())
+
+
+    def weightMatrix(self, angles):
+        """Returns the weights (directions x scenarios) of the rays with the given
+        directions (degree, see RayCasting.directionAngles)"""
+        if np is None:
+            raise ImportError('The wind weighting requires numpy')
+
+        bearings = [compassBearing(angle) for angle in angles]
+        weights = np.zeros((len(angles), len(self.scenarios)))
+
+        for column, (scenario, sectors) in enumerate(self.scenarios.items()):
+            #Every ray belongs to the sector with the nearest direction
+            members = {}
+            for row, bearing in enumerate(bearings):
+                sector = min(range(len(sectors)), key = lambda i: angularDistance(bearing, sectors[i][0]))
+                members.setdefault(sector, []).append(row)
+
+            for sector, (direction, frequency, speed) in enumerate(sectors):
+                rows = members.get(sector)
+                if not rows:
+                    self.logger.warning('No ray in the sector %s of %s, use a smaller degree between the rays' % (direction, scenario))
+                    continue
+                weights[rows, column] = frequency * speed / len(rows)
+
+        return weights
+
+
+
+class FetchTable:
+    """
+    The fetch (ray distance) of every site and direction: the fids of the sites, the
+    directions in degree (see RayCasting.directionAngles) and the distances
+    (sites x directions). settings are the settings of the WaveExposure the fetches
+    were calculated with (see getSettings)
+    """
+
+    def __init__(self, fids, angles, distances, settings = None, logger = None):
+        if np is None:
+            raise ImportError('The fetch table requires numpy')
+
+        self.logger = logger or logging.getLogger(__name__+'.FetchTable')
+        self.fids = list(fids)
+        self.angles = [float(angle) for angle in angles]
+        self.distances = np.asarray(distances, dtype = np.float64).reshape(len(self.fids), len(self.angles))
+        self.settings = dict(settings or {})
+
+
+    @staticmethod
+    def getSettings(exposure):
+        """Returns the settings of a WaveExposure the fetches depend on: the source (see
+        WaveExposure.hashSource, left out without a source file), the filter, the ray
+        length, the degree and the engine"""
+        settings = {'filter': exposure.getFilter(), 'length': float(exposure.getRayLength()),
+                    'degree': float(exposure.getDegree()), 'engine': exposure.getRayCacheKey()}
+        if exposure.sourceFile is not None:
+            settings['source'] = exposure.hashSource()
+        return settings
+
+
+    def getMismatches(self, settings):
+        """Returns the names of the settings which differ from the settings the fetches
+        were calculated with (unknown settings of older files differ as well)"""
+        return [name for name, value in settings.items() if name not in self.settings or self.settings[name] != value]
+
+
+    @classmethod
+    def fromExposure(cls, exposure, visitedIslands = None, allIslands = None):
+        """Casts the rays of the visited islands (default: the loaded islands of the
+        WaveExposure, see loadIslandData) and returns their fetches"""
+        visitedIslands = visitedIslands if visitedIslands is not None else exposure.visitedIslands
+        allIslands = allIslands if allIslands is not None else exposure.allIslandsLayer
+        angles = exposure.getAngles()
+
+        fids = []
+        distances = np.empty((len(visitedIslands.fids), len(angles)))
+        with exposure.metrics.timer('calculate'):
+            for row, (fid, centroid, rays) in enumerate(exposure.iterRays(visitedIslands, allIslands)):
+                fids.append(fid)
+                distances[row] = [distance for distance, endPoint in rays]
+
+        return cls(fids, angles, distances, cls.getSettings(exposure))
+
+
+    @classmethod
+    def load(cls, filePath):
+        """Loads a table stored with save"""
+        with np.load(filePath) as data:
+            settings = json.loads(str(data['settings'])) if 'settings' in data.files else None
+            return cls(data['fids'].tolist(), data['angles'].tolist(), data['distances'], settings)
+
+
+    def save(self, filePath):
+        """Stores the table with its settings as .npz file"""
+        with open(filePath, 'wb') as f:
+            np.savez(f, fids = np.asarray(self.fids, dtype = np.int64), angles = np.asarray(self.angles),
+                     distances = self.distances, settings = np.asarray(json.dumps(self.settings)))
+
+
+    def exposure(self):
+        """Returns the unweighted exposure (sum of the fetches) of the sites"""
+        return self.distances.sum(axis = 1)
+
+
+    def weightedExposure(self, weighting):
+        """Returns the weighted exposure (sites x scenarios) of all scenarios of a
+        WindWeighting"""
+        return self.distances @ weighting.weightMatrix(self.angles)
+
+
+    def writeCsv(self, filePath, weighting):
+        """Writes the fid, the unweighted exposure and the weighted exposure of every
+        scenario of the sites into a CSV file"""
+        weighted = self.weightedExposure(weighting)
+        exposure = self.exposure()
+
+        with open(filePath, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['fid', 'Exposure'] + weighting.getScenarios())
+            for row, fid in enumerate(self.fids):
+                writer.writerow([fid, float(exposure[row])] + [float(value) for value in weighted[row]])
+
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Calculates the exposure weighted by the wind per direction for many scenarios')
+    parser.add_argument('source', nargs = '?', help = 'Vector file with the island polygons (optional with existing --fetches, which are then not checked against the source)')
+    parser.add_argument('--wind', required = True, help = 'CSV with the columns scenario, direction, frequency and speed')
+    parser.add_argument('--fetches', default = None,
+                        help = 'File (.npz) with the fetches of the sites, calculated and stored if it doesn\'t exist '
+                               'or was calculated with other settings')
+    parser.add_argument('--output', required = True, help = 'Output CSV with the weighted exposure per scenario')
+    parser.add_argument('--filter', default = None, help = 'Attribute filter selecting the sites, e.g. "visited = 1"')
+    parser.add_argument('--length', type = float, default = WaveExposure.length)
+    parser.add_argument('--degree', type = float, default = WaveExposure.deg)
+    parser.add_argument('--engine', choices = WaveExposure.engines, default = WaveExposure.engine)
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--log-level', default = 'INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = args.log_level.upper(), stream = sys.stderr,
+                        format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    weighting = WindWeighting()
+    weighting.loadCsv(args.wind)
+
+    exposure = WaveExposure()
+    if args.source is not None:
+        exposure.setSourceFile(args.source)
+    exposure.setFilter(args.filter)
+    exposure.setRayLength(args.length)
+    exposure.setDegree(args.degree)
+    exposure.setEngine(args.engine)
+    exposure.setWorkers(args.workers)
+
+    fetches = None
+    if args.fetches is not None and os.path.exists(args.fetches):
+        fetches = FetchTable.load(args.fetches)
+        mismatches = fetches.getMismatches(FetchTable.getSettings(exposure))
+        if mismatches and args.source is None:
+            parser.error('The fetches in %s were calculated with other settings (%s), give the source file to calculate them again'
+                         % (args.fetches, ', '.join(mismatches)))
+        elif mismatches:
+            logging.getLogger(__name__).warning('The fetches in %s were calculated with other settings (%s), calculating them again'
+                                                % (args.fetches, ', '.join(mismatches)))
+            fetches = None
+
+    if fetches is None:
+        if args.source is None:
+            parser.error('A source file is required to calculate the fetches')
+
+        exposure.loadIslandData()
+
+        fetches = FetchTable.fromExposure(exposure)
+        if args.fetches is not None:
+            fetches.save(args.fetches)
+
+    fetches.writeCsv(args.output, weighting)
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Generator of synthetic archipelagos for benchmarks
+
+Creates star shaped island polygons with a configurable number of islands, vertices
+per polygon and clustering and writes them as shape file with the fields used by
+WaveExposure (visited, name).
+
+    python benchmarks/Archipelago.py /tmp/archipelago.shp --islands 10000 --vertices 64
+"""
+
+import os
+import sys
+import math
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shapely.geometry import Polygon
+
+from ShpHelper import Layer
+
+
+def createIsland(x, y, radius, vertices, rng):
+    """Returns a star shaped polygon around (x, y) with the given number of vertices"""
+    coords = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        r = radius * rng.uniform(0.6, 1.0)
+        coords.append((x + math.cos(angle) * r, y + math.sin(angle) * r))
+    return Polygon(coords)
+
+
+def generateArchipelago(islands = 1000, vertices = 32, clustering = 0.5, extent = 50000.0,
+                        radius = (20.0, 300.0), visitedShare = 0.1, origin = (500000.0, 6400000.0),
+                        seed = 0, srs = None):
+    """
+    Returns a Layer with synthetic island polygons.
+
+    islands      number of polygons
+    vertices     number of vertices per polygon
+    clustering   0 = islands spread uniformly over the extent, 1 = islands in tight clusters
+    extent       width and height of the area in m
+    radius       (min, max) radius of the islands in m
+    visitedShare share of the islands with visited = 1
+    """
+    rng = random.Random(seed)
+
+    #Cluster centres, the spread of the islands around them shrinks with the clustering
+    clusters = [(rng.uniform(0, extent), rng.uniform(0, extent)) for i in range(max(1, islands // 100))]
+    spread = extent * max(0.01, 1.0 - clustering) / 2
+
+    layer = Layer()
+    layer.setGeometryType('Polygon')
+    layer.setSRS(srs)
+    layer.addField('visited', 'Integer')
+    layer.addField('name', 'String')
+
+    for fid in range(islands):
+        if clustering <= 0:
+            x, y = rng.uniform(0, extent), rng.uniform(0, extent)
+        else:
+            cx, cy = rng.choice(clusters)
+            x = min(max(rng.gauss(cx, spread), 0), extent)
+            y = min(max(rng.gauss(cy, spread), 0), extent)
+
+        polygon = createIsland(origin[0] + x, origin[1] + y, rng.uniform(*radius), vertices, rng)
+        attributes = {'visited': 1 if rng.random() < visitedShare else 0, 'name': 'Island %i' % fid}
+        layer.addRow(fid, polygon, attributes)
+
+    return layer
+
+
+def metricSRS(epsg = 3006):
+    """Returns the OGR spatial reference of a metric projection (default SWEREF99 TM)"""
+    import osr
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    return srs
+
+
+def writeArchipelago(filePath, **kwargs):
+    """Generates an archipelago (see generateArchipelago) and writes it as shape file"""
+    kwargs.setdefault('srs', metricSRS())
+    layer = generateArchipelago(**kwargs)
+    layer.writeShp(filePath)
+    return layer
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Writes a synthetic archipelago as shape file')
+    parser.add_argument('path', help = 'Output shape file')
+    parser.add_argument('--islands', type = int, default = 1000)
+    parser.add_argument('--vertices', type = int, default = 32)
+    parser.add_argument('--clustering', type = float, default = 0.5)
+    parser.add_argument('--extent', type = float, default = 50000.0)
+    parser.add_argument('--visited-share', type = float, default = 0.1)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    writeArchipelago(args.path, islands = args.islands, vertices = args.vertices, clustering = args.clustering,
+                     extent = args.extent, visitedShare = args.visited_share, seed = args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Benchmark suite of the wave exposure calculation
+
+Generates a synthetic archipelago (see Archipelago.py) as shape file in a temporary
+directory and times the stages
+
+    load       Layer.loadShp and the selection of the visited islands
+    calculate  WaveExposure.calcExposure for every degree/length setting
+    write      savePointLayer and saveMultiLineLayer
+
+reporting the wall time and rays per second of every stage. With --trace-memory the
+peak of the Python heap (including NumPy arrays) during every stage is reported as
+well. The peak resident set size is the peak of the process up to the end of a stage
+(it never decreases, so it only shows the memory of a stage if that is larger than
+all before) and doesn't include worker processes.
+
+    python benchmarks/BenchExposure.py --islands 5000 --vertices 64 --settings 15:2000 5:2000 15:10000
+    python benchmarks/BenchExposure.py --engine numpy --workers 8 --json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from WaveExposure import WaveExposure
+
+from Archipelago import writeArchipelago
+
+
+def maxRSS():
+    """Returns the peak resident set size of the process since its start in MiB (None
+    if unknown)"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports KiB, macOS bytes
+    return rss / 1024.0 if sys.platform != 'darwin' else rss / 1024.0 / 1024.0
+
+
+class Stage:
+    """Context manager measuring the wall time of a stage, the peak of the Python heap
+    during the stage (traceMemory) and the peak resident set size of the process"""
+
+    def __init__(self, results, name, traceMemory = False, **info):
+        self.results = results
+        self.name = name
+        self.traceMemory = traceMemory
+        self.info = info
+
+    def __enter__(self):
+        if self.traceMemory:
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        result = dict(self.info)
+        result['stage'] = self.name
+        result['seconds'] = time.perf_counter() - self.start
+        result['processPeakRssMiB'] = maxRSS()
+        if self.traceMemory:
+            result['pythonPeakMiB'] = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+        if 'rays' in result and result['seconds'] > 0:
+            result['raysPerSecond'] = result['rays'] / result['seconds']
+        self.results.append(result)
+        return False
+
+
+def parseSetting(value):
+    """Parses a degree:length setting"""
+    deg, length = value.split(':')
+    return float(deg), float(length)
+
+
+def runBenchmark(args):
+    results = []
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'archipelago.shp')
+        writeArchipelago(source, islands = args.islands, vertices = args.vertices, clustering = args.clustering,
+                         extent = args.extent, visitedShare = args.visited_share, seed = args.seed)
+
+        exposure = WaveExposure()
+        exposure.setSourceFile(source)
+        exposure.setFilter('visited = 1')
+        exposure.setEngine(args.engine)
+        exposure.setWorkers(args.workers)
+
+        with Stage(results, 'load', args.trace_memory):
+            exposure.loadIslandData()
+
+        sites = len(exposure.visitedIslands.geometries)
+
+        for deg, length in args.settings:
+            exposure.setDegree(deg)
+            exposure.setRayLength(length)
+            rays = sites * len(exposure.getAngles())
+
+            with Stage(results, 'calculate', args.trace_memory, degree = deg, length = length, sites = sites, rays = rays):
+                exposure.calcExposure(exposure.visitedIslands, exposure.allIslandsLayer)
+
+        with Stage(results, 'write', args.trace_memory, sites = sites):
+            exposure.savePointLayer(os.path.join(directory, 'points.shp'))
+            exposure.saveMultiLineLayer(os.path.join(directory, 'lines.shp'))
+
+    return results
+
+
+def printResults(results):
+    print('%-10s %8s %8s %8s %10s %12s %14s %18s' % ('stage', 'degree', 'length', 'sites', 'seconds', 'rays/s',
+                                                     'heap peak MiB', 'process peak MiB'))
+    for result in results:
+        print('%-10s %8s %8s %8s %10.3f %12s %14s %18s' % (result['stage'],
+                                                         result.get('degree', ''),
+                                                         result.get('length', ''),
+                                                         result.get('sites', ''),
+                                                         result['seconds'],
+                                                         '%.0f' % result['raysPerSecond'] if result.get('raysPerSecond') else '',
+                                                         '%.1f' % result['pythonPeakMiB'] if 'pythonPeakMiB' in result else '',
+                                                         '%.1f' % result['processPeakRssMiB'] if result['processPeakRssMiB'] is not None else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark of the wave exposure calculation on a synthetic archipelago')
+    parser.add_argument('--islands', type = int, default = 2000, help = 'Number of islands (default: %(default)s)')
+    parser.add_argument('--vertices', type = int, default = 32, help = 'Vertices per island (default: %(default)s)')
+    parser.add_argument('--clustering', type = float, default = 0.5, help = '0 = uniform, 1 = tight clusters (default: %(default)s)')
+    parser.add_argument('--extent', type = float, default = 50000.0, help = 'Size of the area in m (default: %(default)s)')
+    parser.add_argument('--visited-share', type = float, default = 0.1, help = 'Share of visited islands (default: %(default)s)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--settings', type = parseSetting, nargs = '+', default = [(15.0, 2000.0), (5.0, 2000.0), (15.0, 10000.0)],
+                        help = 'degree:length settings of the calculation (default: 15:2000 5:2000 15:10000)')
+    parser.add_argument('--engine', choices = WaveExposure.engines, default = WaveExposure.engine)
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--trace-memory', action = 'store_true', help = 'Report the peak of the Python heap of every stage (slower)')
+    parser.add_argument('--json', default = None, help = 'Write the results as JSON into this file')
+    args = parser.parse_args()
+
+    results = runBenchmark(args)
+    printResults(results)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': {key: value for key, value in vars(args).items()}, 'results': results}, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
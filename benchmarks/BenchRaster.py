@@ -0,0 +1,133 @@
+"""
+Comparison of the raster engine with the vector engines
+
+Casts the rays of the visited islands of a synthetic archipelago (see Archipelago.py)
+with a vector engine as reference and with the raster engine for several cell sizes
+and reports the time and the error of the rays:
+
+    seconds    time to build the ray caster (rasterization) and cast all rays
+    median     median absolute error of the ray distances in m
+    p95        95th percentile of the absolute error in m
+    flips      rays blocked in one engine and free in the other
+    exposure   mean relative error of the exposure of the islands
+
+Islands of the synthetic archipelago can overlap, which a label grid can't represent
+(a cell belongs to one island). Visited islands overlapping others are left out.
+
+    python benchmarks/BenchRaster.py --islands 2000 --cell-sizes 20 10 5 2
+    python benchmarks/BenchRaster.py --reference shapely --json raster.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from WaveExposure import WaveExposure
+from ShpHelper import Layer
+
+from Archipelago import generateArchipelago
+
+
+def castAll(exposure, visitedIslands, allIslands):
+    """Returns {fid: rays} of all visited islands and the seconds it took"""
+    start = time.perf_counter()
+    rays = {fid: result for fid, centroid, result in exposure.iterRays(visitedIslands, allIslands)}
+    return rays, time.perf_counter() - start
+
+
+def compare(reference, rays, length):
+    """Returns the error statistics of rays against the reference rays"""
+    errors = []
+    flips = 0
+    exposureErrors = []
+    for fid, referenceRays in reference.items():
+        for (referenceDistance, referencePoint), (distance, point) in zip(referenceRays, rays[fid]):
+            errors.append(abs(distance - referenceDistance))
+            if (referenceDistance < length) != (distance < length):
+                flips += 1
+
+        referenceExposure = sum(ray[0] for ray in referenceRays)
+        exposure = sum(ray[0] for ray in rays[fid])
+        exposureErrors.append(abs(exposure - referenceExposure) / referenceExposure if referenceExposure else 0.0)
+
+    errors.sort()
+    return {'median': errors[len(errors) // 2] if errors else 0.0,
+            'p95': errors[int(len(errors) * 0.95)] if errors else 0.0,
+            'max': errors[-1] if errors else 0.0,
+            'flips': flips,
+            'rays': len(errors),
+            'exposure': sum(exposureErrors) / len(exposureErrors) if exposureErrors else 0.0}
+
+
+def runBenchmark(args):
+    allIslands = generateArchipelago(islands = args.islands, vertices = args.vertices, clustering = args.clustering,
+                                     extent = args.extent, visitedShare = args.visited_share, seed = args.seed)
+    visited = allIslands.filterLayer('visited = 1')
+
+    visitedIslands = Layer()
+    visitedIslands.setFields(dict(visited.getFields()))
+    for row, fid in enumerate(visited.fids):
+        geom = visited.geomColumn[row]
+        if not any(other != fid and allIslands.geometries[other].getGeometry().intersects(geom)
+                   for other in allIslands.queryFids(geom)):
+            visitedIslands.addRow(fid, geom, visited.getRowAttributes(row))
+
+    exposure = WaveExposure()
+    exposure.setRayLength(args.length)
+    exposure.setDegree(args.degree)
+    exposure.setEngine(args.reference)
+    reference, seconds = castAll(exposure, visitedIslands, allIslands)
+
+    results = [{'engine': args.reference, 'cellSize': None, 'seconds': seconds}]
+
+    exposure.setEngine('raster')
+    for cellSize in args.cell_sizes:
+        exposure.setCellSize(cellSize)
+        rays, seconds = castAll(exposure, visitedIslands, allIslands)
+        result = {'engine': 'raster', 'cellSize': cellSize, 'seconds': seconds}
+        result.update(compare(reference, rays, args.length))
+        results.append(result)
+
+    return results
+
+
+def printResults(results):
+    print('%-8s %8s %10s %10s %10s %8s %10s' % ('engine', 'cell', 'seconds', 'median', 'p95', 'flips', 'exposure'))
+    for result in results:
+        if result['cellSize'] is None:
+            print('%-8s %8s %10.3f' % (result['engine'], '', result['seconds']))
+        else:
+            print('%-8s %8s %10.3f %10.2f %10.2f %8i %9.2f%%' % (result['engine'], result['cellSize'], result['seconds'],
+                                                               result['median'], result['p95'], result['flips'],
+                                                               result['exposure'] * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compares the raster engine with a vector engine on a synthetic archipelago')
+    parser.add_argument('--islands', type = int, default = 2000)
+    parser.add_argument('--vertices', type = int, default = 64)
+    parser.add_argument('--clustering', type = float, default = 0.7)
+    parser.add_argument('--extent', type = float, default = 50000.0)
+    parser.add_argument('--visited-share', type = float, default = 0.1)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--length', type = float, default = 5000.0)
+    parser.add_argument('--degree', type = float, default = 5.0)
+    parser.add_argument('--reference', choices = ('shapely', 'numpy'), default = 'numpy', help = 'Vector engine of the reference')
+    parser.add_argument('--cell-sizes', type = float, nargs = '+', default = [20.0, 10.0, 5.0, 2.0])
+    parser.add_argument('--json', default = None, help = 'Write the results as JSON into this file')
+    args = parser.parse_args()
+
+    results = runBenchmark(args)
+    printResults(results)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
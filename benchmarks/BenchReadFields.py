@@ -0,0 +1,167 @@
+"""
+Benchmark of the attribute decoding of Layer.loadShp
+
+Writes a wide point table (by default 100 fields and 1 000 000 features, a third
+each integer, real and string fields) into a temporary GeoPackage or FlatGeobuf and
+reads it with
+
+    legacy   getFieldValueById per feature and field (the reader before the FieldDecoder)
+    decoder  the FieldDecoder with the field indices and getters resolved once
+    arrow    column batches of OGR's Arrow stream (GDAL >= 3.6 and pyarrow)
+
+and prints the features per second of every reader. Afterwards the attribute dicts of
+the decoder and the arrow reader are compared feature by feature, the benchmark fails
+if they differ (e.g. for NULL values with --nulls).
+
+    python benchmarks/BenchReadFields.py --features 1000000 --fields 100
+    python benchmarks/BenchReadFields.py --features 100000 --format fgb --select 5
+    python benchmarks/BenchReadFields.py --features 100000 --nulls 0.1
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ogr
+import osr
+
+import ShpHelper
+from ShpHelper import Layer
+from ShpHelper import Geometry
+from ShpHelper import getFieldValueById
+from ShpHelper import getLayerFieldNamesAndType
+
+#OGR drivers of the formats
+drivers = {'gpkg': 'GPKG', 'fgb': 'FlatGeobuf'}
+
+
+def writeTable(filePath, driverName, features, fields, nulls = 0.0, seed = 0):
+    """Writes a point layer with the given number of features and fields. nulls is
+    the fraction of NULL values"""
+    random.seed(seed)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3006)
+
+    driver = ogr.GetDriverByName(driverName)
+    source = driver.CreateDataSource(filePath)
+    layer = source.CreateLayer('table', srs, ogr.wkbPoint)
+
+    types = [ogr.OFTInteger, ogr.OFTReal, ogr.OFTString]
+    for i in range(fields):
+        layer.CreateField(ogr.FieldDefn('field%03i' % i, types[i % 3]))
+
+    layerDefn = layer.GetLayerDefn()
+    feature = ogr.Feature(layerDefn)
+    layer.StartTransaction()
+    for fid in range(features):
+        feature.SetFID(fid + 1)
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(random.uniform(500000, 600000), random.uniform(6400000, 6500000))
+        feature.SetGeometry(point)
+        for i in range(fields):
+            kind = i % 3
+            if nulls and random.random() < nulls:
+                feature.SetFieldNull(i)
+            elif kind == 0:
+                feature.SetField(i, fid + i)
+            elif kind == 1:
+                feature.SetField(i, fid * 0.5 + i)
+            else:
+                feature.SetField(i, 'value %i' % (fid % 1000))
+        layer.CreateFeature(feature)
+
+        if fid % 100000 == 99999:
+            layer.CommitTransaction()
+            layer.StartTransaction()
+    layer.CommitTransaction()
+    del source
+
+
+def readLegacy(filePath, fields):
+    """The reader before the FieldDecoder: getFieldValueById per feature and field"""
+    source = ogr.Open(filePath, 0)
+    layer = source.GetLayer(0)
+    allFields = getLayerFieldNamesAndType(layer)
+    names = [name for name in allFields if fields is None or name in fields]
+    count = 0
+    for feature in layer:
+        geometry = Geometry(feature.GetGeometryRef(), feature.GetFID(), {name: getFieldValueById(feature, name) for name in names})
+        count += 1
+    del source
+    return count
+
+
+def readLayer(filePath, fields, bulkRead):
+    layer = Layer()
+    layer.bulkRead = bulkRead
+    count = 0
+    for geometry in layer.iterShp(filePath, fields = fields):
+        count += 1
+    return count
+
+
+def compareReaders(filePath, fields):
+    """Reads the table with the decoder and the arrow reader at the same time and
+    raises an AssertionError at the first feature whose FID or attributes differ.
+    Returns the number of compared features"""
+    decoder = Layer()
+    decoder.bulkRead = False
+    arrow = Layer()
+    arrow.bulkRead = True
+
+    count = 0
+    for expected, geometry in itertools.zip_longest(decoder.iterShp(filePath, fields = fields), arrow.iterShp(filePath, fields = fields)):
+        if expected is None or geometry is None:
+            raise AssertionError('The readers return a different number of features')
+        if expected.fid != geometry.fid or expected.getAttributes() != geometry.getAttributes():
+            raise AssertionError('The readers differ at FID %s: %s != %s' % (expected.fid, expected.getAttributes(), geometry.getAttributes()))
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark of the attribute decoding of Layer.loadShp')
+    parser.add_argument('--features', type = int, default = 1000000, help = 'Number of features')
+    parser.add_argument('--fields', type = int, default = 100, help = 'Number of fields')
+    parser.add_argument('--format', choices = sorted(drivers), default = 'gpkg', help = 'Format of the table')
+    parser.add_argument('--select', type = int, default = None, help = 'Only read the first n fields')
+    parser.add_argument('--nulls', type = float, default = 0.0, help = 'Fraction of NULL values')
+    parser.add_argument('--readers', nargs = '+', default = ['legacy', 'decoder', 'arrow'], choices = ['legacy', 'decoder', 'arrow'])
+    args = parser.parse_args()
+
+    fields = ['field%03i' % i for i in range(args.select)] if args.select is not None else None
+
+    with tempfile.TemporaryDirectory() as directory:
+        filePath = os.path.join(directory, 'table.%s' % args.format)
+        start = time.perf_counter()
+        writeTable(filePath, drivers[args.format], args.features, args.fields, args.nulls)
+        print('Wrote %i features with %i fields in %.1f s' % (args.features, args.fields, time.perf_counter() - start))
+
+        canReadArrow = ShpHelper.pa is not None and hasattr(ogr.Layer, 'GetArrowStreamAsPyArrow')
+        for name in args.readers:
+            if name == 'arrow' and not canReadArrow:
+                print('%-8s requires GDAL >= 3.6 and pyarrow' % name)
+                continue
+
+            start = time.perf_counter()
+            if name == 'legacy':
+                count = readLegacy(filePath, fields)
+            else:
+                count = readLayer(filePath, fields, name == 'arrow')
+            duration = time.perf_counter() - start
+
+            print('%-8s %10i features %8.3f s %12.0f features/s' % (name, count, duration, count / duration))
+
+        if canReadArrow:
+            count = compareReaders(filePath, fields)
+            print('check    %10i features with the same attributes from decoder and arrow' % count)
+
+
+if __name__ == '__main__':
+    main()
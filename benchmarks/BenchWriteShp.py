@@ -0,0 +1,103 @@
+"""
+Benchmark of Layer.writeShp
+
+Writes the same point layer once with the former feature-by-feature writer and
+once with the batched LayerWriter and prints the rows per second of both.
+
+    python benchmarks/BenchWriteShp.py --rows 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ogr
+import osr
+
+from shapely import wkb
+from shapely.geometry import Point
+
+from ShpHelper import Layer
+from ShpHelper import Geometry
+from ShpHelper import GeomTypesOgr
+
+
+def writeShpLegacy(layer, filePath):
+    """The writer before the LayerWriter: one new ogr.Feature per row and a debug
+    line per attribute, without transactions"""
+    driver = ogr.GetDriverByName("ESRI Shapefile")
+    if os.path.exists(filePath):
+        driver.DeleteDataSource(filePath)
+
+    source = driver.CreateDataSource(filePath)
+    layerName = os.path.splitext(os.path.basename(filePath))[0]
+    ogrLayer = source.CreateLayer(layerName,layer.srs,GeomTypesOgr[layer.geometryType].value)
+
+    for fieldName, fieldType in layer.fields.items():
+        field = ogr.FieldDefn(fieldName, fieldType)
+        if fieldType == ogr.OFTString:
+            field.SetWidth(80)
+        ogrLayer.CreateField(field)
+
+    for fid, geometry in layer.geometries.items():
+        feature =  ogr.Feature(ogrLayer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb.dumps(geometry.geom)))
+        layer.logger.debug('Feature ID (Geometry): %s' % type(fid))
+        feature.SetFID(int(fid))
+        for attributeName, attributeValue in geometry.attributes.items():
+            layer.logger.debug('Attribute: %s Value:%s' % (attributeName, attributeValue))
+            feature.SetField(attributeName,attributeValue)
+        ogrLayer.CreateFeature(feature)
+        feature.Destroy()
+
+    del source
+
+
+def createLayer(rows, seed = 0):
+    """Creates a point layer with an integer, a float and a string field"""
+    random.seed(seed)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3006)
+
+    layer = Layer()
+    layer.setGeometryType('Point')
+    layer.setSRS(srs)
+    layer.addField('FID', 'String')
+    layer.addField('Exposure', 'Float')
+    layer.addField('visited', 'Integer')
+
+    for fid in range(rows):
+        attributes = {'FID': str(fid), 'Exposure': random.uniform(0, 48000), 'visited': fid % 2}
+        point = Point(random.uniform(500000, 600000), random.uniform(6400000, 6500000))
+        layer.addGeometry(fid, Geometry(point, fid, attributes))
+
+    return layer
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark of Layer.writeShp')
+    parser.add_argument('--rows', type = int, default = 100000, help = 'Number of features')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'Best of n runs')
+    args = parser.parse_args()
+
+    layer = createLayer(args.rows)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, write in (('legacy', writeShpLegacy), ('batched', Layer.writeShp)):
+            best = None
+            for run in range(args.repeat):
+                start = time.perf_counter()
+                write(layer, os.path.join(directory, '%s.shp' % name))
+                duration = time.perf_counter() - start
+                best = duration if best is None else min(best, duration)
+
+            print('%-8s %10i rows %8.3f s %12.0f rows/s' % (name, args.rows, best, args.rows / best))
+
+
+if __name__ == '__main__':
+    main()
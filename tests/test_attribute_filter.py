@@ -0,0 +1,140 @@
+"""
+The in-process attribute filter (ShpHelper.compileAttributeFilter) compared with the
+attribute filter of OGR on the same features
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+    import ogr
+except ImportError:
+    raise unittest.SkipTest('GDAL (ogr) is not installed')
+
+from ShpHelper import Layer
+from ShpHelper import compileAttributeFilter
+
+
+#Rows (visited, name, value, big), None is NULL
+rows = [(1, 'a', 1.5, 2 ** 40),
+        (0, '5', 0.0, 1),
+        (None, '05', None, None),
+        (1, None, 10.0, -2 ** 40),
+        (0, "o'neil", 2.5, 0),
+        (None, '', -1.0, 7)]
+
+#Filters evaluated by both
+expressions = ['visited = 1', 'visited = 0', 'visited <> 0', 'visited != 1', 'visited < 1', 'visited >= 0',
+               'visited IN (0, 1)', 'visited NOT IN (1)', 'visited IS NULL', 'visited IS NOT NULL',
+               'NOT visited = 1', 'VISITED = 1 AND value >= 0', 'NOT (visited = 1) OR name IS NULL',
+               "name = '5'", 'name = 5', "name IN ('a', '05')", "name = 'o''neil'", "name = ''", "name > 'a'",
+               "name IS NULL", 'value > 1', 'value = 0', "value = '1.5'", 'value IN (1.5, 10)', 'value < 0.5',
+               'big > 1000000000', 'big = 1099511627776', 'big < 0', 'big IS NULL']
+
+
+def writeLayer(filePath):
+    """Writes the rows as point layer of a GeoPackage"""
+    source = ogr.GetDriverByName('GPKG').CreateDataSource(filePath)
+    layer = source.CreateLayer('rows', None, ogr.wkbPoint)
+    layer.CreateField(ogr.FieldDefn('visited', ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTReal))
+    layer.CreateField(ogr.FieldDefn('big', ogr.OFTInteger64))
+
+    for i, row in enumerate(rows):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POINT (%i 0)' % i))
+        for name, value in zip(('visited', 'name', 'value', 'big'), row):
+            if value is None:
+                feature.SetFieldNull(name)
+            else:
+                feature.SetField(name, value)
+        layer.CreateFeature(feature)
+    del source
+
+
+def ogrFids(filePath, expression):
+    """Returns the fids of the features matching an attribute filter in OGR"""
+    source = ogr.Open(filePath, 0)
+    layer = source.GetLayer(0)
+    layer.SetAttributeFilter(expression)
+    fids = sorted(feature.GetFID() for feature in layer)
+    del source
+    return fids
+
+
+
+class AttributeFilter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.filePath = os.path.join(cls.directory.name, 'rows.gpkg')
+        writeLayer(cls.filePath)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+
+    def loadLayer(self, bulkRead):
+        layer = Layer()
+        layer.bulkRead = bulkRead
+        layer.loadShp(self.filePath)
+        return layer
+
+
+    def testSameAsOgr(self):
+        for bulkRead in (False, True):
+            layer = self.loadLayer(bulkRead)
+            for expression in expressions:
+                with self.subTest(expression = expression, bulkRead = bulkRead):
+                    self.assertEqual(sorted(layer.filterLayer(expression).fids), ogrFids(self.filePath, expression))
+
+
+    def testNullValues(self):
+        for bulkRead in (False, True):
+            layer = self.loadLayer(bulkRead)
+            attributes = layer.getGeometryByFID(3).getAttributes()
+            self.assertEqual(attributes, {'visited': None, 'name': '05', 'value': None, 'big': None})
+
+
+    def testUnknownField(self):
+        layer = self.loadLayer(False)
+        for expression in ('visted = 1', 'FID = 1', 'visited = 1 OR nmae IS NULL'):
+            with self.subTest(expression = expression):
+                with self.assertRaises(ValueError):
+                    layer.filterLayer(expression)
+
+
+    def testSemantics(self):
+        cases = [('visited = 0', {'visited': None}, False),
+                 ('visited <> 0', {'visited': None}, False),
+                 ('visited IS NULL', {'visited': None}, True),
+                 ('visited IS NOT NULL', {'visited': 0}, True),
+                 ('visited IN (0, 1)', {'visited': None}, False),
+                 ('visited NOT IN (0, 1)', {'visited': None}, False),
+                 ('NOT visited = 1', {'visited': None}, False),
+                 ('NOT (visited = 1 AND name IS NULL)', {'visited': None, 'name': 'a'}, True),
+                 ('visited = 1 OR name IS NULL', {'visited': None, 'name': None}, True),
+                 ('name = 5', {'name': '5'}, True),
+                 ('name = 5', {'name': '05'}, False),
+                 ("visited = '1'", {'visited': 1}, True),
+                 ("value = '1.5'", {'value': 1.5}, True),
+                 ("visited = 'abc'", {'visited': 0}, True),
+                 ('Visited = 1', {'visited': 1}, True)]
+        for expression, attributes, expected in cases:
+            with self.subTest(expression = expression, attributes = attributes):
+                self.assertEqual(compileAttributeFilter(expression, ['visited', 'name', 'value'])(attributes), expected)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Reading layers with Z/M coordinates and curve geometries: Layer.loadShp converts
+them to 2D linear geometries
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+    import ogr
+except ImportError:
+    raise unittest.SkipTest('GDAL (ogr) is not installed')
+
+from ShpHelper import Layer
+
+
+#Layers (name, OGR geometry type, WKT of the features)
+layers = [('polygonz', ogr.wkbMultiPolygon25D, ['MULTIPOLYGON Z (((0 0 5,10 0 5,10 10 5,0 10 5,0 0 5)))']),
+          ('polygonm', ogr.wkbPolygonM, ['POLYGON M ((0 0 1,10 0 2,10 10 3,0 10 4,0 0 1))']),
+          ('curve', ogr.wkbCurvePolygon, ['CURVEPOLYGON (CIRCULARSTRING (0 0,10 0,0 0))']),
+          ('surface', ogr.wkbMultiSurface, ['MULTISURFACE (CURVEPOLYGON (CIRCULARSTRING (0 0,10 0,0 0)),((20 0,30 0,30 10,20 0)))'])]
+
+#Layer of a type without linear equivalent, FlatGeobuf supports it unlike GeoPackage
+tinLayer = ('tin', ogr.wkbTIN, ['TIN (((0 0 0,10 0 0,0 10 0,0 0 0)))'])
+
+
+def writeLayers(filePath, driverName, layers):
+    """Writes the layers into a new data source"""
+    source = ogr.GetDriverByName(driverName).CreateDataSource(filePath)
+    for name, geomType, features in layers:
+        layer = source.CreateLayer(name, None, geomType)
+        for wkt in features:
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+            layer.CreateFeature(feature)
+    del source
+
+
+
+class GeometryTypes(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.filePath = os.path.join(cls.directory.name, 'types.gpkg')
+        writeLayers(cls.filePath, 'GPKG', layers)
+        cls.tinPath = os.path.join(cls.directory.name, 'tin.fgb')
+        writeLayers(cls.tinPath, 'FlatGeobuf', [tinLayer])
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+
+    def loadLayer(self, name, filePath = None):
+        layer = Layer()
+        layer.loadShp(filePath or self.filePath, name)
+        return layer
+
+
+    def testZM(self):
+        for name, geometryType in (('polygonz', 'MultiPolygon'), ('polygonm', 'Polygon')):
+            with self.subTest(name = name):
+                layer = self.loadLayer(name)
+                self.assertEqual(layer.geometryType, geometryType)
+                geom = layer.geomColumn[0]
+                self.assertFalse(geom.has_z)
+                self.assertAlmostEqual(geom.area, 100)
+
+
+    def testCurves(self):
+        #The circle of diameter 10 (area 78.5) is approximated by a polygon
+        for name, geometryType, area in (('curve', 'Polygon', 78.5), ('surface', 'MultiPolygon', 128.5)):
+            with self.subTest(name = name):
+                layer = self.loadLayer(name)
+                self.assertEqual(layer.geometryType, geometryType)
+                geom = layer.geomColumn[0]
+                self.assertEqual(geom.geom_type, geometryType)
+                self.assertAlmostEqual(geom.area, area, delta = 1)
+
+
+    def testUnsupported(self):
+        with self.assertRaises(ValueError):
+            self.loadLayer(0, self.tinPath)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Round trip of the exposure output through a GeoPackage: the points and the rays are
+written into one file and read again with OGR
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+    import ogr
+    import osr
+except ImportError:
+    raise unittest.SkipTest('GDAL (ogr) is not installed')
+
+from WaveExposure import WaveExposure
+
+
+#Square islands (x, y, size, visited, name)
+islands = [(0, 0, 100, 1, 'north'), (400, 0, 100, 1, 'east'), (0, -400, 100, 0, 'south'),
+           (-400, 0, 50, 1, 'west')]
+
+
+def writeIslands(filePath):
+    """Writes the islands as polygon layer of a GeoPackage"""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3006)
+
+    source = ogr.GetDriverByName('GPKG').CreateDataSource(filePath)
+    layer = source.CreateLayer('islands', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('visited', ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+
+    for x, y, size, visited, name in islands:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((%s %s, %s %s, %s %s, %s %s, %s %s))' % (
+            x, y, x + size, y, x + size, y + size, x, y + size, x, y)))
+        feature.SetField('visited', visited)
+        feature.SetField('name', name)
+        layer.CreateFeature(feature)
+    del source
+
+
+def readLayer(source, layerName):
+    """Returns {fid: (attributes, geometry WKT)} of a layer"""
+    layer = source.GetLayerByName(layerName)
+    layerDefn = layer.GetLayerDefn()
+    names = [layerDefn.GetFieldDefn(i).GetName() for i in range(layerDefn.GetFieldCount())]
+    return {feature.GetFID(): ({name: feature.GetField(name) for name in names}, feature.GetGeometryRef().ExportToWkt())
+            for feature in layer}
+
+
+
+class GeoPackageRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sourceFile = os.path.join(self.directory.name, 'islands.gpkg')
+        writeIslands(self.sourceFile)
+
+        self.exposure = WaveExposure()
+        self.exposure.setSourceFile(self.sourceFile)
+        self.exposure.setFilter('visited = 1')
+        self.exposure.setRayLength(1000)
+        self.exposure.setDegree(45)
+        self.exposure.loadIslandData()
+        self.exposure.calcExposure(self.exposure.visitedIslands, self.exposure.allIslandsLayer)
+        self.expected = {fid: dict(self.exposure.pointLayer.getGeometryByFID(fid).getAttributes())
+                         for fid in self.exposure.visitedIslands.fids}
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def checkOutput(self, filePath):
+        source = ogr.Open(filePath, 0)
+        self.assertIsNotNone(source)
+        points = readLayer(source, 'points')
+        rays = readLayer(source, 'rays')
+
+        visited = sorted(self.expected)
+        self.assertEqual(sorted(points), visited)
+        self.assertEqual(sorted(rays), visited)
+
+        #The String field FID doesn't collide with the primary key of the layers
+        self.assertNotEqual(source.GetLayerByName('points').GetFIDColumn().lower(), 'fid')
+
+        for fid in visited:
+            expected = self.expected[fid]
+            for layer in (points, rays):
+                attributes, wkt = layer[fid]
+                self.assertEqual(attributes['FID'], str(fid))
+                self.assertEqual(attributes['name'], expected['name'])
+                self.assertAlmostEqual(attributes['Exposure'], expected['Exposure'])
+                self.assertGreater(attributes['Exposure'], 0)
+
+            self.assertTrue(points[fid][1].startswith('POINT'))
+            self.assertTrue(rays[fid][1].startswith('MULTILINESTRING'))
+        del source
+
+
+    def testOneFile(self):
+        filePath = os.path.join(self.directory.name, 'exposure.gpkg')
+        self.exposure.saveLayers(filePath, filePath)
+        self.checkOutput(filePath)
+
+
+    def testStreamed(self):
+        filePath = os.path.join(self.directory.name, 'streamed.gpkg')
+        self.exposure.streamExposure(self.exposure.visitedIslands, self.exposure.allIslandsLayer, filePath, filePath)
+        self.checkOutput(filePath)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
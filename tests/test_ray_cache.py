@@ -0,0 +1,160 @@
+"""
+The incremental mode of WaveExposure: the RayCache keeps the rays of a calculation
+and only the rays affected by changed islands or a longer ray length are cast again
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+try:
+    import ogr
+except ImportError:
+    raise unittest.SkipTest('GDAL (ogr) is not installed')
+
+from shapely import affinity
+from shapely.geometry import LineString
+from shapely.geometry import Point
+from shapely.geometry import box
+
+from WaveExposure import WaveExposure
+from RayCasting import unitVector
+from ExposureCache import angleKey
+from Archipelago import generateArchipelago
+
+
+def createExposure(length, incremental):
+    exposure = WaveExposure()
+    exposure.setRayLength(length)
+    exposure.setDegree(10)
+    exposure.setIncremental(incremental)
+    return exposure
+
+
+def cachedRays(rayCache):
+    """Returns {(fid, angleKey): (x, y, reach)} of all cached rays"""
+    rays = {}
+    for fid, siteRays in rayCache.rays.items():
+        x, y = rayCache.sites[fid][1]
+        for key, (length, distance, hitPoint) in siteRays.items():
+            rays[(fid, key)] = (x, y, min(length, distance))
+    return rays
+
+
+def raysPassing(rays, boundsList):
+    """Returns the keys of the rays (see cachedRays) passing one of the bounding boxes"""
+    boxes = [box(*bounds) for bounds in boundsList]
+    passing = set()
+    for key, (x, y, reach) in rays.items():
+        ux, uy = unitVector(key[1])
+        ray = LineString([(x, y), (x + ux * reach, y + uy * reach)])
+        if any(ray.intersects(changed) for changed in boxes):
+            passing.add(key)
+    return passing
+
+
+
+class IncrementalRayCache(unittest.TestCase):
+
+    def setUp(self):
+        self.layer = generateArchipelago(islands = 150, vertices = 24, clustering = 0.7, extent = 6000, visitedShare = 0.2)
+        self.exposure = createExposure(1000, True)
+        self.calculate()
+
+
+    def calculate(self):
+        self.exposure.calcExposure(self.layer.filterLayer('visited = 1'), self.layer)
+
+
+    def assertSameAsFresh(self):
+        """Compares the result of the incremental calculation with a calculation
+        without ray cache"""
+        fresh = createExposure(self.exposure.getRayLength(), False)
+        fresh.calcExposure(self.layer.filterLayer('visited = 1'), self.layer)
+        expected = {fid: geometry.getAttributes()['Exposure'] for fid, geometry in fresh.pointLayer.geometries.items()}
+        exposures = {fid: geometry.getAttributes()['Exposure'] for fid, geometry in self.exposure.pointLayer.geometries.items()}
+        self.assertEqual(sorted(exposures), sorted(expected))
+        for fid in expected:
+            self.assertAlmostEqual(exposures[fid], expected[fid], places = 6)
+
+
+    def nearestIsland(self, visited):
+        """Returns the fid of the island (not visited) closest to a visited island"""
+        visitedFids = set(self.layer.filterLayer('visited = 1').fids)
+        site = self.layer.getGeometryByFID(visited).getCentroid()
+        others = [fid for fid in self.layer.fids if fid not in visitedFids]
+        return min(others, key = lambda fid: self.layer.getGeometryByFID(fid).getGeometry().distance(site))
+
+
+    def testUnchanged(self):
+        rays = cachedRays(self.exposure.rayCache)
+        self.exposure.rayCache.update(self.layer.filterLayer('visited = 1'), self.layer, self.exposure.getRayCacheKey())
+        self.assertEqual(cachedRays(self.exposure.rayCache), rays)
+
+
+    def testMovedIsland(self):
+        visited = self.layer.filterLayer('visited = 1').fids[0]
+        fid = self.nearestIsland(visited)
+        geometry = self.layer.getGeometryByFID(fid)
+        oldBounds = geometry.getGeometry().bounds
+        moved = affinity.translate(geometry.getGeometry(), 150, 100)
+        self.layer.addRow(fid, moved, dict(geometry.getAttributes()))
+
+        rays = cachedRays(self.exposure.rayCache)
+        affected = raysPassing(rays, [oldBounds, moved.bounds])
+        self.assertTrue(affected)
+        self.assertLess(len(affected), len(rays))
+
+        self.exposure.rayCache.update(self.layer.filterLayer('visited = 1'), self.layer, self.exposure.getRayCacheKey())
+        self.assertEqual(set(cachedRays(self.exposure.rayCache)), set(rays) - affected)
+
+        self.calculate()
+        self.assertSameAsFresh()
+
+
+    def testAddedIsland(self):
+        rays = cachedRays(self.exposure.rayCache)
+        #A new island on a free ray of a site
+        key = min(key for key, (x, y, reach) in rays.items() if reach == 1000)
+        x, y, reach = rays[key]
+        ux, uy = unitVector(key[1])
+        added = Point(x + ux * 500, y + uy * 500).buffer(60, 8)
+        self.layer.addRow(max(self.layer.fids) + 1, added, {'visited': 0, 'name': 'added'})
+
+        affected = raysPassing(rays, [added.bounds])
+        self.assertIn(key, affected)
+        self.assertLess(len(affected), len(rays))
+
+        self.exposure.rayCache.update(self.layer.filterLayer('visited = 1'), self.layer, self.exposure.getRayCacheKey())
+        self.assertEqual(set(cachedRays(self.exposure.rayCache)), set(rays) - affected)
+
+        self.calculate()
+        self.assertSameAsFresh()
+
+
+    def testLongerRays(self):
+        rayCache = self.exposure.rayCache
+        angles = self.exposure.getAngles()
+        for fid in self.layer.filterLayer('visited = 1').fids:
+            free = [angle for angle in angles if rayCache.rays[fid][angleKey(angle)][2] is None]
+            #Shorter rays are served from the cache, longer rays recast the free rays only
+            self.assertEqual(rayCache.missingAngles(fid, angles, 500), [])
+            self.assertEqual(rayCache.missingAngles(fid, angles, 2000), free)
+
+        self.exposure.setRayLength(2000)
+        self.calculate()
+        self.assertSameAsFresh()
+
+        self.exposure.setRayLength(500)
+        self.calculate()
+        self.assertSameAsFresh()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+The ray casters of RayCasting on synthetic islands: the numpy engine compared with
+the shapely engine, and the rays cast against the simplified boundaries compared
+with the rays cast against the full boundaries
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+try:
+    import ogr
+except ImportError:
+    raise unittest.SkipTest('GDAL (ogr) is not installed')
+
+from shapely.geometry import Point
+from shapely.geometry import Polygon
+
+import RayCasting
+from ShpHelper import Layer
+from RayCasting import NumpyRayCaster
+from RayCasting import ShapelyRayCaster
+from Archipelago import generateArchipelago
+
+
+#Directions of the rays in degrees
+angles = [i * 2.0 for i in range(180)]
+
+
+def bayLayer():
+    """Returns a small island (fid 1) whose centroid is 4 m off the coast of a bay of
+    a large island (fid 2). The bay is shallower than the simplification tolerance
+    of the tests, so the simplified coast runs across the bay mouth, past the site"""
+    layer = Layer()
+    layer.addField('visited', 'Integer')
+    layer.addRow(1, Point(0, -5).buffer(1, 8), {'visited': 1})
+    layer.addRow(2, Polygon([(-500, -1000), (500, -1000), (500, 0), (15, 0), (0, -9), (-15, 0), (-500, 0)]), {'visited': 0})
+    return layer
+
+
+def castDistances(layer, length, tolerance = None, caster = None):
+    """Returns {fid: distances} of the visited islands cast with the given caster
+    (default the shapely engine)"""
+    layer.simplifyBoundaries(tolerance)
+    caster = caster or ShapelyRayCaster(layer, length)
+    distances = {}
+    for fid, geometry in layer.filterLayer('visited = 1').geometries.items():
+        distances[fid] = [distance for distance, endPoint in caster.castRays(fid, geometry.getCentroid(), angles)]
+    return distances
+
+
+
+class Engines(unittest.TestCase):
+
+    def setUp(self):
+        if RayCasting.np is None:
+            self.skipTest('The numpy engine requires numpy')
+        self.layer = generateArchipelago(islands = 200, vertices = 32, clustering = 0.7, extent = 8000, visitedShare = 0.2)
+
+
+    def assertSameDistances(self, distances, expected):
+        for fid in expected:
+            with self.subTest(fid = fid):
+                error = max(abs(distance - expectedDistance) for distance, expectedDistance in zip(distances[fid], expected[fid]))
+                self.assertLess(error, 1e-6)
+
+
+    def testSites(self):
+        for length in (500, 3000):
+            with self.subTest(length = length):
+                expected = castDistances(self.layer, length)
+                distances = castDistances(self.layer, length, caster = NumpyRayCaster(self.layer, length))
+                #Some rays hit an island, others are free
+                self.assertTrue(any(distance < length for fidDistances in expected.values() for distance in fidDistances))
+                self.assertTrue(any(distance == length for fidDistances in expected.values() for distance in fidDistances))
+                self.assertSameDistances(distances, expected)
+
+
+    def testSamplePoints(self):
+        minx, miny, maxx, maxy = (500000, 6400000, 508000, 6408000)
+        xs = [minx + (maxx - minx) * i / 7.0 for i in range(8) for j in range(8)]
+        ys = [miny + (maxy - miny) * j / 7.0 for i in range(8) for j in range(8)]
+        expected = ShapelyRayCaster(self.layer, 1500).castPoints(xs, ys, angles)
+        distances = NumpyRayCaster(self.layer, 1500).castPoints(xs, ys, angles)
+        self.assertEqual(distances.shape, (len(xs), len(angles)))
+        self.assertLess(abs(distances - expected).max(), 1e-6)
+
+
+
+class SimplifiedBoundaries(unittest.TestCase):
+
+    def assertWithinError(self, layer, length, tolerance):
+        expected = castDistances(layer, length)
+        distances = castDistances(layer, length, tolerance)
+        maxError = ShapelyRayCaster.maxErrorFactor * tolerance
+        for fid in expected:
+            with self.subTest(fid = fid):
+                error = max(abs(distance - expectedDistance) for distance, expectedDistance in zip(distances[fid], expected[fid]))
+                self.assertLessEqual(error, maxError)
+
+
+    def testSiteNearCoast(self):
+        layer = bayLayer()
+        expected = castDistances(layer, 2000)
+        #Many rays leave the bay without hitting any coast
+        self.assertGreater(sum(distance == 2000 for distance in expected[1]), len(angles) // 3)
+        self.assertWithinError(layer, 2000, 10)
+
+
+    def testArchipelago(self):
+        layer = generateArchipelago(islands = 200, vertices = 48, clustering = 0.7, extent = 8000, visitedShare = 0.2)
+        for tolerance in (1, 5):
+            with self.subTest(tolerance = tolerance):
+                self.assertWithinError(layer, 1500, tolerance)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
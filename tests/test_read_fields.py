@@ -0,0 +1,113 @@
+"""
+The attribute dicts of the two readers of Layer.iterShp: the FieldDecoder and the
+column batches of OGR's Arrow stream (GDAL >= 3.6 and pyarrow)
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+    import ogr
+except ImportError:
+    raise unittest.SkipTest('GDAL (ogr) is not installed')
+
+import ShpHelper
+from ShpHelper import Layer
+
+
+#Rows (count, big, value, name, flag, FID), None is NULL
+rows = [(1, 2 ** 40, 1.5, 'a', 1, 'x'),
+        (0, -2 ** 40, 0.0, '', 0, None),
+        (None, None, None, None, None, 'y'),
+        (-7, 0, -1.25, "o'neil", 1, ''),
+        (2 ** 31 - 1, 2 ** 62, 1e300, 'ä', None, '5')]
+
+names = ('count', 'big', 'value', 'name', 'flag', 'FID')
+
+
+def writeLayer(filePath):
+    """Writes the rows as point layer of a GeoPackage. The primary key is ogc_fid, so
+    that the String field FID can be created"""
+    source = ogr.GetDriverByName('GPKG').CreateDataSource(filePath)
+    layer = source.CreateLayer('rows', None, ogr.wkbPoint, options = ['FID=ogc_fid'])
+    layer.CreateField(ogr.FieldDefn('count', ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn('big', ogr.OFTInteger64))
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTReal))
+    layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+    flag = ogr.FieldDefn('flag', ogr.OFTInteger)
+    flag.SetSubType(ogr.OFSTBoolean)
+    layer.CreateField(flag)
+    layer.CreateField(ogr.FieldDefn('FID', ogr.OFTString))
+
+    for i, row in enumerate(rows):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POINT (%i 0)' % i))
+        for name, value in zip(names, row):
+            if value is None:
+                feature.SetFieldNull(name)
+            else:
+                feature.SetField(name, value)
+        layer.CreateFeature(feature)
+    del source
+
+
+
+class ReadFields(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.filePath = os.path.join(cls.directory.name, 'rows.gpkg')
+        writeLayer(cls.filePath)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+
+    def readAttributes(self, bulkRead, fields = None):
+        """Returns the list of (fid, attribute dict) read by iterShp"""
+        layer = Layer()
+        layer.bulkRead = bulkRead
+        return [(geometry.fid, geometry.getAttributes()) for geometry in layer.iterShp(self.filePath, fields = fields)]
+
+
+    def canReadArrow(self):
+        return ShpHelper.pa is not None and hasattr(ogr.Layer, 'GetArrowStreamAsPyArrow')
+
+
+    def testDecoder(self):
+        features = self.readAttributes(False)
+        self.assertEqual([fid for fid, attributes in features], [1, 2, 3, 4, 5])
+        for (fid, attributes), row in zip(features, rows):
+            expected = dict(zip(names, row))
+            #A field named FID holds the FID of the feature
+            expected['FID'] = fid
+            self.assertEqual(attributes, expected)
+            for name in ('count', 'big', 'flag'):
+                self.assertIn(type(attributes[name]), (int, type(None)))
+
+
+    def testArrowSameAsDecoder(self):
+        if not self.canReadArrow():
+            self.skipTest('The Arrow stream requires GDAL >= 3.6 and pyarrow')
+        for fields in (None, ['big', 'FID'], ['flag', 'name']):
+            with self.subTest(fields = fields):
+                expected = self.readAttributes(False, fields)
+                features = self.readAttributes(True, fields)
+                self.assertEqual(features, expected)
+                for (fid, attributes), (expectedFid, expectedAttributes) in zip(features, expected):
+                    self.assertEqual({name: type(value) for name, value in attributes.items()},
+                                     {name: type(value) for name, value in expectedAttributes.items()})
+
+
+
+if __name__ == '__main__':
+    unittest.main()